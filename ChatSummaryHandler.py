@@ -0,0 +1,33 @@
+import azure.functions as func
+import logging
+import os
+from query_log import connect, track_queries
+from chat_summary import update_session_summary, SUMMARY_QUEUE_NAME
+from chat_schema import ensure_chat_schema
+
+app = func.FunctionApp()
+
+DB_CONFIG = {
+    "host": os.getenv("COSMOPG_HOST"),
+    "dbname": os.getenv("COSMOPG_DBNAME"),
+    "user": os.getenv("COSMOPG_USER"),
+    "password": os.getenv("COSMOPG_PASSWORD"),
+    "port": 5432
+}
+
+
+@app.queue_trigger(arg_name="msg", queue_name=SUMMARY_QUEUE_NAME, connection="AZURE_STORAGE_CONNECTION_STRING")
+@track_queries()
+def SummarizeChat(msg: func.QueueMessage) -> None:
+    """Fold a stored turn into the rolling summary of its session.
+
+    Failures raise, so the queue delivers the message again later.
+    """
+    message = msg.get_json()
+    logging.info(f"Summarizing turn {message.get('message_uuid')} of session {message.get('sessionid')}")
+    connection = connect(**DB_CONFIG)
+    try:
+        ensure_chat_schema(connection)
+        update_session_summary(connection, message["sessionid"], message["message_uuid"])
+    finally:
+        connection.close()
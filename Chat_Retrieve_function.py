@@ -1,109 +1,207 @@
-import logging
-import json
-import os
-import psycopg2
-import azure.functions as func
-from azure.core.exceptions import HttpResponseError
-
-app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
-
-# Database connection configuration
-DB_CONFIG = {
-    "host": os.getenv("COSMOPG_HOST"),
-    "dbname": os.getenv("COSMOPG_DBNAME"),
-    "user": os.getenv("COSMOPG_USER"),
-    "password": os.getenv("COSMOPG_PASSWORD"),
-    "port": 5432
-}
-
-@app.route(route="Chat_Retrieve_function")
-def Chat_Retrieve_function(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Chat Retrieve started.')
-
-    try:
-        # Parse incoming request
-        request_body = req.get_json() if req.get_body() else None
-        if not request_body:
-            return func.HttpResponse(
-                "Bad Request: Missing email or session_id in request body",
-                status_code=400
-            )
-
-        user_email = request_body.get('email')
-        session_id = request_body.get('session_id')
-
-        if not user_email or not session_id:
-            return func.HttpResponse(
-                "Bad Request: Missing email or session_id in request body",
-                status_code=400
-            )
-
-        # Log the input
-        logging.info(f"Received email: {user_email}, session_id: {session_id}")
-
-        # Get the database connection
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        # Query the database for records with the given email and session_id
-        query = """
-            SELECT * FROM chat_logs 
-            WHERE email = %s AND sessionid = %s
-            ORDER BY timestamp;
-        """
-        cursor.execute(query, (user_email, session_id))
-        items = cursor.fetchall()
-
-        # Format results as JSON
-        result = []
-        for item in items:
-            result.append({
-                "sessionId": item[12],
-                "message_uuid":  item[0],
-                "timestamp": str(item[1]),
-                "output":  item[10],
-                "Data_source":  item[3],
-                "sources":  item[13],
-                "email": item[5],
-                "Input_query":  item[9],
-                "feedback": item[6],
-                "feedback_text": item[7],
-                "feedback_type": item[8], 
-                "document_upload":  item[4]
-            })
-
-        # Close cursor and connection
-        cursor.close()
-        connection.close()
-
-        # Return the response with formatted result
-        return func.HttpResponse(
-            json.dumps({
-                "statusCode": 200,
-                "body": result
-            }),
-            status_code=200,
-            mimetype="application/json"
-        )
-
-    except HttpResponseError as e:
-        logging.error(f"Error fetching data: {str(e)}")
-        return func.HttpResponse(
-            f"Error fetching data: {str(e)}",
-            status_code=500
-        )
-    except Exception as e:
-        logging.error(f"Unexpected error: {str(e)}")
-        return func.HttpResponse(
-            f"Unexpected error: {str(e)}",
-            status_code=500
-        )
-    
-def get_db_connection():
-    try:
-        # Establish the connection to the database
-        connection = psycopg2.connect(**DB_CONFIG)
-        return connection
-    except Exception as e:
-        logging.error(f"Error while connecting to the database: {str(e)}")
-        raise e
+import logging
+import os
+import base64
+from query_log import connect, track_queries
+import azure.functions as func
+from azure.core.exceptions import HttpResponseError
+from stage_timing import StageTimer
+from http_cache import make_etag, etag_matches, not_modified, json_response
+from chat_schema import ensure_chat_schema
+
+app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+
+# Database connection configuration
+DB_CONFIG = {
+    "host": os.getenv("COSMOPG_HOST"),
+    "dbname": os.getenv("COSMOPG_DBNAME"),
+    "user": os.getenv("COSMOPG_USER"),
+    "password": os.getenv("COSMOPG_PASSWORD"),
+    "port": 5432
+}
+
+# chat_logs columns up to sources, in table order; the uploaded document is never returned
+HISTORY_COLUMNS = """
+    message_uuid, timestamp, chat_summary, data_source, document_upload, email, feedback, feedback_text,
+    feedback_type, input_query, output, processed_query, sessionid, sources
+"""
+# Messages per page when paging with a cursor or limit, and the most a client may ask for
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = 200
+
+@app.route(route="Chat_Retrieve_function")
+@track_queries()
+def Chat_Retrieve_function(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Chat Retrieve started.')
+    timer = StageTimer("history")
+
+    try:
+        # Parse incoming request; GET requests pass email and session_id as parameters
+        request_body = req.get_json() if req.get_body() else dict(req.params)
+        if not request_body:
+            return func.HttpResponse(
+                "Bad Request: Missing email or session_id in request body",
+                status_code=400
+            )
+
+        user_email = request_body.get('email')
+        session_id = request_body.get('session_id')
+
+        if not user_email or not session_id:
+            return func.HttpResponse(
+                "Bad Request: Missing email or session_id in request body",
+                status_code=400
+            )
+
+        # Optional paging: messages after the since cursor, before the before cursor, or the latest limit
+        try:
+            since = decode_cursor(request_body.get('since'))
+            before = decode_cursor(request_body.get('before'))
+            limit = request_body.get('limit')
+            limit = min(int(limit), HISTORY_MAX_PAGE_SIZE) if limit else None
+            if limit is not None and limit < 1:
+                raise ValueError("limit must be positive")
+        except ValueError as e:
+            return func.HttpResponse(f"Bad Request: {str(e)}", status_code=400)
+        if since and before:
+            return func.HttpResponse("Bad Request: pass either since or before", status_code=400)
+        paged = bool(since or before or limit)
+
+        # Log the input
+        logging.info(f"Received email: {user_email}, session_id: {session_id}")
+
+        # Get the database connection
+        with timer.stage("db_connect"):
+            connection = get_db_connection()
+            ensure_chat_schema(connection)
+        cursor = connection.cursor()
+
+        # The full transcript is versioned for conditional requests; a page only costs its own rows
+        etag = None
+        if not paged:
+            # Version of the history from aggregates only: rows are added and deleted, and the writes of
+            # feedback and summaries into existing rows bump their updated_at
+            with timer.stage("db_version"):
+                cursor.execute("""
+                    SELECT count(*), max(timestamp), max(updated_at)
+                    FROM chat_logs
+                    WHERE email = %s AND sessionid = %s
+                """, (user_email, session_id))
+                etag = make_etag(user_email, session_id, *cursor.fetchone())
+            if etag_matches(req, etag):
+                cursor.close()
+                connection.close()
+                return not_modified(etag)
+
+        # Query the database for records with the given email and session_id; (timestamp, message_uuid)
+        # orders messages with equal timestamps and is the keyset the cursors point into
+        page_size = limit or HISTORY_PAGE_SIZE
+        if since:
+            query = f"""
+                SELECT {HISTORY_COLUMNS} FROM chat_logs
+                WHERE email = %s AND sessionid = %s AND (timestamp, message_uuid) > (%s, %s)
+                ORDER BY timestamp, message_uuid
+                LIMIT %s
+            """
+            params = (user_email, session_id, *since, page_size + 1)
+        elif before or limit:
+            query = f"""
+                SELECT {HISTORY_COLUMNS} FROM chat_logs
+                WHERE email = %s AND sessionid = %s {"AND (timestamp, message_uuid) < (%s, %s)" if before else ""}
+                ORDER BY timestamp DESC, message_uuid DESC
+                LIMIT %s
+            """
+            params = (user_email, session_id, *(before or ()), page_size + 1)
+        else:
+            query = f"""
+                SELECT {HISTORY_COLUMNS} FROM chat_logs
+                WHERE email = %s AND sessionid = %s
+                ORDER BY timestamp, message_uuid
+            """
+            params = (user_email, session_id)
+        with timer.stage("db_query"):
+            cursor.execute(query, params)
+            items = cursor.fetchall()
+
+        # One row beyond the page tells whether there are more in its direction
+        has_more = paged and len(items) > page_size
+        items = items[:page_size] if paged else items
+        if paged and not since:
+            items.reverse()
+
+        # Format results as JSON
+        result = []
+        for item in items:
+            result.append({
+                "sessionId": item[12],
+                "message_uuid":  item[0],
+                "timestamp": str(item[1]),
+                "output":  item[10],
+                "Data_source":  item[3],
+                "sources":  item[13],
+                "email": item[5],
+                "Input_query":  item[9],
+                "feedback": item[6],
+                "feedback_text": item[7],
+                "feedback_type": item[8], 
+                "document_upload":  item[4],
+                "chat_summary": item[2],
+                "cursor": encode_cursor(item[1], item[0])
+            })
+
+        # Close cursor and connection
+        cursor.close()
+        connection.close()
+
+        # Return the response with formatted result
+        # since: where the next delta sync continues from; has_more: another page follows in this direction
+        latest = result[-1]["cursor"] if result and not before else request_body.get('since')
+        return json_response(req, {
+                "statusCode": 200,
+                "body": result,
+                "since": latest,
+                "has_more": has_more
+            },
+            etag=etag,
+            headers=timer.finish(rows=len(result))
+        )
+
+    except HttpResponseError as e:
+        logging.error(f"Error fetching data: {str(e)}")
+        return func.HttpResponse(
+            f"Error fetching data: {str(e)}",
+            status_code=500
+        )
+    except Exception as e:
+        logging.error(f"Unexpected error: {str(e)}")
+        return func.HttpResponse(
+            f"Unexpected error: {str(e)}",
+            status_code=500
+        )
+    
+def get_db_connection():
+    try:
+        # Establish the connection to the database
+        connection = connect(**DB_CONFIG)
+        return connection
+    except Exception as e:
+        logging.error(f"Error while connecting to the database: {str(e)}")
+        raise e
+
+
+def encode_cursor(timestamp, message_uuid):
+    """Opaque cursor of a message: its position (timestamp, message_uuid) in the session."""
+    return base64.urlsafe_b64encode(f"{timestamp}|{message_uuid}".encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(timestamp, message_uuid) of a cursor, None if there is none; ValueError if it is malformed."""
+    if not cursor:
+        return None
+    try:
+        text = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+    except Exception:
+        raise ValueError("malformed cursor")
+    timestamp, separator, message_uuid = text.rpartition("|")
+    if not separator or not timestamp or not message_uuid:
+        raise ValueError("malformed cursor")
+    return timestamp, message_uuid
@@ -0,0 +1,31 @@
+import azure.functions as func
+import logging
+# HTTP streaming needs the FastAPI extension (azurefunctions-extensions-http-fastapi)
+from azurefunctions.extensions.http.fastapi import Request, StreamingResponse, PlainTextResponse
+from chat_export import export_chat_logs, parse_date, EXPORT_FORMATS
+
+app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
+
+
+@app.route(route="ExportChatLogs", methods=[func.HttpMethod.GET])
+async def ExportChatLogs(req: Request) -> StreamingResponse:
+    """Stream chat_logs as ?format=csv (default), jsonl.gz or parquet.
+
+    Optional filters: start and end (ISO date or timestamp, end excluded), email and data_source.
+    """
+    logging.info('Exporting chat logs...')
+    export_format = req.query_params.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return PlainTextResponse(f"Bad Request: format must be one of {', '.join(EXPORT_FORMATS)}", status_code=400)
+    try:
+        start = parse_date(req.query_params.get("start"))
+        end = parse_date(req.query_params.get("end"))
+    except ValueError as e:
+        return PlainTextResponse(f"Bad Request: {str(e)}", status_code=400)
+
+    media_type, extension = EXPORT_FORMATS[export_format]
+    # The generator is iterated on a worker thread, one chunk at a time, as the client reads
+    chunks = export_chat_logs(export_format, start, end, req.query_params.get("email"),
+                              req.query_params.get("data_source"))
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="chat_logs.{extension}"'})
@@ -1,241 +1,752 @@
-import azure.functions as func
-import os
-import logging
-import requests
-from msal import ConfidentialClientApplication
-from io import BytesIO
-from azure.storage.blob import BlobServiceClient, ContentSettings
-import time
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-import threading
-import psycopg2
-
-app = func.FunctionApp()
-
-# Your existing configurations
-site_ids = {
-    "operations": "askbrinkmann.sharepoint.com,9016808e-d23f-4386-9ef9-e0d5d635bb79,a4630e11-fe5d-4114-940f-d5196ee016b1"
-}
-
-# Azure AD credentials
-client_id = os.getenv('AD_CLIENT_id')
-client_secret = os.getenv('AD_CLIENT_SECRET')
-tenant_id = os.getenv('TENANT_ID')
-
-# Azure Blob Storage Configuration
-AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-CONTAINER_NAME = os.getenv('BLOB_CONTAINER_NAME')
-
-# PostgreSQL Configuration
-DB_HOST = os.getenv('COSMOPG_HOST')
-DB_PORT = 5432  # Default port for PostgreSQL
-DB_USER = os.getenv('COSMOPG_USER')
-DB_PASSWORD = os.getenv('COSMOPG_PASSWORD')
-DB_NAME = os.getenv('COSMOPG_DBNAME')
-
-# Excluded file extensions
-EXCLUDED_EXTENSIONS = ['.mp4', '.mov', '.avi', '.mp3', '.wav', '.flac', '.mkv', '.png', '.jpg', '.msg', '.m4v', '.eps', '.jpeg', '.jfif', '.heic']
-
-# Avoid file names containing specific keywords (case-insensitive)
-AVOID_LIST = ["confidential", "offer letter", "compensation", 'Termination']
-
-access_token = None
-token_expiry = 0
-token_lock = threading.Lock()
-
-session = requests.Session()
-retries = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 503, 504])
-session.mount("https://", HTTPAdapter(max_retries=retries))
-
-blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-
-@app.route(route="sharepointPlugin")
-def sharepointPlugin(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Connecting to Sharepoint...')
-    try:
-        result = extract_sharepoint()
-        return func.HttpResponse(result, status_code=200)
-    except Exception as e:
-        logging.error(f"Error: {e}")
-        return func.HttpResponse(str(e), status_code=500)
-
-def get_access_token():
-    """Fetch a new access token from Azure AD."""
-    authority = f"https://login.microsoftonline.com/{tenant_id}"
-    scopes = ["https://graph.microsoft.com/.default"]
-
-    app = ConfidentialClientApplication(client_id, authority=authority, client_credential=client_secret)
-    result = app.acquire_token_for_client(scopes=scopes)
-
-    if "access_token" in result:
-        global token_expiry
-        token_expiry = time.time() + 3600
-        return result["access_token"]
-    else:
-        raise Exception("Failed to acquire access token")
-
-
-def refresh_access_token():
-    """Refresh the global access token."""
-    global access_token
-    with token_lock:
-        access_token = get_access_token()
-
-
-def get_valid_access_token():
-    """Retrieve a valid access token, refreshing it if necessary."""
-    global access_token, token_expiry
-    with token_lock:
-        if access_token is None or time.time() > token_expiry - 300:
-            refresh_access_token()
-        return access_token
-
-
-def fetch_all_drives(site_id, access_token):
-    """Fetch all drive IDs for a given SharePoint site."""
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(url, headers=headers)
-
-    if response.status_code != 200:
-        raise Exception(f"Failed to fetch drives for site {site_id}: {response.json()}")
-
-    drives = response.json().get("value", [])
-    return [drive["id"] for drive in drives]
-
-
-def is_excluded_file(file_name, folder_name):
-    """Check if a file has an excluded extension or contains avoided keywords."""
-    file_extension = os.path.splitext(file_name)[1].lower()
-    if file_extension in EXCLUDED_EXTENSIONS:
-        return True
-
-    for keyword in AVOID_LIST:
-        if keyword.lower() in folder_name.lower() or keyword.lower() in file_name.lower():
-            return True
-    return False
-
-
-def upload_to_blob_storage(file_url, blob_name, filename, sharepoint_url):
-    """Download file from SharePoint and upload to Azure Blob Storage and store in PostgreSQL."""
-    try:
-        # Download File with Timeout
-        response = session.get(file_url, stream=True, timeout=30)
-        response.raise_for_status()  # Raise error for bad status codes
-
-        # Read file into memory
-        file_data = BytesIO(response.content)
-
-        # Upload to Azure Blob Storage
-        blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=blob_name)
-        blob_client.upload_blob(file_data, overwrite=True, content_settings=ContentSettings(content_type="application/octet-stream"))
-
-        # Store details in PostgreSQL
-        store_in_postgresql(filename, blob_name, sharepoint_url)
-
-        logging.info(f"Uploaded: {blob_name}")
-    except requests.exceptions.RequestException as e:
-        logging.info(f"Request error for {file_url}: {e}")
-    except Exception as e:
-        logging.info(f"Error processing {file_url}: {e}")
-
-
-def store_in_postgresql(filename, blob_name, sharepoint_url):
-    """Store file information in PostgreSQL table (insert or update)."""
-    try:
-        # Connect to PostgreSQL
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            dbname=DB_NAME
-        )
-        cursor = conn.cursor()
-
-        # Insert into source_url table or update if the filename already exists
-        cursor.execute("""
-            INSERT INTO source_url (filename, blobname, sharepoint_url)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (filename)
-            DO UPDATE SET blobname = EXCLUDED.blobname, sharepoint_url = EXCLUDED.sharepoint_url;
-        """, (filename, blob_name, sharepoint_url))
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-        logging.info(f"Stored or updated file info: {filename}, {blob_name}, {sharepoint_url}")
-    except Exception as e:
-        logging.error(f"Error storing data in PostgreSQL: {e}")
-
-
-def fetch_drive_content(drive_id, folder_path="", site_name=""):
-    """Fetch content of a SharePoint drive recursively."""
-    headers = {"Authorization": f"Bearer {get_valid_access_token()}"}
-    url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root/children" if folder_path == "" else \
-          f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:/{folder_path}:/children"
-
-    try:
-        response = session.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logging.info(f"Failed to fetch content for drive {drive_id}: {e}")
-        return
-
-    items = response.json().get("value", [])
-    threads = []
-
-    for item in items:
-        if "folder" in item:
-            fetch_drive_content(drive_id, f"{folder_path}/{item['name']}".strip("/"), site_name)
-        else:
-            if not is_excluded_file(item["name"], folder_path):
-                blob_name = f"{site_name}/{folder_path}/{item['name']}".replace("\\", "/")
-                sharepoint_url = item["@microsoft.graph.downloadUrl"]
-                shareable_link = file_weblink(drive_id, item['id'])
-                logging.info(str(blob_name))
-                thread = threading.Thread(target=upload_to_blob_storage, args=(sharepoint_url, blob_name, item["name"], shareable_link))
-                thread.start()
-                threads.append(thread)
-
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
-
-
-def extract_sharepoint():
-    """Extract SharePoint files and upload to Azure Blob Storage."""
-    logging.info("Started Fetching")
-    refresh_access_token()
-    for site_name, site_id in site_ids.items():
-        try:
-            drive_ids = fetch_all_drives(site_id, get_valid_access_token())
-            for drive_id in drive_ids:
-                fetch_drive_content(drive_id, site_name=site_name)
-        except Exception as e:
-            logging.info(f"Error processing site {site_name}: {e}")
-    logging.info("Process Done")
-    return "Files uploaded to Azure Blob Storage"
-
-
-def file_weblink(DRIVE_ID, ITEM_ID):
-    # API endpoint to create a sharing link
-    urll = f"https://graph.microsoft.com/v1.0/drives/{DRIVE_ID}/items/{ITEM_ID}/createLink"
-
-    header = {"Authorization": f"Bearer {get_valid_access_token()}", "Content-Type": "application/json"}
-
-
-    data = {
-        "type": "view",  # "edit" for edit permissions
-        "scope": "organization"  # "organization" for internal users only
-    }
-
-    respons = requests.post(urll, headers=header, json=data)
-
-    if respons.status_code == 200:
-        link = respons.json().get("link").get("webUrl")
-        # logging.info(f"Shareable link: {link}")
-    else:
-        logging.info(f"Error: {respons.json()}")
-    return link
\ No newline at end of file
+import azure.functions as func
+import os
+import logging
+import requests
+import uuid
+import time
+from azure.storage.blob import BlobServiceClient, ContentSettings
+import json
+import hashlib
+import threading
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import unquote
+from azure.core.exceptions import ResourceNotFoundError
+from graph_client import graph_get, graph_post, graph_batch, iter_pages, iter_collection, collection_params, \
+    DeltaQuery, DeltaResyncRequired, get_latest_delta_link, rate_limited, BATCH_LIMIT, PAGE_SIZE
+from blob_transfer import stage_download, commit_blocks
+from drive_crawler import DriveCrawler, CrawlProgress
+from crawl_store import CrawlStore, ContentIndex
+from crawl_jobs import CrawlJob, CrawlJobRunning, get_job_status, TIME_BUDGET_SECONDS
+from crawl_shards import ensure_shard_schema, new_run_id, make_shard, record_shards, start_shard, complete_shard, \
+    fail_shard, get_run_status, RESULT_COUNTERS
+from site_registry import load_sites, crawl_sites, get_site
+from text_extract import get_file_type, extract_pages, build_sidecar, dump_sidecar, get_sidecar_name
+from work_queue import get_work_queue, drain, LocalQueue, QUEUE_NAME
+
+app = func.FunctionApp()
+
+# Azure Blob Storage Configuration
+AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+CONTAINER_NAME = os.getenv('BLOB_CONTAINER_NAME')
+
+# Only the drive item fields the crawler uses
+DRIVE_ITEM_FIELDS = ["id", "name", "file", "folder", "size", "lastModifiedDateTime", "@microsoft.graph.downloadUrl"]
+DRIVE_DELTA_FIELDS = DRIVE_ITEM_FIELDS + ["parentReference", "deleted", "root"]
+
+# Files are copied for text extraction while they stream to Blob Storage, in memory up to this size
+SIDECAR_SPOOL_SIZE = 16 * 1024 * 1024
+
+SHARING_LINK_REQUEST = {
+    "type": "view",  # "edit" for edit permissions
+    "scope": "organization"  # "organization" for internal users only
+}
+
+blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
+
+# Content hashes of what is already stored, reloaded at the start of every crawl
+content_index = ContentIndex()
+
+# PostgreSQL side of the current run, one connection for the whole crawl
+crawl_store = None
+
+# Checkpointed state of the crawl job the current run works on
+crawl_job = None
+
+# Sharing links by drive item id, so each item only gets one link created
+sharing_links = {}
+
+# Counters of the current (or last) crawl by site name, served by sharepointPluginProgress
+site_progress = {}
+
+# Shards worked on at once in this process share the store, content index and link cache
+shard_context_lock = threading.Lock()
+shard_context_users = 0
+
+@app.route(route="sharepointPlugin")
+def sharepointPlugin(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Connecting to Sharepoint...')
+    # ?full=true ignores the stored delta links and re-crawls every drive
+    full_crawl = req.params.get('full', '').lower() == 'true'
+    try:
+        result = extract_sharepoint(full_crawl)
+        if result["status"] == "paused":
+            # The time budget ran out; triggering the function again resumes the job
+            return func.HttpResponse(f"Crawl job {result['job_id']} paused, trigger again to resume. "
+                                     f"source_url rows: {json.dumps(result['source_url'])}", status_code=202)
+        return func.HttpResponse(f"Files uploaded to Azure Blob Storage. source_url rows: {json.dumps(result['source_url'])}",
+                                 status_code=200)
+    except CrawlJobRunning as e:
+        return func.HttpResponse(str(e), status_code=409)
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return func.HttpResponse(str(e), status_code=500)
+
+
+@app.route(route="sharepointPluginProgress")
+def sharepointPluginProgress(req: func.HttpRequest) -> func.HttpResponse:
+    snapshots = {site_name: progress.snapshot() for site_name, progress in site_progress.items()}
+    return func.HttpResponse(json.dumps(snapshots), status_code=200, mimetype="application/json")
+
+
+@app.route(route="sharepointPluginStatus")
+def sharepointPluginStatus(req: func.HttpRequest) -> func.HttpResponse:
+    # The latest drive crawl job, or the one given by ?job_id=
+    store = CrawlStore()
+    try:
+        status = get_job_status(store, "drives", req.params.get('job_id'))
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return func.HttpResponse(str(e), status_code=500)
+    finally:
+        store.close()
+    if status is None:
+        return func.HttpResponse("No crawl job found", status_code=404)
+    return func.HttpResponse(json.dumps(status), status_code=200, mimetype="application/json")
+
+
+@app.route(route="sharepointPluginFanOut")
+def sharepointPluginFanOut(req: func.HttpRequest) -> func.HttpResponse:
+    # Splits the crawl into shards on the work queue; ?full=true walks every drive again
+    full_crawl = req.params.get('full', '').lower() == 'true'
+    try:
+        result = fan_out_crawl(full_crawl)
+        return func.HttpResponse(json.dumps(result), status_code=200 if result.get("complete") else 202,
+                                 mimetype="application/json")
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return func.HttpResponse(str(e), status_code=500)
+
+
+@app.queue_trigger(arg_name="msg", queue_name=QUEUE_NAME, connection="AZURE_STORAGE_CONNECTION_STRING")
+def sharepointPluginShard(msg: func.QueueMessage) -> None:
+    # Failures are raised so the queue redelivers the shard, up to its poison threshold
+    process_shard(msg.get_json(), get_work_queue())
+
+
+@app.route(route="sharepointPluginFanOutStatus")
+def sharepointPluginFanOutStatus(req: func.HttpRequest) -> func.HttpResponse:
+    run_id = req.params.get('run_id')
+    if not run_id:
+        return func.HttpResponse("run_id is required", status_code=400)
+    store = CrawlStore()
+    try:
+        status = get_run_status(store, run_id)
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return func.HttpResponse(str(e), status_code=500)
+    finally:
+        store.close()
+    if status is None:
+        return func.HttpResponse("No crawl run found", status_code=404)
+    return func.HttpResponse(json.dumps(status), status_code=200, mimetype="application/json")
+
+
+def fetch_all_drives(site):
+    """Fetch the IDs of the drives of a SharePoint site the registry asks to crawl."""
+    drives = iter_collection(f"sites/{site.site_id}/drives", select=["id", "name"], top=None)
+    return [drive["id"] for drive in drives if site.includes_drive(drive)]
+
+
+def is_excluded_file(item, folder_path, site):
+    """Check a file's metadata against the site's filter policy, counting why it is skipped."""
+    reason = site.filter_policy.skip_reason(item, folder_path)
+    if reason:
+        site_progress[site.name].add_skip(reason)
+        return True
+    return False
+
+
+def get_content_hash(item):
+    """Content hash Graph reports for a drive item, or None if it has none."""
+    hashes = item.get("file", {}).get("hashes", {})
+    if hashes.get("sha256Hash"):
+        return f"sha256:{hashes['sha256Hash'].lower()}"
+    if hashes.get("quickXorHash"):
+        return f"quickxor:{hashes['quickXorHash']}"
+    return None
+
+
+def skip_stored_content(filename, blob_name, content_hash, sharepoint_url, item_id):
+    """Return True if the content is already stored, pointing a duplicate at the existing blob."""
+    if content_index.is_unchanged(filename, content_hash):
+        logging.info(f"Unchanged, skipping: {blob_name}")
+        crawl_store.mark_unchanged()
+        return True
+
+    existing_blob = content_index.find_duplicate(content_hash, blob_name)
+    if existing_blob:
+        sidecar_blobname = content_index.get_sidecar(existing_blob)
+        crawl_store.add_source(filename, existing_blob, sharepoint_url, item_id, content_hash, sidecar_blobname)
+        content_index.record(filename, existing_blob, content_hash, sidecar_blobname)
+        logging.info(f"Duplicate of {existing_blob}, skipping: {blob_name}")
+        return True
+    return False
+
+
+def write_sidecar(blob_name, filename, content_hash, source=None):
+    """Extract the text of a stored file into a sidecar blob next to it.
+
+    source is a file object holding the content, which is otherwise read back
+    from the blob. Returns the sidecar blob name, "" if no text could be
+    extracted (so the file is not tried again until its content changes), or
+    None for file types without an extractor.
+    """
+    file_type = get_file_type(filename)
+    if not file_type:
+        return None
+
+    spool = None
+    try:
+        if source is None:
+            source = spool = tempfile.SpooledTemporaryFile(SIDECAR_SPOOL_SIZE)
+            blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=blob_name).download_blob().readinto(spool)
+        source.seek(0)
+        sidecar = build_sidecar(extract_pages(source, file_type), content_hash)
+
+        sidecar_blobname = get_sidecar_name(blob_name)
+        blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=sidecar_blobname).upload_blob(
+            dump_sidecar(sidecar), overwrite=True, metadata={"content_hash": content_hash},
+            content_settings=ContentSettings(content_type="application/json"))
+        return sidecar_blobname
+    except Exception as e:
+        logging.info(f"Error extracting text of {blob_name}: {e}")
+        return ""
+    finally:
+        if spool:
+            spool.close()
+
+
+def backfill_sidecar(filename, content_hash):
+    """Write the missing text sidecar of an unchanged file from its stored blob."""
+    blob_name = content_index.missing_sidecar(filename)
+    if blob_name and get_file_type(filename):
+        sidecar_blobname = write_sidecar(blob_name, filename, content_hash)
+        crawl_store.set_sidecar(filename, sidecar_blobname)
+        content_index.record_sidecar(blob_name, sidecar_blobname)
+
+
+def upload_to_blob_storage(file_url, blob_name, filename, sharepoint_url, item_id=None, content_hash=None):
+    """Download file from SharePoint and upload to Azure Blob Storage and store in PostgreSQL."""
+    # Extractable files are copied on the way, so their text is extracted without downloading them again
+    spool = tempfile.SpooledTemporaryFile(SIDECAR_SPOOL_SIZE) if get_file_type(filename) else None
+    try:
+        # Stream the download into staged blocks. A transfer of known content can resume from
+        # the blocks an interrupted run left behind; without a Graph hash it is hashed on the way.
+        if content_hash:
+            transfer_key = hashlib.sha1(content_hash.encode()).hexdigest()[:12]
+            hasher = None
+        else:
+            transfer_key = uuid.uuid4().hex[:12]
+            hasher = hashlib.sha256()
+
+        # A blob that duplicates of other files point at keeps its content; the change gets a blob of its own
+        previous_blob = content_index.get_blobname(filename)
+        if content_index.is_shared(blob_name, filename):
+            blob_name = get_versioned_blob_name(blob_name, transfer_key)
+        blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=blob_name)
+
+        block_ids, transferred, copied = stage_download(blob_client, file_url, transfer_key, resume=hasher is None,
+                                                        hasher=hasher, copy_to=spool)
+
+        # Items without a Graph hash can only be compared once downloaded; their staged blocks are never committed
+        if hasher:
+            content_hash = f"sha256:{hasher.hexdigest()}"
+            if skip_stored_content(filename, blob_name, content_hash, sharepoint_url, item_id):
+                return transferred
+
+        # Commit the staged blocks as the blob content
+        commit_blocks(blob_client, block_ids, metadata={"content_hash": content_hash},
+                      content_settings=ContentSettings(content_type="application/octet-stream"))
+
+        # Changed content gets its text extracted once, here; a resumed transfer's from the committed blob
+        sidecar_blobname = write_sidecar(blob_name, filename, content_hash, spool if copied else None)
+
+        # Store details in PostgreSQL
+        crawl_store.add_source(filename, blob_name, sharepoint_url, item_id, content_hash, sidecar_blobname)
+        content_index.record(filename, blob_name, content_hash, sidecar_blobname)
+
+        # The content this file had before stays only while another source points at it
+        if previous_blob and previous_blob != blob_name:
+            orphaned = sorted(crawl_store.unreferenced_blobs([previous_blob], except_filename=filename))
+            content_index.forget([], orphaned)
+            delete_blobs(orphaned)
+
+        logging.info(f"Uploaded: {blob_name}")
+        return transferred
+    except requests.exceptions.RequestException as e:
+        logging.info(f"Request error for {file_url}: {e}")
+        raise
+    except Exception as e:
+        logging.info(f"Error processing {file_url}: {e}")
+        raise
+    finally:
+        if spool:
+            spool.close()
+
+
+def list_drive_folder(drive_id, folder_path, site):
+    """List the children of a drive folder as crawler entries."""
+    url = f"drives/{drive_id}/root/children" if folder_path == "" else \
+          f"drives/{drive_id}/root:/{folder_path}:/children"
+
+    for page in iter_pages(url, collection_params(DRIVE_ITEM_FIELDS, PAGE_SIZE)):
+        items = page.get("value", [])
+        create_sharing_links(drive_id, [item for item in items if "folder" not in item and needs_upload(item, folder_path, site)])
+
+        for item in items:
+            if "folder" in item:
+                yield "folder", f"{folder_path}/{item['name']}".strip("/")
+            else:
+                yield "file", (item, folder_path)
+
+
+def fetch_drive_content(drive_id, site, cursor_key):
+    """Fetch content of a SharePoint drive, walking its folders breadth-first.
+
+    The walk resumes from the folders the crawl job left pending. Returns
+    whether it finished within the job's time budget; a finished walk in
+    which any folder or file failed raises instead, so the drive is not
+    marked synced past them.
+    """
+    crawler = DriveCrawler(
+        lambda folder_path: list_drive_folder(drive_id, folder_path, site),
+        lambda task: process_drive_file(drive_id, task[0], task[1], site),
+        progress=site_progress[site.name],
+        checkpoint=crawl_job.checkpoint_for(cursor_key, lambda task: task[0]["id"]),
+        **site.crawler_options(),
+    )
+    crawler.crawl(crawl_job.pending_folders(cursor_key), deadline=crawl_job.deadline)
+    if crawler.pending_folders:
+        return False
+    crawler.raise_failures()
+    return True
+
+
+def needs_upload(item, folder_path, site):
+    """Whether a listed file is neither excluded nor unchanged since the last run."""
+    return not site.filter_policy.skip_reason(item, folder_path) and not content_index.is_unchanged(item["name"], get_content_hash(item))
+
+
+def create_sharing_links(drive_id, items):
+    """Create the missing sharing links of a set of drive items through $batch."""
+    missing = [item["id"] for item in items if item["id"] not in sharing_links]
+    if not missing:
+        return
+
+    responses = graph_batch([
+        {
+            "method": "POST",
+            "url": f"drives/{drive_id}/items/{item_id}/createLink",
+            "body": SHARING_LINK_REQUEST,
+            "headers": {"Content-Type": "application/json"},
+        }
+        for item_id in missing
+    ])
+    for item_id, response in zip(missing, responses):
+        if response and response.get("status") in (200, 201):
+            sharing_links[item_id] = response["body"]["link"]["webUrl"]
+        else:
+            logging.info(f"Error creating link for {item_id}: {response}")
+
+
+def process_drive_file(drive_id, item, folder_path, site):
+    """Upload a drive file unless it is excluded or already stored; returns the bytes transferred."""
+    if is_excluded_file(item, folder_path, site):
+        return 0
+
+    blob_name = get_blob_name(site.name, folder_path, item["name"])
+    content_hash = get_content_hash(item)
+    if content_index.is_unchanged(item["name"], content_hash):
+        logging.info(f"Unchanged, skipping: {blob_name}")
+        crawl_store.mark_unchanged()
+        # Files stored before sidecars existed get theirs once
+        backfill_sidecar(item["name"], content_hash)
+        return 0
+
+    shareable_link = file_weblink(drive_id, item['id'])
+    if content_hash and skip_stored_content(item["name"], blob_name, content_hash, shareable_link, item["id"]):
+        return 0
+
+    sharepoint_url = item.get("@microsoft.graph.downloadUrl") or get_download_url(drive_id, item["id"])
+    logging.info(str(blob_name))
+    return upload_to_blob_storage(sharepoint_url, blob_name, item["name"], shareable_link, item["id"], content_hash)
+
+
+def get_blob_name(site_name, folder_path, file_name):
+    """Blob path a drive file is stored under."""
+    return f"{site_name}/{folder_path}/{file_name}".replace("\\", "/")
+
+
+def get_versioned_blob_name(blob_name, version):
+    """Blob path for a version of a file whose own path still holds content other files point at."""
+    root, extension = os.path.splitext(blob_name)
+    return f"{root}.{version}{extension}"
+
+
+def get_download_url(drive_id, item_id):
+    """Fetch the pre-authenticated download URL of a drive item."""
+    response = graph_get(f"drives/{drive_id}/items/{item_id}", params={"$select": "id,@microsoft.graph.downloadUrl"})
+    response.raise_for_status()
+    return response.json()["@microsoft.graph.downloadUrl"]
+
+
+def get_folder_path(drive_id, item, folder_paths):
+    """Folder path of a drive item relative to the drive root, e.g. 'Safety/Forms'.
+
+    Delta items carry their parent's id but not its path, so the parent is
+    looked up in folder_paths (folder paths by id, filled as the delta is
+    read), or else fetched once and added to it.
+    """
+    parent = item.get("parentReference", {})
+    parent_path = parent.get("path")
+    if parent_path is not None:
+        return unquote(parent_path.split("root:", 1)[-1]).strip("/") if "root:" in parent_path else ""
+    if "id" not in parent:
+        return ""
+    if parent["id"] not in folder_paths:
+        response = graph_get(f"drives/{drive_id}/items/{parent['id']}", params={"$select": "id,name,root,parentReference"})
+        response.raise_for_status()
+        folder_paths[parent["id"]] = get_item_path(drive_id, response.json(), folder_paths)
+    return folder_paths[parent["id"]]
+
+
+def get_item_path(drive_id, item, folder_paths):
+    """Path of a drive item relative to the drive root, "" for the root itself."""
+    if "root" in item or "id" not in item.get("parentReference", {}):
+        return ""
+    return f"{get_folder_path(drive_id, item, folder_paths)}/{item['name']}".strip("/")
+
+
+def remove_deleted_item(item_id, keep_blobname=None):
+    """Delete the blobs and source_url rows of an item that was removed from SharePoint."""
+    filenames, blob_names = crawl_store.delete_source_by_item_id(item_id, keep_blobname)
+    content_index.forget(filenames, blob_names)
+    delete_blobs(blob_names)
+
+
+def delete_blobs(blob_names):
+    """Delete stored blobs along with their text sidecars."""
+    sidecar_names = [get_sidecar_name(blob_name) for blob_name in blob_names if get_file_type(blob_name)]
+    for blob_name in blob_names + sidecar_names:
+        try:
+            blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=blob_name).delete_blob()
+            logging.info(f"Deleted: {blob_name}")
+        except ResourceNotFoundError:
+            pass
+
+
+def list_drive_changes(drive_id, query, site):
+    """Apply deletions from a drive delta query and yield its changed files as crawler entries."""
+    changed = []
+    folder_paths = {}
+    for item in query:
+        if "deleted" in item:
+            remove_deleted_item(item["id"])
+        elif "folder" in item:
+            folder_paths[item["id"]] = get_item_path(drive_id, item, folder_paths)
+        elif "file" in item:
+            folder_path = get_folder_path(drive_id, item, folder_paths)
+            # A moved or renamed file keeps its id, so drop the blob stored under the old path
+            remove_deleted_item(item["id"], keep_blobname=get_blob_name(site.name, folder_path, item["name"]))
+            changed.append((item, folder_path))
+
+        # Hand files over a batch at a time so their sharing links share one round trip
+        if len(changed) >= BATCH_LIMIT:
+            yield from batch_changed_files(drive_id, changed, site)
+            changed = []
+    yield from batch_changed_files(drive_id, changed, site)
+
+
+def batch_changed_files(drive_id, changed, site):
+    """Create the sharing links of a batch of changed files, then hand them to the crawler."""
+    create_sharing_links(drive_id, [item for item, folder_path in changed if needs_upload(item, folder_path, site)])
+    for task in changed:
+        yield "file", task
+
+
+def process_drive_delta(drive_id, delta_link, site):
+    """Apply the changes of a drive since the last run and return the new delta link.
+
+    Raises if the query or any changed file failed, so the changes are applied again from the old link.
+    """
+    query = DeltaQuery(delta_link, select=DRIVE_DELTA_FIELDS)
+    crawler = DriveCrawler(
+        lambda _: list_drive_changes(drive_id, query, site),
+        lambda task: process_drive_file(drive_id, task[0], task[1], site),
+        progress=site_progress[site.name],
+        **site.crawler_options(),
+    )
+    crawler.crawl([delta_link])
+    crawler.raise_failures()
+    if query.delta_link is None:
+        raise Exception(f"Delta query for drive {drive_id} did not complete")
+    return query.delta_link
+
+
+def sync_drive(drive_id, site, full_crawl=False):
+    """Crawl a drive incrementally from its stored delta link, or in full on the first run."""
+    cursor_key = f"drive:{drive_id}"
+    resource = crawl_job.get_resource(cursor_key)
+    if resource and resource[1]:
+        # Already synced by an earlier run of this job
+        return
+    if resource and resource[0]:
+        # A full walk an earlier run of this job did not finish
+        walk_drive(drive_id, site, cursor_key, resource[0])
+        return
+
+    delta_link = None if full_crawl else crawl_store.get_delta_link(cursor_key)
+    if delta_link:
+        try:
+            crawl_store.save_delta_link(cursor_key, process_drive_delta(drive_id, delta_link, site))
+            crawl_job.finish_resource(cursor_key)
+            return
+        except DeltaResyncRequired as e:
+            logging.info(f"{e}, falling back to a full crawl")
+            crawl_store.clear_delta_link(cursor_key)
+
+    # Take the cursor before walking so changes made during the walk are picked up next run
+    latest_delta_link = get_latest_delta_link(f"drives/{drive_id}/root/delta", select=DRIVE_DELTA_FIELDS)
+    crawl_job.start_resource(cursor_key, latest_delta_link, root_folder="")
+    walk_drive(drive_id, site, cursor_key, latest_delta_link)
+
+
+def walk_drive(drive_id, site, cursor_key, latest_delta_link):
+    """Walk a drive in full; once the walk is complete, resume it from latest_delta_link next run."""
+    if fetch_drive_content(drive_id, site, cursor_key):
+        crawl_store.save_delta_link(cursor_key, latest_delta_link)
+        crawl_job.finish_resource(cursor_key)
+
+
+def crawl_site(site, full_crawl=False):
+    """Sync every drive of a site, within the site's request budget.
+
+    A drive that fails does not stop the others; the first error is raised once they are done.
+    """
+    errors = []
+    with rate_limited(site.rate_limiter):
+        for drive_id in fetch_all_drives(site):
+            if crawl_job.out_of_time():
+                break
+            try:
+                sync_drive(drive_id, site, full_crawl)
+            except Exception as e:
+                logging.info(f"Error syncing drive {drive_id} of site {site.name}: {e}")
+                errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def extract_sharepoint(full_crawl=False):
+    """Extract SharePoint files and upload to Azure Blob Storage.
+
+    Runs (or resumes) a checkpointed crawl job; returns its id and status,
+    "paused" when the time budget ran out, with the source_url summary.
+    """
+    global content_index, site_progress, sharing_links, crawl_store, crawl_job
+    logging.info("Started Fetching")
+    # Sites registered with an empty drive list only have their pages scraped
+    sites = [site for site in load_sites() if site.drives != set()]
+    crawl_store = CrawlStore()
+    try:
+        crawl_store.ensure_schema()
+        crawl_job = CrawlJob.open(crawl_store, "drives", full_crawl)
+        content_index = crawl_store.load_content_index()
+        sharing_links = crawl_store.load_sharing_links()
+        site_progress = {site.name: CrawlProgress() for site in sites}
+        crawl_job.progress_source = lambda: {site_name: progress.snapshot() for site_name, progress in site_progress.items()}
+        failed_sites = crawl_sites(sites, lambda site: crawl_site(site, crawl_job.full_crawl))
+        crawl_store.flush()
+        status = crawl_job.finish({"source_url": crawl_store.summary(), "failed_sites": list(failed_sites)})
+    finally:
+        summary = crawl_store.close()
+    snapshots = {site_name: progress.snapshot() for site_name, progress in site_progress.items()}
+    logging.info(f"Process Done ({status}): {snapshots}, source_url: {summary}, failed sites: {list(failed_sites)}")
+    return {"job_id": crawl_job.job_id, "status": status, "source_url": summary}
+
+
+@contextmanager
+def shard_context():
+    """Open the crawl store and caches for the first shard of this process, close them after the last."""
+    global crawl_store, content_index, sharing_links, shard_context_users
+    with shard_context_lock:
+        if shard_context_users == 0:
+            crawl_store = CrawlStore()
+            crawl_store.ensure_schema()
+            ensure_shard_schema(crawl_store)
+            content_index = crawl_store.load_content_index()
+            sharing_links = crawl_store.load_sharing_links()
+        shard_context_users += 1
+    try:
+        yield crawl_store
+    finally:
+        with shard_context_lock:
+            shard_context_users -= 1
+            if shard_context_users == 0:
+                crawl_store.close()
+
+
+def plan_drive_shards(run_id, site, drive_id, full_crawl=False):
+    """Split the crawl of a drive into shards.
+
+    A drive with a stored delta link is one delta shard. Otherwise every
+    top-level folder is a walk shard, plus one for the files at the root.
+    """
+    if not full_crawl and crawl_store.get_delta_link(f"drive:{drive_id}"):
+        return [make_shard(run_id, site.name, drive_id, "delta")]
+
+    # Taken before the walk, and stored once all walk shards are done
+    latest_delta_link = get_latest_delta_link(f"drives/{drive_id}/root/delta", select=DRIVE_DELTA_FIELDS)
+    shards = [make_shard(run_id, site.name, drive_id, "walk", files_only=True, delta_link=latest_delta_link)]
+    for item in iter_collection(f"drives/{drive_id}/root/children", select=["name", "folder"]):
+        if "folder" in item:
+            shards.append(make_shard(run_id, site.name, drive_id, "walk", folder=item["name"], delta_link=latest_delta_link))
+    return shards
+
+
+def send_shards(work_queue, shards):
+    record_shards(crawl_store, shards)
+    for shard in shards:
+        work_queue.send(shard)
+
+
+def fan_out_crawl(full_crawl=False):
+    """Coordinate a sharded crawl: plan the shards of every registered drive and queue them.
+
+    With a local queue the shards are also drained here, on worker threads,
+    and the aggregated result is returned; otherwise the queue-triggered
+    workers pick them up and sharepointPluginFanOutStatus reports on the run.
+    """
+    run_id = new_run_id()
+    work_queue = get_work_queue()
+    sites = [site for site in load_sites() if site.drives != set()]
+
+    with shard_context() as store:
+        def plan_site(site):
+            site = get_site(site.name)
+            with rate_limited(site.rate_limiter):
+                for drive_id in fetch_all_drives(site):
+                    send_shards(work_queue, plan_drive_shards(run_id, site, drive_id, full_crawl))
+
+        failed_sites = crawl_sites(sites, plan_site)
+        if isinstance(work_queue, LocalQueue):
+            drain(work_queue, lambda shard: process_shard(shard, work_queue))
+        status = get_run_status(store, run_id) or {"run_id": run_id, "shards": 0, "complete": True}
+    status["failed_sites"] = list(failed_sites)
+    logging.info(f"Fan-out crawl {run_id}: {status}")
+    return status
+
+
+def process_shard(shard, work_queue):
+    """Work one shard of a fanned-out crawl.
+
+    A walk shard hands the folders it did not get to in time, and those
+    that failed to list or had files fail, back to the queue as new shards.
+    A shard failing in its own folder is marked failed and raised, so the
+    queue delivers it again. The worker
+    completing the last shard of a drive stores the drive's new delta link,
+    which a failed shard holds back until it is done.
+    """
+    with shard_context() as store:
+        if not start_shard(store, shard):
+            logging.info(f"Shard {shard['shard_id']} already done, skipping")
+            return
+
+        site = get_site(shard["site"])
+        drive_id = shard["drive_id"]
+        progress = site_progress.setdefault(site.name, CrawlProgress())
+        try:
+            with rate_limited(site.rate_limiter):
+                if shard["mode"] == "delta":
+                    result = process_delta_shard(shard, site, work_queue)
+                else:
+                    result = process_walk_shard(shard, site, work_queue)
+            store.flush()
+            if complete_shard(store, shard, result) and shard["delta_link"]:
+                store.save_delta_link(f"drive:{drive_id}", shard["delta_link"])
+            logging.info(f"Shard {shard['shard_id']} of drive {drive_id} done: {result}, site progress: {progress.snapshot()}")
+        except Exception as e:
+            fail_shard(store, shard, e)
+            raise
+
+
+def process_delta_shard(shard, site, work_queue):
+    """Apply a drive's changes since its stored delta link, or replan it as walk shards if the link expired.
+
+    A change that fails raises before the new delta link is stored, failing the shard.
+    """
+    drive_id = shard["drive_id"]
+    cursor_key = f"drive:{drive_id}"
+    try:
+        crawl_store.save_delta_link(cursor_key, process_drive_delta(drive_id, crawl_store.get_delta_link(cursor_key), site))
+        return {}
+    except DeltaResyncRequired as e:
+        logging.info(f"{e}, replanning drive {drive_id} as walk shards")
+        crawl_store.clear_delta_link(cursor_key)
+        send_shards(work_queue, plan_drive_shards(shard["run_id"], site, drive_id, full_crawl=True))
+        return {}
+
+
+def process_walk_shard(shard, site, work_queue):
+    """Walk a shard's folder within the time budget, queueing the folders left over as new shards.
+
+    A folder that failed to list is queued to be walked again, and a folder
+    with failed files to have its files handled again. Raises, once those
+    are queued, if that retry would repeat this shard.
+    """
+    drive_id = shard["drive_id"]
+    root = shard["folder"]
+
+    def list_folder(folder_path):
+        entries = list_drive_folder(drive_id, folder_path, site)
+        if shard["files_only"] and folder_path == root:
+            # The root shard leaves the top-level folders to their own shards
+            return (entry for entry in entries if entry[0] == "file")
+        return entries
+
+    progress = CrawlProgress()
+    crawler = DriveCrawler(
+        list_folder,
+        lambda task: process_drive_file(drive_id, task[0], task[1], site),
+        progress=progress,
+        **site.crawler_options(),
+    )
+    crawler.crawl([root], deadline=time.time() + TIME_BUDGET_SECONDS)
+    result = progress.snapshot()
+    site_progress[site.name].add(**{counter: result[counter] for counter in RESULT_COUNTERS})
+
+    # (folder, files_only) of the walks still to do
+    failed_folders = {folder for folder, _ in crawler.failed_folders}
+    retried = {(folder, shard["files_only"] and folder == root) for folder in failed_folders}
+    retried |= {(task[1], True) for task, _ in crawler.failed_files if task[1] not in failed_folders}
+    this_shard = (root, shard["files_only"])
+    leftover = [(folder, False) for folder in crawler.pending_folders] + sorted(retried - {this_shard})
+    if leftover:
+        logging.info(f"Shard {shard['shard_id']}: queueing {len(crawler.pending_folders)} folders left over "
+                     f"and {len(leftover) - len(crawler.pending_folders)} failed ones as new shards")
+        send_shards(work_queue, [make_shard(shard["run_id"], site.name, drive_id, "walk", folder=folder,
+                                            files_only=files_only, delta_link=shard["delta_link"])
+                                 for folder, files_only in leftover])
+    if this_shard in retried:
+        crawler.raise_failures()
+    return result
+
+
+def file_weblink(DRIVE_ID, ITEM_ID):
+    if ITEM_ID in sharing_links:
+        return sharing_links[ITEM_ID]
+
+    # API endpoint to create a sharing link
+    urll = f"drives/{DRIVE_ID}/items/{ITEM_ID}/createLink"
+
+    link = None
+    respons = graph_post(urll, json=SHARING_LINK_REQUEST)
+
+    if respons.status_code in (200, 201):
+        link = respons.json().get("link").get("webUrl")
+        sharing_links[ITEM_ID] = link
+        # logging.info(f"Shareable link: {link}")
+    else:
+        logging.info(f"Error: {respons.json()}")
+    return link
@@ -1,217 +1,320 @@
-import azure.functions as func
-import logging
-import requests
-import json
-from msal import ConfidentialClientApplication
-from json_repair import repair_json
-from azure.storage.blob import BlobServiceClient
-from bs4 import BeautifulSoup
-import os
-import psycopg2
-
-app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
-
-# Microsoft Graph API Details
-CLIENT_ID = os.getenv('AD_CLIENT_id')
-CLIENT_SECRET = os.getenv('AD_CLIENT_SECRET')
-TENANT_ID = os.getenv('TENANT_ID')
-
-# PostgreSQL Configuration
-DB_HOST = os.getenv('COSMOPG_HOST')
-DB_PORT = 5432  # Default port for PostgreSQL
-DB_USER = os.getenv('COSMOPG_USER')
-DB_PASSWORD = os.getenv('COSMOPG_PASSWORD')
-DB_NAME = os.getenv('COSMOPG_DBNAME')
-
-# Azure Blob Storage Configuration
-AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-CONTAINER_NAME = os.getenv('BLOB_CONTAINER_NAME')
-FOLDER = "scraped_pages"
-
-AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
-SCOPE = ["https://graph.microsoft.com/.default"]
-SITE_ID = "askbrinkmann.sharepoint.com,9016808e-d23f-4386-9ef9-e0d5d635bb79,a4630e11-fe5d-4114-940f-d5196ee016b1"
-LIST_TITLE = "Site Pages"
-GRAPH_API_URL = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/lists/{LIST_TITLE}/items"
-
-blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-
-EXCLUDE_URLS = [
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Documents.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/search.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Welcome2.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Templates",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Templates/News.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Templates/Orion-News.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Pre-Con.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Prepare-for-2023-Annual-Performance-Reviews.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Moving-On-Up--Brinkmann-Reaches--80-on-ENR-s-Top-400-General-Contractor-List.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Brinkmann-Labor-Rates.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Lifelong-Learning-in-Action--Cold-Storage-Industrial-Business-Unit-Tour-Evapco-World-Headquarters.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Missouri-University-of-Science-and-Technology-Amusement-Park-Design-Camp-Visits-Oasis-at-Lakeport-Project.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Now-Available--Brinkmann-s-Digital-Project-List.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Header-Test.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Occupational%20Safety%20and%20Health%20Administration%20(OSHA)%20Inspections.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Brinkmann%20Brag.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Brinkmann%20Bravo.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Jobsite%20Utility%20Setup.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Congratulations--Aubrey-Wyrick-.aspx",
-      "https://askbrinkmann.sharepoint.com/sites/Operations/SitePages/Now-Live--Project-Lifecycle.aspx"
-  ]
-
-
-@app.route(route="Sharpoint_Scrape_Sites")
-def Sharpoint_Scrape_Sites(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Connecting to Sharepoint...')
-    try:
-        result = process_sharepoint_pages()
-        return func.HttpResponse("Sites Scraped and Saved to Blob Storage.", status_code=200)
-    except Exception as e:
-        logging.error(f"Error: {e}")
-        return func.HttpResponse(str(e), status_code=500)
-    
-
-def get_access_token():
-    """Get an access token for Microsoft Graph API"""
-    app = ConfidentialClientApplication(CLIENT_ID, CLIENT_SECRET, authority=AUTHORITY)
-    token_response = app.acquire_token_for_client(scopes=SCOPE)
-
-    if "access_token" in token_response:
-        return token_response["access_token"]
-    else:
-        raise Exception(f"Error fetching token: {token_response.get('error_description')}")
-
-
-def fetch_sharepoint_page(etag_id):
-    """Fetch SharePoint Page content"""
-    token = get_access_token()
-    url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/pages/{etag_id}/microsoft.graph.sitePage?$expand=canvasLayout"
-    headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        cleaned_text = repair_json(response.text)
-        try:
-            return json.loads(cleaned_text)
-        except json.JSONDecodeError as e:
-            logging.error(f"JSON decode error: {e}")
-            return None
-    else:
-        logging.error(f"Error {response.status_code}: {response.text}")
-        return None
-
-
-def save_content_locally(directory, file_name, content):
-    """Save formatted content to a local file."""
-    os.makedirs(directory, exist_ok=True)
-    file_path = os.path.join(directory, file_name)
-
-    try:
-        with open(file_path, "w", encoding="utf-8") as file:
-            file.write(content)
-        logging.info("Content successfully saved locally as %s.", file_path)
-    except Exception as e:
-        logging.error("Failed to save content locally: %s", e)
-
-def store_in_postgresql(filename, blob_name, sharepoint_url):
-    """Store file information in PostgreSQL table (insert or update)."""
-    try:
-        # Connect to PostgreSQL
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            dbname=DB_NAME
-        )
-        cursor = conn.cursor()
-
-        # Insert into source_url table or update if the filename already exists
-        cursor.execute("""
-            INSERT INTO source_url (filename, blobname, sharepoint_url)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (filename)
-            DO UPDATE SET blobname = EXCLUDED.blobname, sharepoint_url = EXCLUDED.sharepoint_url;
-        """, (filename, blob_name, sharepoint_url))
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-        logging.info(f"Stored or updated file info: {filename}, {blob_name}, {sharepoint_url}")
-    except Exception as e:
-        logging.error(f"Error storing data in PostgreSQL: {e}")
-
-
-def save_to_blob(directory, file_name, content, sharepoint_url):
-    """Save content to Azure Blob Storage."""
-    try:
-        file_path = os.path.join(directory, file_name)
-        blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=file_path)
-        blob_client.upload_blob(content, overwrite=True)
-        store_in_postgresql(file_name, file_path, sharepoint_url)
-
-        logging.info("File successfully saved to Blob Storage: %s", file_name)
-    except Exception as e:
-        logging.error("Failed to save content to Blob: %s", e)
-
-
-def format_html_content(html_content):
-    """Format HTML content for readability."""
-    soup = BeautifulSoup(html_content, "html.parser")
-    formatted_content = []
-
-    for element in soup.descendants:
-        if element.name == "a":
-            formatted_content.append(f"[{element.get_text(strip=True)}]({element.get('href', '')})")
-        elif element.name == "table":
-            for row in element.find_all("tr"):
-                cells = [cell.get_text(strip=True) for cell in row.find_all(["td", "th"])]
-                formatted_content.append(" | ".join(cells))
-        elif element.name in ["p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol"]:
-            formatted_content.append(element.get_text(strip=True))
-
-    return "\n".join(formatted_content)
-
-
-def process_sharepoint_pages():
-    """Fetch and process pages from SharePoint."""
-    token = get_access_token()
-    headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
-    response = requests.get(GRAPH_API_URL, headers=headers)
-
-    if response.status_code != 200:
-        logging.error(f"Error {response.status_code}: {response.text}")
-        return
-
-    for item in response.json().get('value', []):
-        web_url = item.get('webUrl')
-
-        # Skip URLs that are in the exclude list
-        if web_url in EXCLUDE_URLS:
-            logging.info(f"Skipping excluded URL: {web_url}")
-            continue
-
-        etag = item.get('eTag', '').strip('"').split(',')[0]
-        logging.info(f"Fetching Page ID: {etag} - URL: {web_url}")
-
-        page_response = fetch_sharepoint_page(etag)
-        if page_response:
-            horizontal_sections = page_response.get("canvasLayout", {}).get("horizontalSections", [])
-            all_formatted_content = []
-
-            for section in horizontal_sections:
-                for column in section.get("columns", []):
-                    for webpart in column.get("webparts", []):
-                        formatted_content = format_html_content(webpart.get("innerHtml", ""))
-                        all_formatted_content.append(formatted_content)
-                        contacts = webpart.get("data", {}).get("properties", {}).get("persons", [])
-                        if contacts:
-                            all_formatted_content.append(str(contacts))
-
-            combined_content = "\n".join(all_formatted_content)
-            file_name = f"{web_url.split('/')[-1].replace('%20', '').replace('%26', '').replace('.aspx', '.txt')}"
-
-            # save_content_locally(FOLDER, file_name, combined_content)
-            save_to_blob(FOLDER, file_name, combined_content, web_url)
-        else:
-            logging.error(f"Failed to fetch page: {web_url}")
\ No newline at end of file
+import azure.functions as func
+import logging
+import json
+from json_repair import repair_json
+from azure.storage.blob import BlobServiceClient
+import os
+import hashlib
+import threading
+from azure.core.exceptions import ResourceNotFoundError
+from graph_client import graph_get, graph_batch, DeltaQuery, DeltaResyncRequired, rate_limited, BATCH_LIMIT
+from crawl_store import CrawlStore, ContentIndex
+from crawl_jobs import CrawlJob, CrawlJobRunning, get_job_status
+from html_text import html_to_text
+from site_registry import load_sites, crawl_sites
+
+app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+
+# Azure Blob Storage Configuration
+AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+CONTAINER_NAME = os.getenv('BLOB_CONTAINER_NAME')
+
+# Only the list item fields the scraper uses
+PAGE_ITEM_FIELDS = ["id", "webUrl", "eTag"]
+
+blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
+
+# Content hashes of the pages already stored, reloaded at the start of every run
+content_index = ContentIndex()
+
+# PostgreSQL side of the current run, one connection for the whole run
+crawl_store = None
+
+# Checkpointed state of the crawl job the current run works on
+crawl_job = None
+
+# Pages left out by the filter policy in the current run, by reason
+skipped_pages = {}
+skipped_pages_lock = threading.Lock()
+
+
+@app.route(route="Sharpoint_Scrape_Sites")
+def Sharpoint_Scrape_Sites(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Connecting to Sharepoint...')
+    # ?full=true ignores the stored delta link and re-scrapes every page
+    full_crawl = req.params.get('full', '').lower() == 'true'
+    try:
+        result = process_sharepoint_pages(full_crawl)
+        if result["status"] == "paused":
+            # The time budget ran out; triggering the function again resumes the job
+            return func.HttpResponse(f"Crawl job {result['job_id']} paused, trigger again to resume. "
+                                     f"source_url rows: {json.dumps(result['source_url'])}", status_code=202)
+        return func.HttpResponse(f"Sites Scraped and Saved to Blob Storage. source_url rows: {json.dumps(result['source_url'])}", status_code=200)
+    except CrawlJobRunning as e:
+        return func.HttpResponse(str(e), status_code=409)
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return func.HttpResponse(str(e), status_code=500)
+
+
+@app.route(route="Sharpoint_Scrape_Sites_Status")
+def Sharpoint_Scrape_Sites_Status(req: func.HttpRequest) -> func.HttpResponse:
+    # The latest page crawl job, or the one given by ?job_id=
+    store = CrawlStore()
+    try:
+        status = get_job_status(store, "pages", req.params.get('job_id'))
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return func.HttpResponse(str(e), status_code=500)
+    finally:
+        store.close()
+    if status is None:
+        return func.HttpResponse("No crawl job found", status_code=404)
+    return func.HttpResponse(json.dumps(status), status_code=200, mimetype="application/json")
+
+
+def get_page_url(site, etag_id):
+    return f"sites/{site.site_id}/pages/{etag_id}/microsoft.graph.sitePage?$expand=canvasLayout"
+
+
+def get_page_id(item):
+    return item.get('eTag', '').strip('"').split(',')[0]
+
+
+def fetch_sharepoint_page(site, etag_id):
+    """Fetch SharePoint Page content"""
+    response = graph_get(get_page_url(site, etag_id))
+
+    if response.status_code == 200:
+        cleaned_text = repair_json(response.text)
+        try:
+            return json.loads(cleaned_text)
+        except json.JSONDecodeError as e:
+            logging.error(f"JSON decode error: {e}")
+            return None
+    else:
+        logging.error(f"Error {response.status_code}: {response.text}")
+        return None
+
+
+def save_content_locally(directory, file_name, content):
+    """Save formatted content to a local file."""
+    os.makedirs(directory, exist_ok=True)
+    file_path = os.path.join(directory, file_name)
+
+    try:
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        logging.info("Content successfully saved locally as %s.", file_path)
+    except Exception as e:
+        logging.error("Failed to save content locally: %s", e)
+
+def save_to_blob(directory, file_name, content, sharepoint_url, item_id=None):
+    """Save content to Azure Blob Storage."""
+    try:
+        file_path = os.path.join(directory, file_name)
+        content_hash = f"sha256:{hashlib.sha256(content.encode('utf-8')).hexdigest()}"
+        if content_index.is_unchanged(file_name, content_hash):
+            logging.info("Unchanged, skipping: %s", file_name)
+            crawl_store.mark_unchanged()
+            return
+
+        blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=file_path)
+        blob_client.upload_blob(content, overwrite=True, metadata={"content_hash": content_hash})
+        crawl_store.add_source(file_name, file_path, sharepoint_url, item_id, content_hash)
+        content_index.record(file_name, file_path, content_hash)
+
+        logging.info("File successfully saved to Blob Storage: %s", file_name)
+    except Exception as e:
+        logging.error("Failed to save content to Blob: %s", e)
+        raise
+
+
+def format_html_content(html_content):
+    """Format HTML content for readability."""
+    return html_to_text(html_content)
+
+
+def remove_deleted_item(item_id, keep_blobname=None):
+    """Delete the blobs and source_url rows of a page that was removed from SharePoint."""
+    filenames, blob_names = crawl_store.delete_source_by_item_id(item_id, keep_blobname)
+    content_index.forget(filenames, blob_names)
+    for blob_name in blob_names:
+        try:
+            blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=blob_name).delete_blob()
+            logging.info("Deleted from Blob Storage: %s", blob_name)
+        except ResourceNotFoundError:
+            pass
+
+
+def is_excluded_page(site, item):
+    """Check a page's URL against the filter policy of its site, counting why it is skipped."""
+    web_url = item.get('webUrl')
+    reason = site.filter_policy.url_skip_reason(web_url)
+    if reason:
+        logging.info(f"Skipping excluded URL: {web_url}")
+        with skipped_pages_lock:
+            skipped_pages[reason] = skipped_pages.get(reason, 0) + 1
+        return True
+    return False
+
+
+def fetch_sharepoint_pages(site, items):
+    """Fetch several SharePoint Pages through $batch, in the order of items."""
+    try:
+        responses = graph_batch([{"method": "GET", "url": get_page_url(site, get_page_id(item))} for item in items])
+    except ValueError as e:
+        # An unparsable batch response falls back to single requests, which can repair the JSON
+        logging.error(f"Batch JSON decode error: {e}")
+        responses = [None] * len(items)
+
+    pages = []
+    for item, response in zip(items, responses):
+        if response and response.get("status") == 200 and isinstance(response.get("body"), dict):
+            pages.append(response["body"])
+        elif response and response.get("status") != 200:
+            logging.error(f"Error {response.get('status')}: {response.get('body')}")
+            pages.append(None)
+        else:
+            pages.append(fetch_sharepoint_page(site, get_page_id(item)))
+    return pages
+
+
+def process_page_batch(site, items):
+    """Fetch a batch of Site Pages and save their formatted content; returns the number of pages that failed."""
+    if not items:
+        return 0
+    failed = 0
+    for item, page_response in zip(items, fetch_sharepoint_pages(site, items)):
+        try:
+            save_page(site, item, page_response)
+        except Exception as e:
+            logging.error(f"Failed to save page {item.get('webUrl')}: {e}")
+            failed += 1
+    return failed
+
+
+def save_page(site, item, page_response):
+    """Format a fetched Site Page and save it to Blob Storage."""
+    web_url = item.get('webUrl')
+    logging.info(f"Fetched Page ID: {get_page_id(item)} - URL: {web_url}")
+
+    if page_response:
+        horizontal_sections = page_response.get("canvasLayout", {}).get("horizontalSections", [])
+        all_formatted_content = []
+
+        for section in horizontal_sections:
+            for column in section.get("columns", []):
+                for webpart in column.get("webparts", []):
+                    formatted_content = format_html_content(webpart.get("innerHtml", ""))
+                    all_formatted_content.append(formatted_content)
+                    contacts = webpart.get("data", {}).get("properties", {}).get("persons", [])
+                    if contacts:
+                        all_formatted_content.append(str(contacts))
+
+        combined_content = "\n".join(all_formatted_content)
+        file_name = f"{web_url.split('/')[-1].replace('%20', '').replace('%26', '').replace('.aspx', '.txt')}"
+
+        # A renamed page keeps its id, so drop the blob stored under the old name
+        remove_deleted_item(item['id'], keep_blobname=os.path.join(site.pages_folder, file_name))
+        # save_content_locally(site.pages_folder, file_name, combined_content)
+        save_to_blob(site.pages_folder, file_name, combined_content, web_url, item['id'])
+    else:
+        raise Exception(f"Failed to fetch page: {web_url}")
+
+
+def process_sharepoint_pages(full_crawl=False):
+    """Fetch and process the pages changed in SharePoint since the last run.
+
+    Runs (or resumes) a checkpointed crawl job; returns its id and status,
+    "paused" when the time budget ran out, with the source_url summary.
+    """
+    global content_index, crawl_store, crawl_job, skipped_pages
+    sites = [site for site in load_sites() if site.lists]
+    skipped_pages = {}
+    crawl_store = CrawlStore()
+    try:
+        crawl_store.ensure_schema()
+        crawl_job = CrawlJob.open(crawl_store, "pages", full_crawl)
+        content_index = crawl_store.load_content_index()
+        failed_sites = crawl_sites(sites, lambda site: crawl_site_pages(site, crawl_job.full_crawl))
+        crawl_store.flush()
+        status = crawl_job.finish({"source_url": crawl_store.summary(), "failed_sites": list(failed_sites),
+                                   "skipped": skipped_pages})
+    finally:
+        summary = crawl_store.close()
+    logging.info(f"Pages processed ({status}), source_url: {summary}, skipped: {skipped_pages}, "
+                 f"failed sites: {list(failed_sites)}")
+    return {"job_id": crawl_job.job_id, "status": status, "source_url": summary}
+
+
+def crawl_site_pages(site, full_crawl=False):
+    """Sync the page lists of a site, within the site's request budget.
+
+    A list that fails does not stop the others; the first error is raised once they are done.
+    """
+    errors = []
+    with rate_limited(site.rate_limiter):
+        for list_title in site.lists:
+            if crawl_job.out_of_time():
+                break
+            try:
+                sync_site_pages(site, list_title, full_crawl)
+            except Exception as e:
+                logging.error(f"Error syncing list {list_title} of site {site.name}: {e}")
+                errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def sync_site_pages(site, list_title, full_crawl=False):
+    """Apply the page list changes since the stored delta link, or all pages on the first run.
+
+    Progress is checkpointed after every page of the delta query, so a list
+    the time budget interrupts resumes from the next page. Once a Site Page
+    fails to be saved, progress is no longer checkpointed and the delta link
+    is not stored, so the next run fetches the failed pages again.
+    """
+    cursor_key = f"list:{site.site_id}:{list_title}"
+    resource = crawl_job.get_resource(cursor_key)
+    if resource and resource[1]:
+        # Already synced by an earlier run of this job
+        return
+    resume_link = resource[0] if resource else None
+    delta_link = None if full_crawl else crawl_store.get_delta_link(cursor_key)
+
+    # Without a stored delta link the query starts from scratch and returns every page
+    query = DeltaQuery(resume_link or delta_link or f"sites/{site.site_id}/lists/{list_title}/items/delta",
+                       select=PAGE_ITEM_FIELDS)
+    failed = 0
+    try:
+        for items in query.pages():
+            batch = []
+            for item in items:
+                if "deleted" in item:
+                    remove_deleted_item(item['id'])
+                elif not is_excluded_page(site, item):
+                    batch.append(item)
+
+                # Pages are fetched 20 at a time through a single $batch round trip
+                if len(batch) >= BATCH_LIMIT:
+                    failed += process_page_batch(site, batch)
+                    batch = []
+            failed += process_page_batch(site, batch)
+
+            if query.next_link:
+                if not failed:
+                    crawl_job.save_cursor(cursor_key, query.next_link)
+                if crawl_job.out_of_time():
+                    return
+    except DeltaResyncRequired as e:
+        logging.info(f"{e}, falling back to a full crawl")
+        crawl_store.clear_delta_link(cursor_key)
+        crawl_job.start_resource(cursor_key)
+        return sync_site_pages(site, list_title, full_crawl=True)
+
+    if failed:
+        raise Exception(f"{failed} pages of list {list_title} failed")
+    if query.delta_link:
+        crawl_store.save_delta_link(cursor_key, query.delta_link)
+    crawl_job.finish_resource(cursor_key)
@@ -0,0 +1,255 @@
+"""End-to-end benchmark of the SharePoint crawlers against a local Graph stand-in.
+
+Starts benchmarks/mock_graph.py with a synthetic tenant, keeps blobs in
+memory and the crawl state in a local PostgreSQL (COSMOPG_* settings, the
+crawl tables are emptied first), then runs the pages and drive crawls in
+full and optionally again incrementally.
+
+    COSMOPG_HOST=localhost COSMOPG_DBNAME=bench COSMOPG_USER=postgres COSMOPG_PASSWORD=postgres \
+        python benchmarks/bench_crawl.py --drives 2 --depth 3 --files 20 --throttle-every 100 --runs 2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import importlib.util
+import multiprocessing
+import urllib.request
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_graph import serve, add_tenant_arguments, tenant_from_arguments
+
+# Tables the crawlers keep their state in; emptied so the first run is a full crawl
+CRAWL_TABLES = ["source_url", "crawl_cursor", "crawl_job", "crawl_job_resource", "crawl_job_folder", "crawl_job_item"]
+
+
+class MemoryBlobService:
+    """In-memory stand-in for the BlobServiceClient calls the crawlers make."""
+
+    def __init__(self):
+        self.blobs = {}
+        self.staged = {}
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def get_blob_client(self, container, blob):
+        return MemoryBlobClient(self, blob)
+
+
+class MemoryBlob:
+    def __init__(self, content):
+        self.content = content
+
+    def readall(self):
+        return self.content
+
+    def readinto(self, stream):
+        stream.write(self.content)
+        return len(self.content)
+
+
+class MemoryBlock:
+    def __init__(self, id, size):
+        self.id = id
+        self.size = size
+
+
+class MemoryBlobClient:
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+
+    def stage_block(self, block_id, data, **kwargs):
+        with self.service.lock:
+            self.service.staged.setdefault(self.name, {})[block_id] = bytes(data)
+            self.service.stats["blocks_staged"] += 1
+            self.service.stats["bytes_staged"] += len(data)
+
+    def get_block_list(self, block_list_type="committed", **kwargs):
+        from azure.core.exceptions import ResourceNotFoundError
+        with self.service.lock:
+            staged = self.service.staged.get(self.name)
+            if staged is None and self.name not in self.service.blobs:
+                raise ResourceNotFoundError(f"Blob not found: {self.name}")
+            return [], [MemoryBlock(block_id, len(block)) for block_id, block in (staged or {}).items()]
+
+    def commit_block_list(self, block_list, **kwargs):
+        with self.service.lock:
+            staged = self.service.staged.pop(self.name, {})
+            self.service.blobs[self.name] = b"".join(staged[block.id] for block in block_list)
+            self.service.stats["blobs_committed"] += 1
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        content = data.encode("utf-8") if isinstance(data, str) else data if isinstance(data, bytes) else data.read()
+        with self.service.lock:
+            self.service.blobs[self.name] = content
+            self.service.stats["blobs_uploaded"] += 1
+            self.service.stats["bytes_uploaded"] += len(content)
+
+    def download_blob(self, **kwargs):
+        from azure.core.exceptions import ResourceNotFoundError
+        with self.service.lock:
+            if self.name not in self.service.blobs:
+                raise ResourceNotFoundError(f"Blob not found: {self.name}")
+            self.service.stats["blobs_downloaded"] += 1
+            return MemoryBlob(self.service.blobs[self.name])
+
+    def delete_blob(self, **kwargs):
+        from azure.core.exceptions import ResourceNotFoundError
+        with self.service.lock:
+            if self.service.blobs.pop(self.name, None) is None:
+                raise ResourceNotFoundError(f"Blob not found: {self.name}")
+            self.service.stats["blobs_deleted"] += 1
+
+
+def start_mock_graph(args):
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, daemon=True, args=(
+        tenant_from_arguments(args), 0, args.throttle_every, args.retry_after, ready))
+    server.start()
+    return server, f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+
+def get_graph_stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/_stats") as response:
+        return json.load(response)
+
+
+def write_site_registry(args, tenant, pages_dir):
+    sites = [{
+        "name": f"bench{site}",
+        "site_id": tenant.site_id(site),
+        "lists": ["Site Pages"],
+        "pages_folder": os.path.join(pages_dir, f"bench{site}"),
+        "budget": {
+            "requests_per_second": args.requests_per_second,
+            "list_workers": args.list_workers,
+            "download_workers": args.download_workers,
+        },
+    } for site in range(args.sites)]
+    handle, path = tempfile.mkstemp(prefix="bench-sites-", suffix=".json")
+    with os.fdopen(handle, "w", encoding="utf-8") as file:
+        json.dump({"sites": sites}, file)
+    return path
+
+
+def configure_environment(base_url, sites_file):
+    """Point the crawl modules at the stand-ins; must run before they are imported."""
+    os.environ["GRAPH_BASE_URL"] = f"{base_url}/v1.0"
+    os.environ["GRAPH_STATIC_TOKEN"] = "bench"
+    os.environ["SHAREPOINT_SITES_FILE"] = sites_file
+    os.environ.setdefault("AZURE_STORAGE_CONNECTION_STRING", "UseDevelopmentStorage=true")
+    os.environ.setdefault("BLOB_CONTAINER_NAME", "bench")
+    os.environ.setdefault("CRAWL_TIME_BUDGET_SECONDS", str(24 * 3600))
+
+
+def load_module(name, file_name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reset_database():
+    from crawl_store import CrawlStore
+    from crawl_jobs import JOB_SCHEMA_STATEMENTS
+    store = CrawlStore()
+    try:
+        store.execute("CREATE TABLE IF NOT EXISTS source_url (filename TEXT PRIMARY KEY, blobname TEXT, sharepoint_url TEXT)")
+        store.ensure_schema()
+        for statement in JOB_SCHEMA_STATEMENTS:
+            store.execute(statement)
+        store.execute(f"TRUNCATE {', '.join(CRAWL_TABLES)}")
+    finally:
+        store.close()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(name, run, blob_service, graph_url):
+    blobs_before = Counter(blob_service.stats)
+    graph_before = Counter(get_graph_stats(graph_url))
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    blobs = Counter(blob_service.stats)
+    blobs.subtract(blobs_before)
+    graph = Counter(get_graph_stats(graph_url))
+    graph.subtract(graph_before)
+
+    stored = blobs["blobs_committed"] + blobs["blobs_uploaded"]
+    stored_bytes = blobs["bytes_staged"] + blobs["bytes_uploaded"]
+    return {
+        "name": name,
+        "status": result["status"],
+        "seconds": round(seconds, 3),
+        "blobs_stored": stored,
+        "blobs_per_second": round(stored / seconds, 1),
+        "megabytes_per_second": round(stored_bytes / seconds / 1024 / 1024, 2),
+        "graph_requests": sum(count for route, count in graph.items() if route not in ("bytes_served", "throttled")),
+        "throttled": graph["throttled"],
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "source_url": result["source_url"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_tenant_arguments(parser)
+    parser.add_argument("--runs", type=int, default=1, help="crawls of each kind; runs after the first are incremental")
+    parser.add_argument("--requests-per-second", type=float, default=1000, help="per-site Graph budget")
+    parser.add_argument("--list-workers", type=int, default=4)
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    server, graph_url = start_mock_graph(args)
+    pages_dir = tempfile.mkdtemp(prefix="bench-pages-")
+    sites_file = write_site_registry(args, tenant_from_arguments(args), pages_dir)
+    configure_environment(graph_url, sites_file)
+
+    scrape_pages = load_module("Sharpoint_Scrape_Sites", "Sharpoint_Scrape_Sites.py")
+    scrape_drives = load_module("sharepoint_scrape", "Sharepoint Scrape.py")
+    blob_service = MemoryBlobService()
+    scrape_pages.blob_service_client = blob_service
+    scrape_drives.blob_service_client = blob_service
+    reset_database()
+
+    results = []
+    try:
+        for run in range(args.runs):
+            full_crawl = run == 0
+            kind = "full" if full_crawl else "incremental"
+            results.append(measure(f"pages {kind}", lambda: scrape_pages.process_sharepoint_pages(full_crawl),
+                                   blob_service, graph_url))
+            results.append(measure(f"drives {kind}", lambda: scrape_drives.extract_sharepoint(full_crawl),
+                                   blob_service, graph_url))
+    finally:
+        server.terminate()
+        os.remove(sites_file)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'crawl':<20} {'status':<10} {'seconds':>8} {'blobs':>7} {'blobs/s':>8} {'MB/s':>7} "
+          f"{'requests':>9} {'429s':>6} {'rss MB':>7}")
+    for result in results:
+        print(f"{result['name']:<20} {result['status']:<10} {result['seconds']:8.2f} {result['blobs_stored']:7d} "
+              f"{result['blobs_per_second']:8.1f} {result['megabytes_per_second']:7.2f} "
+              f"{result['graph_requests']:9d} {result['throttled']:6d} {result['peak_rss_mb']:7.1f}")
+
+
+if __name__ == "__main__":
+    main()
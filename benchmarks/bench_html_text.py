@@ -0,0 +1,65 @@
+"""Micro-benchmark of the Site Pages HTML-to-text conversion.
+
+Compares html_text.html_to_text against the previous BeautifulSoup based
+format_html_content (when bs4 is installed) on a captured web part.
+
+    python benchmarks/bench_html_text.py [--repeat 200] [--fixture path]
+"""
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_text import html_to_text
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "webpart.html")
+
+
+def legacy_format_html_content(html_content):
+    """The conversion used before html_text, kept for comparison."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, "html.parser")
+    formatted_content = []
+
+    for element in soup.descendants:
+        if element.name == "a":
+            formatted_content.append(f"[{element.get_text(strip=True)}]({element.get('href', '')})")
+        elif element.name == "table":
+            for row in element.find_all("tr"):
+                cells = [cell.get_text(strip=True) for cell in row.find_all(["td", "th"])]
+                formatted_content.append(" | ".join(cells))
+        elif element.name in ["p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol"]:
+            formatted_content.append(element.get_text(strip=True))
+
+    return "\n".join(formatted_content)
+
+
+def bench(name, convert, html_content, repeat):
+    seconds = min(timeit.repeat(lambda: convert(html_content), number=repeat, repeat=3)) / repeat
+    output = convert(html_content)
+    print(f"{name:<10} {seconds * 1e6:10.1f} us/page {len(output):8d} chars out")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixture", default=FIXTURE)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.fixture, encoding="utf-8") as file:
+        html_content = file.read()
+    print(f"fixture: {args.fixture} ({len(html_content)} chars)")
+
+    fast = bench("html_text", html_to_text, html_content, args.repeat)
+    try:
+        legacy = bench("bs4", legacy_format_html_content, html_content, args.repeat)
+        print(f"speedup: {legacy / fast:.1f}x")
+    except ImportError:
+        print("bs4 not installed, skipping the legacy conversion")
+
+
+if __name__ == "__main__":
+    main()
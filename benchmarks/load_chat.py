@@ -0,0 +1,347 @@
+"""Load test of the chat turn flow against local OpenAI and Postgres stand-ins.
+
+Hosts the chat function apps in-process behind one local HTTP server (the
+inter-function calls of ChatTransactionHandler go through it), answers
+Azure OpenAI from benchmarks/mock_openai.py and stores chat logs in a local
+PostgreSQL (COSMOPG_* settings). Runs the new session, follow-up, document
+upload and document follow-up turns in that order and reports latency
+percentiles, throughput and the database and HTTP calls of each turn.
+
+    COSMOPG_HOST=localhost COSMOPG_DBNAME=bench COSMOPG_USER=postgres COSMOPG_PASSWORD=postgres \
+        python benchmarks/load_chat.py --turns 200 --concurrency 16 --latency-ms 800 --citations 5
+
+--transport inprocess calls ChatTransactionHandler directly instead of over
+HTTP, leaving out the cost of the outer request.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import functools
+import threading
+import importlib
+import multiprocessing
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import psycopg2
+import requests
+import azure.functions as func
+from mock_openai import serve, add_openai_arguments, openai_from_arguments, citation_title
+
+# Function apps hosted for a chat turn
+FUNCTION_MODULES = ["ChatTransactionHandler", "Chat_Retrieve_function", "ChatAssistantHandler", "ReadUploadDoc",
+                    "UpdateChatlogsDB"]
+SCENARIOS = ["new_session", "followup", "doc_upload", "doc_followup"]
+LOAD_TEST_EMAIL = "loadtest@brinkmann.local"
+
+CHAT_LOGS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chat_logs (
+        message_uuid TEXT PRIMARY KEY,
+        timestamp TIMESTAMP,
+        chat_summary TEXT,
+        data_source TEXT,
+        document_upload BOOLEAN,
+        email TEXT,
+        feedback TEXT,
+        feedback_text TEXT,
+        feedback_type TEXT,
+        input_query TEXT,
+        output TEXT,
+        processed_query TEXT,
+        sessionid TEXT,
+        sources JSONB,
+        doc_content TEXT,
+        doc_type TEXT
+    )
+"""
+
+calls = Counter()
+calls_lock = threading.Lock()
+
+
+def count_call(name):
+    with calls_lock:
+        calls[name] += 1
+
+
+@functools.lru_cache(maxsize=None)
+def counting_cursor(cursor_factory):
+    """Subclass of a cursor class counting its statements."""
+    class CountingCursor(cursor_factory):
+        def execute(self, query, vars=None):
+            count_call("db_queries")
+            return super().execute(query, vars)
+
+    return CountingCursor
+
+
+def count_database_calls():
+    """Count the connections and queries of every psycopg2 user in this process."""
+    connect = psycopg2.connect
+
+    def counting_connect(*args, **kwargs):
+        count_call("db_connects")
+        kwargs["cursor_factory"] = counting_cursor(kwargs.get("cursor_factory") or psycopg2.extensions.cursor)
+        return connect(*args, **kwargs)
+
+    psycopg2.connect = counting_connect
+
+
+class FunctionHost:
+    """Serves the HTTP functions of function apps at /api/<route>, like the Functions host."""
+
+    def __init__(self):
+        self.functions = {}
+        host = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_request(self):
+                parts = urlsplit(self.path)
+                route = parts.path[len("/api/"):] if parts.path.startswith("/api/") else None
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if route not in host.functions:
+                    return self.respond(404, b"Not Found", "text/plain")
+
+                count_call(f"http:{route}")
+                request = func.HttpRequest(self.command, f"http://{self.headers.get('Host')}{self.path}",
+                                           headers=dict(self.headers), params={name: values[0] for name, values in
+                                                                                parse_qs(parts.query).items()},
+                                           route_params={}, body=body)
+                response = host.functions[route](request)
+                self.respond(response.status_code, response.get_body(), response.mimetype, response.headers)
+
+            def respond(self, status, body, mimetype, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    if name.lower() not in ("content-type", "content-length"):
+                        self.send_header(name, value)
+                self.send_header("Content-Type", mimetype or "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = handle_request
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def add_app(self, app):
+        for function in app.get_functions():
+            route = getattr(function.get_trigger(), "route", None) or function.get_function_name()
+            self.functions[route] = function.get_user_function()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def start_mock_openai(args):
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, daemon=True, args=(openai_from_arguments(args), 0, ready))
+    server.start()
+    return server, f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+
+def get_openai_stats(openai_url):
+    with urllib.request.urlopen(f"{openai_url}/_stats") as response:
+        return json.load(response)
+
+
+def configure_environment(host_url, openai_url):
+    """Point the chat functions at the local host and stand-ins; must run before they are imported."""
+    os.environ["CHAT_RETRIEVE_FUNCTION_URL"] = f"{host_url}/api/Chat_Retrieve_function"
+    os.environ["CHAT_ASSISTANT_URL"] = f"{host_url}/api/ChatAssistant"
+    os.environ["READ_UPLOAD_DOC_URL"] = f"{host_url}/api/ReadUploadDoc"
+    os.environ["UPDATE_CHATLOGS_DB_URL"] = f"{host_url}/api/UpdateChatlogsDB"
+    os.environ["AZURE_OPENAI_ENDPOINT"] = openai_url
+    os.environ["AZURE_OPENAI_API_KEY"] = "load-test"
+    os.environ.setdefault("OPENAI_API_VERSION", "2024-05-01-preview")
+    os.environ.setdefault("DEPLOYMENT", "gpt-4o")
+    # Retrieval happens inside the OpenAI stand-in, these are only passed through
+    os.environ.setdefault("AZURE_SEARCH_ENDPOINT", "http://search.local")
+    os.environ.setdefault("AZURE_SEARCH_INDEX", "load-test")
+    os.environ.setdefault("AZURE_SEARCH_API_KEY", "load-test")
+    # Summaries go through an Azure Storage Queue, which the load test has no stand-in for
+    os.environ.setdefault("CHAT_SUMMARIES", "off")
+
+
+def prepare_database(citations):
+    """Create the tables a turn uses, drop earlier load-test chats and register the cited documents."""
+    connection = psycopg2.connect(**importlib.import_module("ChatTransactionHandler").DB_CONFIG)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(CHAT_LOGS_SCHEMA)
+            cursor.execute("CREATE TABLE IF NOT EXISTS source_url (filename TEXT PRIMARY KEY, blobname TEXT, sharepoint_url TEXT)")
+            cursor.execute("DELETE FROM chat_logs WHERE email = %s", (LOAD_TEST_EMAIL,))
+            for index in range(1, citations + 1):
+                cursor.execute("""
+                    INSERT INTO source_url (filename, blobname, sharepoint_url) VALUES (%s, %s, %s)
+                    ON CONFLICT (filename) DO NOTHING
+                """, (citation_title(index), f"loadtest/{citation_title(index)}",
+                      f"https://askbrinkmann.sharepoint.com/:b:/r/loadtest/{index}"))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def make_document(kilobytes):
+    line = "Section 4.2: Concrete pours require a 48 hour cure before formwork is stripped.\n"
+    return base64.b64encode((line * (kilobytes * 1024 // len(line) + 1)).encode()).decode()
+
+
+class ChatClient:
+    """Sends chat turns to ChatTransactionHandler over HTTP or by calling it directly."""
+
+    def __init__(self, host, transport):
+        self.host = host
+        self.transport = transport
+        self.local = threading.local()
+
+    def send(self, payload):
+        if self.transport == "inprocess":
+            request = func.HttpRequest("POST", f"{self.host.base_url}/api/ChatTransactionHandler",
+                                       headers={"Content-Type": "application/json"}, params={}, route_params={},
+                                       body=json.dumps(payload).encode())
+            response = self.host.functions["ChatTransactionHandler"](request)
+            return response.status_code, response.get_body()
+
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        response = self.local.session.post(f"{self.host.base_url}/api/ChatTransactionHandler", json=payload)
+        return response.status_code, response.content
+
+
+def turn_payloads(scenario, turns, sessions, document):
+    """Request bodies of a scenario; the follow-ups continue the sessions of the turns before them."""
+    for index in range(turns):
+        payload = {"email": LOAD_TEST_EMAIL, "query": f"What is the curing time for slab pour {index}?"}
+        if scenario == "followup":
+            payload["sessionid"] = sessions["new_session"][index % len(sessions["new_session"])]
+        elif scenario == "doc_upload":
+            payload.update({"document_uploaded": True, "file_content": document, "file_type": "txt"})
+        elif scenario == "doc_followup":
+            payload.update({"document_uploaded": True, "sessionid": sessions["doc_upload"][index % len(sessions["doc_upload"])]})
+        yield payload
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+def run_scenario(scenario, client, payloads, concurrency, openai_url):
+    latencies = []
+    session_ids = []
+    errors = Counter()
+    lock = threading.Lock()
+
+    def turn(payload):
+        start = time.perf_counter()
+        try:
+            status, body = client.send(payload)
+        except Exception as e:
+            status, body = type(e).__name__, b""
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status == 200:
+                session_ids.append(json.loads(body)["sessionid"])
+            else:
+                errors[str(status)] += 1
+
+    with calls_lock:
+        calls_before = Counter(calls)
+    openai_before = Counter(get_openai_stats(openai_url))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(turn, payloads))
+    seconds = time.perf_counter() - start
+    with calls_lock:
+        turn_calls = Counter(calls)
+    turn_calls.subtract(calls_before)
+    openai_calls = Counter(get_openai_stats(openai_url))
+    openai_calls.subtract(openai_before)
+
+    turns = len(latencies)
+    return {
+        "scenario": scenario,
+        "turns": turns,
+        "errors": dict(errors),
+        "seconds": round(seconds, 3),
+        "turns_per_second": round(turns / seconds, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(max(latencies) * 1000, 1),
+        "per_turn": {name: round(count / turns, 2) for name, count in sorted(turn_calls.items()) if count} |
+                    {"openai": round(openai_calls["completions"] / turns, 2)},
+    }, session_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=100, help="turns per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="turns in flight")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--transport", choices=["http", "inprocess"], default="http")
+    parser.add_argument("--doc-kb", type=int, default=32, help="size of the uploaded text document")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    add_openai_arguments(parser)
+    args = parser.parse_args()
+
+    openai_server, openai_url = start_mock_openai(args)
+    host = FunctionHost()
+    configure_environment(host.base_url, openai_url)
+    for module in FUNCTION_MODULES:
+        host.add_app(importlib.import_module(module).app)
+    host.start()
+    count_database_calls()
+    prepare_database(args.citations)
+
+    client = ChatClient(host, args.transport)
+    document = make_document(args.doc_kb)
+    sessions = {}
+    results = []
+    try:
+        for scenario in SCENARIOS:
+            if scenario not in args.scenarios:
+                continue
+            if scenario == "followup" and not sessions.get("new_session") or \
+                    scenario == "doc_followup" and not sessions.get("doc_upload"):
+                print(f"Skipping {scenario}: it continues the sessions of an earlier scenario", file=sys.stderr)
+                continue
+            result, sessions[scenario] = run_scenario(scenario, client, turn_payloads(scenario, args.turns, sessions, document),
+                                                      args.concurrency, openai_url)
+            results.append(result)
+    finally:
+        openai_server.terminate()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'scenario':<14} {'turns':>6} {'errors':>6} {'turns/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  calls per turn")
+    for result in results:
+        per_turn = ", ".join(f"{name} {count:g}" for name, count in result["per_turn"].items())
+        print(f"{result['scenario']:<14} {result['turns']:6d} {sum(result['errors'].values()):6d} "
+              f"{result['turns_per_second']:8.2f} {result['p50_ms']:8.1f} {result['p95_ms']:8.1f} {result['p99_ms']:8.1f}  "
+              f"{per_turn}")
+
+
+if __name__ == "__main__":
+    main()
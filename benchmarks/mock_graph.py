@@ -0,0 +1,349 @@
+"""Local stand-in for the parts of Microsoft Graph the SharePoint crawlers use.
+
+Serves a synthetic tenant: site drives with nested folders and paged
+listings, delta links, $batch, sharing links, file downloads (with Range),
+and Site Pages with canvas web parts. With --changes, the drive delta
+queries after the first report that many changed files per drive. Every Nth request can be throttled
+with 429 + Retry-After. GET /_stats returns the request counts.
+
+    python benchmarks/mock_graph.py --port 8765 --files 20 --throttle-every 50
+"""
+import os
+import json
+import zlib
+import base64
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "webpart.html")
+PAGE_SIZE = 200
+LINE = b"Brinkmann synthetic document line for crawl benchmarking purposes only.\n"
+
+
+def encode_id(*parts):
+    return base64.urlsafe_b64encode("|".join(str(part) for part in parts).encode()).rstrip(b"=").decode()
+
+
+def decode_id(item_id):
+    return base64.urlsafe_b64decode(item_id + "=" * (-len(item_id) % 4)).decode().split("|")
+
+
+class SyntheticTenant:
+    """A tenant generated from its shape, nothing is stored per item."""
+
+    def __init__(self, sites=1, drives=2, depth=2, folders=3, files=10, file_size=64 * 1024, pages=50, webparts=3,
+                 extension="txt", changes=0):
+        self.sites = sites
+        self.drives = drives
+        self.depth = depth
+        self.folders = folders
+        self.files = files
+        self.file_size = file_size
+        self.pages = pages
+        self.webparts = webparts
+        self.extension = extension
+        self.changes = changes
+        with open(FIXTURE, encoding="utf-8") as file:
+            self.webpart_html = file.read()
+
+    def site_id(self, site):
+        return f"bench.sharepoint.com,{site:08d}-0000-0000-0000-000000000000,web{site}"
+
+    def site_index(self, site_id):
+        return int(site_id.split(",")[1].split("-")[0])
+
+    def drive_id(self, site, drive):
+        return f"b!s{site}d{drive}"
+
+    def list_drives(self, site):
+        return [{"id": self.drive_id(site, drive), "name": f"Library {drive}"} for drive in range(self.drives)]
+
+    def list_children(self, drive_id, folder_path, base_url):
+        depth = len(folder_path.split("/")) if folder_path else 0
+        children = []
+        if depth < self.depth:
+            children += [{"id": encode_id(drive_id, folder_path, f"folder{index}"), "name": f"Folder {index}",
+                          "folder": {"childCount": self.folders + self.files}} for index in range(self.folders)]
+        children += [self.file_item(drive_id, folder_path, index, base_url) for index in range(self.files)]
+        return children
+
+    def file_item(self, drive_id, folder_path, index, base_url):
+        item_id = encode_id(drive_id, folder_path, index)
+        return {
+            "id": item_id,
+            "name": f"Document {drive_id[2:]}-{zlib.crc32(folder_path.encode()):08x}-{index}.{self.extension}",
+            "size": self.file_size,
+            "lastModifiedDateTime": "2024-01-15T10:00:00Z",
+            "file": {"mimeType": "text/plain", "hashes": {"quickXorHash": base64.b64encode(hashlib.sha1(item_id.encode()).digest()).decode()}},
+            "@microsoft.graph.downloadUrl": f"{base_url}/download/{item_id}",
+        }
+
+    def folder_paths(self):
+        """Every folder path of a drive, breadth-first from the root ("")."""
+        paths = [""]
+        for path in paths:
+            if (len(path.split("/")) if path else 0) < self.depth:
+                paths += [f"{path}/Folder {index}".strip("/") for index in range(self.folders)]
+        return paths
+
+    def folder_id(self, drive_id, folder_path):
+        if not folder_path:
+            return encode_id(drive_id, "root")
+        parent, _, name = folder_path.rpartition("/")
+        return encode_id(drive_id, parent, f"folder{name.split()[-1]}")
+
+    def folder_of_id(self, item_id):
+        """Folder path of a folder id, None for file ids."""
+        parts = decode_id(item_id)
+        if parts[1:] == ["root"]:
+            return ""
+        if len(parts) == 3 and parts[2].startswith("folder"):
+            return f"{parts[1]}/Folder {parts[2][len('folder'):]}".strip("/")
+        return None
+
+    def folder_item(self, drive_id, folder_path):
+        """A folder as a driveItem GET answers it, with the path of its parent."""
+        if not folder_path:
+            return {"id": self.folder_id(drive_id, ""), "name": "root", "root": {}, "folder": {}}
+        parent, _, name = folder_path.rpartition("/")
+        return {"id": self.folder_id(drive_id, folder_path), "name": name,
+                "folder": {"childCount": self.folders + self.files},
+                "parentReference": {"driveId": drive_id, "id": self.folder_id(drive_id, parent),
+                                    "path": f"/drives/{drive_id}/root:/{quote(parent)}".rstrip("/")}}
+
+    def drive_changes(self, drive_id, base_url):
+        """Delta items of self.changes files changed since the first crawl, spread over the folders.
+
+        As in Graph's delta, items name their parent by id only. The first
+        half of the changes come with their folders, the others leave the
+        folder to be looked up.
+        """
+        folder_paths = self.folder_paths()
+        items = []
+        listed = set()
+        for change in range(self.changes):
+            folder_path = folder_paths[change % len(folder_paths)]
+            if change < self.changes // 2 and folder_path and folder_path not in listed:
+                listed.add(folder_path)
+                folder = self.folder_item(drive_id, folder_path)
+                del folder["parentReference"]["path"]
+                items.append(folder)
+            item = self.file_item(drive_id, folder_path, change // len(folder_paths) % self.files, base_url)
+            item["file"]["hashes"]["quickXorHash"] = base64.b64encode(hashlib.sha1(f"{item['id']}:changed".encode()).digest()).decode()
+            item["parentReference"] = {"driveId": drive_id, "id": self.folder_id(drive_id, folder_path)}
+            items.append(item)
+        return items
+
+    def file_content(self):
+        return (LINE * (self.file_size // len(LINE) + 1))[:self.file_size]
+
+    def page_items(self, site):
+        return [{
+            "id": str(index + 1),
+            "webUrl": f"https://bench.sharepoint.com/sites/s{site}/SitePages/Page-{index}.aspx",
+            "eTag": f"\"00000000-0000-0000-{site:04d}-{index:012d},3\"",
+        } for index in range(self.pages)]
+
+    def site_page(self, page_guid):
+        index = int(page_guid.split("-")[-1])
+        webpart = {"innerHtml": f"<h2>Page {index}</h2>{self.webpart_html}"}
+        return {"id": page_guid, "canvasLayout": {"horizontalSections": [{"columns": [{"webparts": [webpart] * self.webparts}]}]}}
+
+
+class MockGraph:
+    """Routes Graph requests against a SyntheticTenant."""
+
+    def __init__(self, tenant, base_url, throttle_every=0, retry_after=1):
+        self.tenant = tenant
+        self.base_url = base_url
+        self.graph_url = f"{base_url}/v1.0"
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.routed = 0
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def throttled(self):
+        if not self.throttle_every:
+            return False
+        with self.lock:
+            self.routed += 1
+            return self.routed % self.throttle_every == 0
+
+    def route(self, method, url, body=None):
+        """Answer one Graph request; returns (status, headers, body object)."""
+        parts = urlsplit(url)
+        path = unquote(parts.path).split("/v1.0/", 1)[-1].strip("/")
+        query = {name: values[0] for name, values in parse_qs(parts.query).items()}
+
+        if path == "$batch":
+            self.count("batch")
+            return 200, {}, {"responses": [self.route_sub_request(sub_request) for sub_request in body["requests"]]}
+
+        if self.throttled():
+            self.count("throttled")
+            return 429, {"Retry-After": str(self.retry_after)}, {"error": {"code": "TooManyRequests"}}
+
+        segments = path.split("/")
+        if segments[0] == "sites" and len(segments) == 3 and segments[2] == "drives":
+            self.count("drives")
+            return 200, {}, {"value": self.tenant.list_drives(self.tenant.site_index(segments[1]))}
+
+        if segments[0] == "sites" and "lists" in segments and segments[-1] == "delta":
+            self.count("list_delta")
+            return 200, {}, self.page_list_delta(segments[1], path, query)
+
+        if segments[0] == "sites" and len(segments) >= 4 and segments[2] == "pages":
+            self.count("site_page")
+            return 200, {}, self.tenant.site_page(segments[3])
+
+        if segments[0] == "drives":
+            return self.route_drive(method, segments, path, query)
+
+        self.count("not_found")
+        return 404, {}, {"error": {"code": "itemNotFound", "message": path}}
+
+    def route_sub_request(self, sub_request):
+        status, headers, body = self.route(sub_request["method"], f"{self.graph_url}{sub_request['url']}",
+                                           sub_request.get("body"))
+        return {"id": sub_request["id"], "status": status, "headers": headers, "body": body}
+
+    def route_drive(self, method, segments, path, query):
+        drive_id = segments[1]
+        if path.endswith("/createLink"):
+            self.count("create_link")
+            return 201, {}, {"link": {"webUrl": f"https://bench.sharepoint.com/:t:/r/{segments[3]}"}}
+
+        if segments[2:4] == ["root", "delta"]:
+            self.count("drive_delta")
+            # A drive changes once, after the first crawl, if the tenant has changes at all
+            token = query.get("token")
+            changed = self.tenant.changes and token in ("bench", "bench-changed")
+            items = self.tenant.drive_changes(drive_id, self.base_url) if changed and token == "bench" else []
+            return 200, {}, {"value": items, "@odata.deltaLink":
+                             f"{self.graph_url}/drives/{drive_id}/root/delta?token={'bench-changed' if changed else 'bench'}"}
+
+        if segments[2] == "items":
+            self.count("item")
+            folder_path = self.tenant.folder_of_id(segments[3])
+            if folder_path is not None:
+                return 200, {}, self.tenant.folder_item(drive_id, folder_path)
+            return 200, {}, {"id": segments[3], "@microsoft.graph.downloadUrl": f"{self.base_url}/download/{segments[3]}"}
+
+        if path.endswith("children"):
+            self.count("children")
+            folder_path = path.split("root:", 1)[1].rsplit(":", 1)[0].strip("/") if "root:" in path else ""
+            children = self.tenant.list_children(drive_id, folder_path, self.base_url)
+            return 200, {}, self.paged(children, f"{self.graph_url}/{quote(path, safe='/:,!')}", query, int(query.get("$top", PAGE_SIZE)))
+
+        self.count("not_found")
+        return 404, {}, {"error": {"code": "itemNotFound", "message": path}}
+
+    def page_list_delta(self, site_id, path, query):
+        if query.get("token") == "bench":
+            return {"value": [], "@odata.deltaLink": f"{self.graph_url}/{quote(path, safe='/:,!')}?token=bench"}
+        page = self.paged(self.tenant.page_items(self.tenant.site_index(site_id)), f"{self.graph_url}/{quote(path, safe='/:,!')}", query, PAGE_SIZE)
+        if "@odata.nextLink" not in page:
+            page["@odata.deltaLink"] = f"{self.graph_url}/{quote(path, safe='/:,!')}?token=bench"
+        return page
+
+    def paged(self, items, url, query, page_size):
+        offset = int(query.get("$skiptoken", 0))
+        page = {"value": items[offset:offset + page_size]}
+        if offset + page_size < len(items):
+            page["@odata.nextLink"] = f"{url}?$top={page_size}&$skiptoken={offset + page_size}"
+        return page
+
+    def download(self, range_header):
+        content = self.tenant.file_content()
+        start = int(range_header.split("=", 1)[1].split("-", 1)[0]) if range_header else 0
+        self.count("download")
+        self.count("bytes_served", len(content) - start)
+        return (206 if start else 200), content[start:]
+
+
+def make_handler(graph):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status, body, headers=None, content_type="application/json"):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                with graph.lock:
+                    return self.send_body(200, dict(graph.stats))
+            if self.path.startswith("/download/"):
+                status, content = graph.download(self.headers.get("Range"))
+                return self.send_body(status, content, content_type="application/octet-stream")
+            status, headers, body = graph.route("GET", self.path)
+            self.send_body(status, body, headers)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length)) if length else None
+            status, headers, response = graph.route("POST", self.path, body)
+            self.send_body(status, response, headers)
+
+    return Handler
+
+
+def serve(tenant, port=0, throttle_every=0, retry_after=1, ready=None):
+    """Serve the tenant until the process ends; the bound port is put on ready, if given."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), None)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.RequestHandlerClass = make_handler(MockGraph(tenant, base_url, throttle_every, retry_after))
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def add_tenant_arguments(parser):
+    parser.add_argument("--sites", type=int, default=1)
+    parser.add_argument("--drives", type=int, default=2, help="drives per site")
+    parser.add_argument("--depth", type=int, default=2, help="folder nesting below each drive root")
+    parser.add_argument("--folders", type=int, default=3, help="subfolders per folder")
+    parser.add_argument("--files", type=int, default=10, help="files per folder")
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--pages", type=int, default=50, help="Site Pages per site")
+    parser.add_argument("--webparts", type=int, default=3, help="web parts per page")
+    parser.add_argument("--changes", type=int, default=0, help="files per drive changed after the first crawl")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth request with 429")
+    parser.add_argument("--retry-after", type=float, default=1)
+
+
+def tenant_from_arguments(args):
+    return SyntheticTenant(args.sites, args.drives, args.depth, args.folders, args.files, args.file_size,
+                           args.pages, args.webparts, changes=args.changes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    add_tenant_arguments(parser)
+    args = parser.parse_args()
+    print(f"Serving mock Graph on http://127.0.0.1:{args.port}/v1.0")
+    serve(tenant_from_arguments(args), args.port, args.throttle_every, args.retry_after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Local stand-in for Azure OpenAI chat completions "on your data".
+
+Answers POST .../openai/deployments/{deployment}/chat/completions after a
+configurable latency, with a number of [docN] references and matching
+Azure Search citations in message.context, as ChatAssistantHandler expects.
+The retrieval the real service runs against Azure Search is part of that
+latency. GET /_stats returns the request counts.
+
+    python benchmarks/mock_openai.py --port 8766 --latency-ms 800 --jitter-ms 200 --citations 5
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+NOT_FOUND_ANSWER = "The requested information is not available in the retrieved data. Please try another query or topic."
+
+
+def citation_title(index):
+    return f"Load Test Document {index}.pdf"
+
+
+class MockOpenAI:
+    """Builds chat completions; not_found_rate of the answers are the "not available" reply."""
+
+    def __init__(self, latency_ms=800, jitter_ms=200, citations=5, citation_chars=1500, not_found_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.citations = citations
+        self.citation_chars = citation_chars
+        self.not_found_rate = not_found_rate
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def delay(self):
+        return max(0.0, random.gauss(self.latency_ms, self.jitter_ms) / 1000) if self.jitter_ms else self.latency_ms / 1000
+
+    def completion(self, request):
+        messages = request.get("messages", [])
+        prompt_chars = sum(len(message.get("content") or "") for message in messages)
+        self.count("completions")
+        self.count("prompt_chars", prompt_chars)
+
+        if random.random() < self.not_found_rate:
+            content, citations = NOT_FOUND_ANSWER, []
+        else:
+            citations = [{
+                "content": (f"Excerpt {index} of the retrieved construction document. " * 40)[:self.citation_chars],
+                "title": citation_title(index),
+                "url": f"https://search.local/docs/{index}",
+                "filepath": citation_title(index),
+                "chunk_id": "0",
+            } for index in range(1, self.citations + 1)]
+            content = " ".join(f"Finding {index} of the answer [doc{index}]." for index in range(1, self.citations + 1))
+
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {
+                    "role": "assistant",
+                    "content": content,
+                    "context": {"citations": citations, "intent": "[]"},
+                },
+            }],
+            "usage": {"prompt_tokens": prompt_chars // 4, "completion_tokens": len(content) // 4,
+                      "total_tokens": (prompt_chars + len(content)) // 4},
+        }
+
+
+def make_handler(openai):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                with openai.lock:
+                    return self.send_json(200, dict(openai.stats))
+            self.send_json(404, {"error": {"code": "NotFound"}})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if "/chat/completions" not in self.path:
+                return self.send_json(404, {"error": {"code": "NotFound"}})
+            time.sleep(openai.delay())
+            self.send_json(200, openai.completion(request))
+
+    return Handler
+
+
+def serve(openai, port=0, ready=None):
+    """Serve until the process ends; the bound port is put on ready, if given."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(openai))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def add_openai_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=800, help="mean completion latency")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="standard deviation of the latency")
+    parser.add_argument("--citations", type=int, default=5, help="citations per answer")
+    parser.add_argument("--citation-chars", type=int, default=1500)
+    parser.add_argument("--not-found-rate", type=float, default=0.0, help="share of \"not available\" answers")
+
+
+def openai_from_arguments(args):
+    return MockOpenAI(args.latency_ms, args.jitter_ms, args.citations, args.citation_chars, args.not_found_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8766)
+    add_openai_arguments(parser)
+    args = parser.parse_args()
+    print(f"Serving mock Azure OpenAI on http://127.0.0.1:{args.port}")
+    serve(openai_from_arguments(args), args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobBlock
+from graph_client import session
+
+# Files are piped into Blob Storage in blocks of this size
+BLOCK_SIZE = int(os.getenv('BLOB_BLOCK_SIZE', str(4 * 1024 * 1024)))
+# Blocks read but not yet staged, per transfer; bounds memory to about (N + 1) * BLOCK_SIZE
+MAX_IN_FLIGHT_BLOCKS = int(os.getenv('BLOB_MAX_IN_FLIGHT_BLOCKS', '4'))
+# Threads staging blocks, shared by all transfers
+STAGE_WORKERS = int(os.getenv('BLOB_STAGE_WORKERS', '16'))
+READ_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+stage_pool = ThreadPoolExecutor(STAGE_WORKERS, thread_name_prefix="blob-stage")
+
+
+def make_block_id(transfer_key, index):
+    """Deterministic block id, so an interrupted transfer can find its staged blocks again."""
+    return base64.b64encode(f"{transfer_key}-{index:06d}".encode()).decode()
+
+
+def get_resume_block(blob_client, transfer_key):
+    """Number of leading blocks an earlier, interrupted attempt of this transfer already staged."""
+    try:
+        _, uncommitted = blob_client.get_block_list("uncommitted")
+    except ResourceNotFoundError:
+        return 0
+
+    staged = {block.id: block.size for block in uncommitted}
+    index = 0
+    while staged.get(make_block_id(transfer_key, index)) == BLOCK_SIZE:
+        index += 1
+    return index
+
+
+def read_blocks(response, block_size):
+    """Regroup a streamed HTTP body into blocks of exactly block_size bytes (the last may be shorter)."""
+    buffer = bytearray()
+    for chunk in response.iter_content(READ_CHUNK_SIZE):
+        buffer += chunk
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def stage_download(blob_client, file_url, transfer_key, resume=True, hasher=None, copy_to=None):
+    """Stream file_url into staged, uncommitted blocks of blob_client.
+
+    Blocks are staged in parallel with at most MAX_IN_FLIGHT_BLOCKS held in
+    memory. With resume, blocks already staged under the same transfer_key are
+    kept and only the rest of the file is requested with a Range header.
+    copy_to, a file object, receives a copy of the content unless the
+    transfer resumed, as the blocks staged before cannot be read back until
+    they are committed. Returns the ordered block ids, the number of bytes
+    downloaded, and whether copy_to holds the whole content.
+    """
+    start_block = get_resume_block(blob_client, transfer_key) if resume else 0
+    headers = {"Range": f"bytes={start_block * BLOCK_SIZE}-"} if start_block else {}
+
+    response = session.get(file_url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)
+    response.raise_for_status()
+    if start_block and response.status_code != 206:
+        # The server ignored the range, so the body starts from the beginning
+        start_block = 0
+    if start_block:
+        copy_to = None
+
+    block_ids = [make_block_id(transfer_key, index) for index in range(start_block)]
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT_BLOCKS)
+    futures = []
+    transferred = 0
+
+    try:
+        for index, block in enumerate(read_blocks(response, BLOCK_SIZE), start=start_block):
+            if hasher:
+                hasher.update(block)
+            if copy_to:
+                copy_to.write(block)
+            block_id = make_block_id(transfer_key, index)
+
+            in_flight.acquire()
+            future = stage_pool.submit(blob_client.stage_block, block_id, block)
+            future.add_done_callback(lambda _: in_flight.release())
+            futures.append(future)
+            block_ids.append(block_id)
+            transferred += len(block)
+    finally:
+        response.close()
+
+    # Surface the first staging error, if any
+    for future in futures:
+        future.result()
+    return block_ids, transferred, start_block == 0
+
+
+def commit_blocks(blob_client, block_ids, content_settings=None, metadata=None):
+    """Commit staged blocks as the new content of the blob."""
+    blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                                  content_settings=content_settings, metadata=metadata)
@@ -0,0 +1,289 @@
+"""Streaming export of chat_logs as CSV, gzip JSONL or Parquet.
+
+Rows are read through COPY TO (CSV) or a server-side cursor, so memory
+stays constant however many rows match, and the output is produced as a
+stream of byte chunks for ExportChatLogs.py or the command line:
+
+    python chat_export.py --format jsonl.gz --start 2025-01-01 --end 2025-02-01 --output chat_logs.jsonl.gz
+"""
+import os
+import io
+import sys
+import json
+import zlib
+import queue
+import logging
+import argparse
+import datetime
+import threading
+import psycopg2
+
+DB_CONFIG = {
+    "host": os.getenv("COSMOPG_HOST"),
+    "dbname": os.getenv("COSMOPG_DBNAME"),
+    "user": os.getenv("COSMOPG_USER"),
+    "password": os.getenv("COSMOPG_PASSWORD"),
+    "port": 5432
+}
+
+# Columns of chat_logs in export order, as written by UpdateChatlogsDB
+EXPORT_COLUMNS = [
+    "message_uuid", "timestamp", "chat_summary", "data_source", "document_upload", "email", "feedback",
+    "feedback_text", "feedback_type", "input_query", "output", "processed_query", "sessionid", "sources",
+    "doc_content", "doc_type",
+]
+
+# Rows are fetched from the server-side cursor (and written per Parquet row group) in batches of about
+# this many bytes of column values, as a row with an uploaded document's text is far larger than one without
+EXPORT_BATCH_BYTES = int(os.getenv('EXPORT_BATCH_BYTES', str(16 * 1024 * 1024)))
+# Bounds on the rows of a batch; the first one is small, until the row size is known
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+EXPORT_FIRST_BATCH_SIZE = 100
+# Size assumed for a value that is not text, e.g. a timestamp or the parsed sources
+VALUE_SIZE_ESTIMATE = 64
+# Output is handed out in chunks of about this many bytes
+EXPORT_CHUNK_SIZE = 256 * 1024
+# Chunks COPY may run ahead of the consumer
+COPY_QUEUE_CHUNKS = 8
+# PostgreSQL type oids of timestamp and timestamptz, the columns Parquet exports keep as timestamps
+TIMESTAMP_OID = 1114
+TIMESTAMPTZ_OID = 1184
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl.gz": ("application/gzip", "jsonl.gz"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def parse_date(value):
+    """ISO date or timestamp of a filter; ValueError if it is malformed."""
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+def build_export_query(start=None, end=None, email=None, data_source=None):
+    """SELECT of the chat_logs rows in [start, end) matching the filters, oldest first, and its parameters."""
+    conditions = []
+    params = []
+    for condition, value in (("timestamp >= %s", start), ("timestamp < %s", end), ("email = %s", email),
+                             ("data_source = %s", data_source)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT {', '.join(EXPORT_COLUMNS)} FROM chat_logs{where} ORDER BY timestamp", params
+
+
+def get_db_connection():
+    try:
+        return psycopg2.connect(**DB_CONFIG)
+    except Exception as e:
+        logging.error(f"Error while connecting to the database: {str(e)}")
+        raise e
+
+
+def iter_rows(connection, query, params, batch_bytes=EXPORT_BATCH_BYTES, max_batch_size=EXPORT_BATCH_SIZE):
+    """Batches of rows of query, read through a server-side cursor.
+
+    Each fetch asks for as many rows as fit in batch_bytes at the average
+    size of the rows of the batch before, up to max_batch_size rows.
+    """
+    with connection.cursor(name="chat_logs_export") as cursor:
+        cursor.execute(query, params)
+        batch_size = min(EXPORT_FIRST_BATCH_SIZE, max_batch_size)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+            row_bytes = sum(len(value) if isinstance(value, (str, bytes)) else VALUE_SIZE_ESTIMATE
+                            for row in rows for value in row) / len(rows)
+            batch_size = max(1, min(max_batch_size, int(batch_bytes / row_bytes)))
+
+
+def describe_query(connection, query, params):
+    """Type codes (PostgreSQL oids) of the columns of query, without reading any of its rows."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT * FROM ({query}) AS export LIMIT 0", params)
+        return [column.type_code for column in cursor.description]
+
+
+class QueueWriter:
+    """File object handing what is written to a bounded queue in chunks, so the writer waits for the reader."""
+
+    def __init__(self, chunks, chunk_size=EXPORT_CHUNK_SIZE):
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data.encode("utf-8") if isinstance(data, str) else data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.chunks.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+def export_csv(connection, query, params):
+    """CSV with a header row, produced by COPY TO STDOUT on a separate thread."""
+    with connection.cursor() as cursor:
+        copy = f"COPY ({cursor.mogrify(query, params).decode()}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    chunks = queue.Queue(COPY_QUEUE_CHUNKS)
+    failure = []
+    done = object()
+
+    def run_copy():
+        try:
+            with connection.cursor() as cursor:
+                writer = QueueWriter(chunks)
+                cursor.copy_expert(copy, writer)
+                writer.flush()
+        except Exception as e:
+            failure.append(e)
+        finally:
+            chunks.put(done)
+
+    copier = threading.Thread(target=run_copy, name="chat-export-copy", daemon=True)
+    copier.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        if copier.is_alive():
+            # The consumer gave up on the stream: cancel the copy and unblock it if it waits on the full queue
+            connection.cancel()
+        while copier.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    if failure:
+        raise failure[0]
+
+
+def json_default(value):
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.time)) else str(value)
+
+
+def export_jsonl_gz(connection, query, params):
+    """One JSON object per row, gzip-compressed as it is produced."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    buffer = bytearray()
+    for rows in iter_rows(connection, query, params):
+        for row in rows:
+            line = json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=json_default, ensure_ascii=False) + "\n"
+            buffer += compressor.compress(line.encode("utf-8"))
+        if len(buffer) >= EXPORT_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer = bytearray()
+    buffer += compressor.flush()
+    yield bytes(buffer)
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file collecting bytes until they are taken, for writers that need a file object."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        return data
+
+
+def export_parquet(connection, query, params):
+    """Parquet with one row group per batch (see iter_rows).
+
+    The schema follows the column types the query returns: timestamp
+    columns stay timestamps (timestamptz ones in UTC), everything else is
+    text. A row can therefore not fail to convert halfway through the
+    stream, e.g. a timestamp column stored as text is exported as text.
+    """
+    # pyarrow is only needed for Parquet exports
+    import pyarrow
+    import pyarrow.parquet
+
+    types = [pyarrow.timestamp("us") if type_code == TIMESTAMP_OID else
+             pyarrow.timestamp("us", tz="UTC") if type_code == TIMESTAMPTZ_OID else pyarrow.string()
+             for type_code in describe_query(connection, query, params)]
+    schema = pyarrow.schema(list(zip(EXPORT_COLUMNS, types)))
+    sink = ChunkSink()
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in iter_rows(connection, query, params):
+            columns = list(zip(*rows))
+            writer.write_table(pyarrow.table([
+                pyarrow.array(values if pyarrow.types.is_timestamp(arrow_type) else [to_text(value) for value in values],
+                              arrow_type)
+                for arrow_type, values in zip(types, columns)
+            ], schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+EXPORTERS = {"csv": export_csv, "jsonl.gz": export_jsonl_gz, "parquet": export_parquet}
+
+
+def export_chat_logs(export_format, start=None, end=None, email=None, data_source=None):
+    """Byte chunks of the chat_logs export; the connection is closed when the stream ends or is abandoned."""
+    query, params = build_export_query(start, end, email, data_source)
+    connection = get_db_connection()
+    try:
+        exported = 0
+        for chunk in EXPORTERS[export_format](connection, query, params):
+            if chunk:
+                exported += len(chunk)
+                yield chunk
+        logging.info(f"Exported {exported} bytes of chat_logs as {export_format}")
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--start", type=parse_date, help="first timestamp or date included")
+    parser.add_argument("--end", type=parse_date, help="first timestamp or date no longer included")
+    parser.add_argument("--email")
+    parser.add_argument("--data-source")
+    parser.add_argument("--output", default="-", help="file to write, - for stdout")
+    args = parser.parse_args()
+
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for chunk in export_chat_logs(args.format, args.start, args.end, args.email, args.data_source):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""One-off migration of the chat_logs additions, run once per deploy before the functions rely on them.
+
+The indexes are built with CREATE INDEX CONCURRENTLY, so chat writes carry
+on while they build; the functions themselves only apply the cheap
+CHAT_SCHEMA_STATEMENTS, and page without an index until it exists.
+
+    python chat_schema.py
+"""
+import os
+import logging
+import argparse
+import threading
+import psycopg2
+
+DB_CONFIG = {
+    "host": os.getenv("COSMOPG_HOST"),
+    "dbname": os.getenv("COSMOPG_DBNAME"),
+    "user": os.getenv("COSMOPG_USER"),
+    "password": os.getenv("COSMOPG_PASSWORD"),
+    "port": 5432
+}
+
+# Additions to the chat_logs table, applied by the functions that rely on them
+CHAT_SCHEMA_STATEMENTS = [
+    # Set on insert and by every write into an existing row, so a session's version is max(updated_at).
+    # Looked up first, as ALTER TABLE locks out readers of chat_logs even when the column exists.
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'chat_logs' AND column_name = 'updated_at') THEN
+            ALTER TABLE chat_logs ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT now();
+        END IF;
+    END $$
+    """,
+]
+
+# Indexes on chat_logs, by name, built by migrate_chat_schema only
+CHAT_INDEX_STATEMENTS = {
+    # Chat_Retrieve_function pages through a session by (timestamp, message_uuid)
+    "chat_logs_session_keyset_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_logs_session_keyset_idx
+        ON chat_logs (email, sessionid, timestamp, message_uuid)
+    """,
+}
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_chat_schema(connection):
+    """Apply CHAT_SCHEMA_STATEMENTS on connection and commit them, once per process."""
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        with connection.cursor() as cursor:
+            for statement in CHAT_SCHEMA_STATEMENTS:
+                cursor.execute(statement)
+        connection.commit()
+        _schema_ready = True
+
+
+def migrate_chat_schema(connection):
+    """Apply CHAT_SCHEMA_STATEMENTS and build the CHAT_INDEX_STATEMENTS indexes without blocking writes.
+
+    Switches connection to autocommit, as CONCURRENTLY cannot run in a
+    transaction. An index an interrupted build left invalid is dropped and
+    built again, since IF NOT EXISTS would keep it.
+    """
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        for statement in CHAT_SCHEMA_STATEMENTS:
+            cursor.execute(statement)
+        for name, statement in CHAT_INDEX_STATEMENTS.items():
+            cursor.execute("""
+                SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s
+            """, (name,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                logging.info(f"Dropping invalid index {name}")
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            logging.info(f"Building index {name} unless it exists")
+            cursor.execute(statement)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    connection = psycopg2.connect(**DB_CONFIG)
+    try:
+        migrate_chat_schema(connection)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Rolling per-session summaries kept in chat_logs.chat_summary.
+
+The chat_summary of a turn summarizes the session up to and including that
+turn. After UpdateChatlogsDB stores a turn it queues a summary request;
+ChatSummaryHandler.py folds the turns since the last summarized one into
+that summary, so every turn costs one short completion however long the
+session is, and follow-up prompts carry the summary plus the last turn.
+"""
+import os
+import time
+import logging
+import threading
+
+# Storage Queue the summary requests go through; "off" in CHAT_SUMMARIES stops queueing them
+SUMMARY_QUEUE_NAME = os.getenv('CHAT_SUMMARY_QUEUE_NAME', 'chat-summaries')
+CHAT_SUMMARIES = os.getenv('CHAT_SUMMARIES', 'on')
+# Deployment writing the summaries, and the length it may give them
+SUMMARY_DEPLOYMENT = os.getenv('SUMMARY_DEPLOYMENT', os.getenv('DEPLOYMENT'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '300'))
+# Characters of a query or answer passed to the summarizer
+SUMMARY_TURN_CHARS = 4000
+# Unsummarized turns folded in at once, should earlier summaries have been lost
+SUMMARY_MAX_TURNS = 10
+# Seconds a summary may take, queueing for the limiter included
+SUMMARY_DEADLINE_SECONDS = 60
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a user and a construction project assistant.
+Update the summary with the new turns. Keep the facts, document and project names, numbers and decisions
+the user may refer back to, and the question currently being discussed. Drop pleasantries and repetition.
+Answer with the updated summary only, in at most 150 words.
+"""
+
+_queue = None
+_queue_lock = threading.Lock()
+_client = None
+
+
+def get_summary_queue():
+    """StorageQueue of summary requests, created once per process."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            from work_queue import StorageQueue
+            _queue = StorageQueue(SUMMARY_QUEUE_NAME)
+        return _queue
+
+
+def request_summary(session_id, message_uuid):
+    """Queue the summary of a stored turn; a failure only costs the summary, not the turn."""
+    if CHAT_SUMMARIES == "off" or not session_id or not message_uuid:
+        return
+    try:
+        get_summary_queue().send({"sessionid": session_id, "message_uuid": message_uuid})
+    except Exception as e:
+        logging.warning(f"Could not queue the summary of {message_uuid}: {str(e)}")
+
+
+def get_client():
+    global _client
+    if _client is None:
+        # Only the summarizer needs the OpenAI client, not the apps queueing summaries
+        from openai import AzureOpenAI
+        _client = AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version=os.getenv("OPENAI_API_VERSION"),
+            max_retries=0
+        )
+    return _client
+
+
+def format_turns(turns):
+    return "\n\n".join(f"User: {(query or '')[:SUMMARY_TURN_CHARS]}\nAssistant: {(output or '')[:SUMMARY_TURN_CHARS]}"
+                       for query, output in turns)
+
+
+def summarize(previous_summary, turns):
+    """previous_summary (None at the start of a session) updated with turns, (input_query, output) pairs."""
+    from openai_limiter import complete
+
+    completion = complete(
+        get_client().chat.completions.create,
+        deadline=time.monotonic() + SUMMARY_DEADLINE_SECONDS,
+        model=SUMMARY_DEPLOYMENT,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        temperature=0,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Summary so far:\n{previous_summary or '(new conversation)'}\n\n"
+                                        f"New turns:\n{format_turns(turns)}"},
+        ]
+    )
+    return completion.choices[0].message.content.strip()
+
+
+def update_session_summary(connection, session_id, message_uuid):
+    """Write the rolling summary of the session up to message_uuid into its chat_summary.
+
+    Returns the summary, or None if there was nothing to do: the turn is
+    unknown or already summarized, or a later turn already has a summary
+    that took this one in (queue messages may arrive late or twice).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT message_uuid, input_query, output, chat_summary FROM chat_logs
+            WHERE sessionid = %s AND timestamp <= (SELECT timestamp FROM chat_logs WHERE message_uuid = %s)
+            ORDER BY timestamp DESC
+            LIMIT %s
+        """, (session_id, message_uuid, SUMMARY_MAX_TURNS + 1))
+        rows = cursor.fetchall()
+        if not rows or rows[0][0] != message_uuid or rows[0][3]:
+            return None
+        cursor.execute("""
+            SELECT 1 FROM chat_logs
+            WHERE sessionid = %s AND chat_summary IS NOT NULL
+              AND timestamp > (SELECT timestamp FROM chat_logs WHERE message_uuid = %s)
+            LIMIT 1
+        """, (session_id, message_uuid))
+        if cursor.fetchone():
+            return None
+
+    # Turns since the last summarized one, oldest first
+    previous_summary = None
+    turns = []
+    for _, input_query, output, chat_summary in rows:
+        if chat_summary:
+            previous_summary = chat_summary
+            break
+        turns.append((input_query, output))
+    turns = turns[:SUMMARY_MAX_TURNS][::-1]
+
+    summary = summarize(previous_summary, turns)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE chat_logs SET chat_summary = %s, updated_at = now()
+            WHERE message_uuid = %s AND chat_summary IS NULL
+        """, (summary, message_uuid))
+    connection.commit()
+    logging.info(f"Summarized {len(turns)} turns of session {session_id} into {len(summary)} characters")
+    return summary
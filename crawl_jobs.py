@@ -0,0 +1,326 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from psycopg2.extras import Json
+
+# Seconds an invocation crawls before it checkpoints and leaves the rest to the next trigger,
+# kept below the function timeout
+TIME_BUDGET_SECONDS = int(os.getenv('CRAWL_TIME_BUDGET_SECONDS', '480'))
+
+# Folder and item progress is written once this many changes are queued, or this often
+CHECKPOINT_SIZE = int(os.getenv('CRAWL_CHECKPOINT_SIZE', '200'))
+CHECKPOINT_INTERVAL = int(os.getenv('CRAWL_CHECKPOINT_INTERVAL', '30'))
+
+JOB_SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS crawl_job (
+        job_id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        full_crawl BOOLEAN NOT NULL DEFAULT false,
+        runs INTEGER NOT NULL DEFAULT 0,
+        started_at TIMESTAMP NOT NULL DEFAULT now(),
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        finished_at TIMESTAMP,
+        progress JSONB,
+        summary JSONB
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS crawl_job_resource (
+        job_id TEXT NOT NULL REFERENCES crawl_job ON DELETE CASCADE,
+        resource_key TEXT NOT NULL,
+        cursor TEXT,
+        done BOOLEAN NOT NULL DEFAULT false,
+        PRIMARY KEY (job_id, resource_key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS crawl_job_folder (
+        job_id TEXT NOT NULL REFERENCES crawl_job ON DELETE CASCADE,
+        resource_key TEXT NOT NULL,
+        folder_path TEXT NOT NULL,
+        done BOOLEAN NOT NULL DEFAULT false,
+        PRIMARY KEY (job_id, resource_key, folder_path)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS crawl_job_item (
+        job_id TEXT NOT NULL REFERENCES crawl_job ON DELETE CASCADE,
+        resource_key TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        PRIMARY KEY (job_id, resource_key, item_id)
+    )
+    """,
+]
+
+UNFINISHED_STATUSES = ("running", "paused")
+
+
+class CrawlJobRunning(Exception):
+    """Another invocation is already working on a crawl job of this kind."""
+
+
+class CrawlJob:
+    """A crawl that can span several invocations, checkpointed in PostgreSQL.
+
+    Each resource (a drive or a page list) records the cursor it resumes from
+    and whether it is done; a drive walk also records its pending folders and
+    the items it completed. Progress is queued in memory and written in
+    batches, always after the source_url rows it covers. Once the time budget
+    is spent the crawl stops taking on new work and the job is paused; the
+    next trigger of the same kind resumes it.
+    """
+
+    def __init__(self, store, job_id, kind, full_crawl=False, time_budget=TIME_BUDGET_SECONDS):
+        self.store = store
+        self.job_id = job_id
+        self.kind = kind
+        self.full_crawl = full_crawl
+        self.deadline = time.time() + time_budget
+        self.lock = threading.RLock()
+        self.folder_rows = {}
+        self.item_rows = set()
+        self.last_checkpoint = time.time()
+        # Callable returning the progress counters stored with every checkpoint
+        self.progress_source = None
+
+    @classmethod
+    def open(cls, store, kind, full_crawl=False, time_budget=TIME_BUDGET_SECONDS):
+        """Resume the unfinished job of this kind, or start a new one.
+
+        full_crawl abandons an unfinished job and starts a full one. Raises
+        CrawlJobRunning if another invocation holds the job.
+        """
+        for statement in JOB_SCHEMA_STATEMENTS:
+            store.execute(statement)
+
+        # Session lock, released when the store's connection closes
+        if not store.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"crawl_job:{kind}",), fetch=True)[0][0]:
+            raise CrawlJobRunning(f"A {kind} crawl is already running")
+
+        if full_crawl:
+            store.execute("""
+                UPDATE crawl_job SET status = 'abandoned', updated_at = now()
+                WHERE kind = %s AND status = ANY(%s)
+            """, (kind, list(UNFINISHED_STATUSES)))
+
+        unfinished = store.execute("""
+            SELECT job_id, full_crawl FROM crawl_job
+            WHERE kind = %s AND status = ANY(%s)
+            ORDER BY started_at DESC LIMIT 1
+        """, (kind, list(UNFINISHED_STATUSES)), fetch=True)
+        if unfinished:
+            job_id, full_crawl = unfinished[0]
+            logging.info(f"Resuming {kind} crawl job {job_id}")
+        else:
+            job_id = uuid.uuid4().hex
+            store.execute("INSERT INTO crawl_job (job_id, kind, status, full_crawl) VALUES (%s, %s, 'running', %s)",
+                          (job_id, kind, full_crawl))
+            logging.info(f"Started {kind} crawl job {job_id}")
+
+        # State of abandoned jobs is of no further use
+        for table in ("crawl_job_resource", "crawl_job_folder", "crawl_job_item"):
+            store.execute(f"""
+                DELETE FROM {table} WHERE job_id IN (SELECT job_id FROM crawl_job WHERE kind = %s AND status = 'abandoned')
+            """, (kind,))
+        store.execute("UPDATE crawl_job SET status = 'running', runs = runs + 1, updated_at = now() WHERE job_id = %s",
+                      (job_id,))
+        return cls(store, job_id, kind, full_crawl, time_budget)
+
+    def out_of_time(self):
+        return time.time() >= self.deadline
+
+    def get_resource(self, resource_key):
+        """(cursor, done) of a resource this job already started, or None."""
+        result = self.store.execute("SELECT cursor, done FROM crawl_job_resource WHERE job_id = %s AND resource_key = %s",
+                                    (self.job_id, resource_key), fetch=True)
+        return result[0] if result else None
+
+    def start_resource(self, resource_key, cursor=None, root_folder=None):
+        """Record that the job works on a resource, forgetting any earlier progress on it."""
+        with self.lock:
+            self.flush()
+            self.clear_resource_state(resource_key)
+            self.save_cursor(resource_key, cursor)
+            if root_folder is not None:
+                self.folders_found(resource_key, [root_folder])
+                self.flush()
+
+    def save_cursor(self, resource_key, cursor):
+        """Persist the point a resource resumes from, after the work done up to it."""
+        self.flush()
+        self.store.execute("""
+            INSERT INTO crawl_job_resource (job_id, resource_key, cursor)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (job_id, resource_key) DO UPDATE SET cursor = EXCLUDED.cursor, done = false;
+        """, (self.job_id, resource_key, cursor))
+
+    def finish_resource(self, resource_key):
+        """Mark a resource done; its folder and item progress is no longer needed."""
+        with self.lock:
+            self.flush()
+            self.clear_resource_state(resource_key)
+            self.store.execute("""
+                INSERT INTO crawl_job_resource (job_id, resource_key, done)
+                VALUES (%s, %s, true)
+                ON CONFLICT (job_id, resource_key) DO UPDATE SET done = true;
+            """, (self.job_id, resource_key))
+
+    def clear_resource_state(self, resource_key):
+        with self.lock:
+            self.folder_rows = {key: done for key, done in self.folder_rows.items() if key[0] != resource_key}
+            self.item_rows = {key for key in self.item_rows if key[0] != resource_key}
+            for table in ("crawl_job_folder", "crawl_job_item"):
+                self.store.execute(f"DELETE FROM {table} WHERE job_id = %s AND resource_key = %s", (self.job_id, resource_key))
+
+    def folder_states(self, resource_key):
+        """Folders of a drive walk found so far, mapped to whether they were completed."""
+        return dict(self.store.execute("""
+            SELECT folder_path, done FROM crawl_job_folder
+            WHERE job_id = %s AND resource_key = %s
+            ORDER BY folder_path
+        """, (self.job_id, resource_key), fetch=True))
+
+    def pending_folders(self, resource_key):
+        """Folders of a drive walk that were found but not completed."""
+        return [folder for folder, done in self.folder_states(resource_key).items() if not done]
+
+    def completed_items(self, resource_key):
+        """Ids of the items of a resource this job already completed."""
+        return {row[0] for row in self.store.execute(
+            "SELECT item_id FROM crawl_job_item WHERE job_id = %s AND resource_key = %s",
+            (self.job_id, resource_key), fetch=True)}
+
+    def folders_found(self, resource_key, folders):
+        with self.lock:
+            for folder in folders:
+                self.folder_rows.setdefault((resource_key, folder), False)
+            self.checkpoint()
+
+    def folder_done(self, resource_key, folder):
+        with self.lock:
+            self.folder_rows[(resource_key, folder)] = True
+            self.checkpoint()
+
+    def item_done(self, resource_key, item_id):
+        with self.lock:
+            self.item_rows.add((resource_key, item_id))
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Write the queued progress if enough of it piled up or the last write is old enough."""
+        with self.lock:
+            queued = len(self.folder_rows) + len(self.item_rows)
+            if queued >= CHECKPOINT_SIZE or time.time() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                self.flush()
+
+    def flush(self):
+        """Write the queued folder and item progress."""
+        with self.lock:
+            # Progress may only be recorded once the rows of the work it covers are stored
+            self.store.flush()
+            if self.folder_rows:
+                # A subfolder found and its parent completed land in the same statement
+                self.store.execute_batch("""
+                    INSERT INTO crawl_job_folder (job_id, resource_key, folder_path, done) VALUES %s
+                    ON CONFLICT (job_id, resource_key, folder_path)
+                    DO UPDATE SET done = crawl_job_folder.done OR EXCLUDED.done;
+                """, [(self.job_id, resource_key, folder, done) for (resource_key, folder), done in self.folder_rows.items()])
+            if self.item_rows:
+                self.store.execute_batch("""
+                    INSERT INTO crawl_job_item (job_id, resource_key, item_id) VALUES %s
+                    ON CONFLICT DO NOTHING;
+                """, [(self.job_id, resource_key, item_id) for resource_key, item_id in self.item_rows])
+            progress = self.progress_source() if self.progress_source else None
+            self.store.execute("UPDATE crawl_job SET updated_at = now(), progress = %s WHERE job_id = %s",
+                               (Json(progress), self.job_id))
+            self.folder_rows = {}
+            self.item_rows = set()
+            self.last_checkpoint = time.time()
+
+    def finish(self, summary=None):
+        """Checkpoint the run and pause the job if it ran out of time, otherwise complete it.
+
+        Returns the job status.
+        """
+        with self.lock:
+            self.flush()
+            status = "paused" if self.out_of_time() else "completed"
+            self.store.execute("""
+                UPDATE crawl_job SET status = %s, summary = %s, updated_at = now(),
+                                     finished_at = CASE WHEN %s = 'completed' THEN now() END
+                WHERE job_id = %s
+            """, (status, Json(summary), status, self.job_id))
+            if status == "completed":
+                self.store.execute("DELETE FROM crawl_job_resource WHERE job_id = %s", (self.job_id,))
+                for table in ("crawl_job_folder", "crawl_job_item"):
+                    self.store.execute(f"DELETE FROM {table} WHERE job_id = %s", (self.job_id,))
+            logging.info(f"{self.kind} crawl job {self.job_id} {status}")
+            return status
+
+    def checkpoint_for(self, resource_key, item_id):
+        """DriveCrawler checkpoint recording the walk of one resource."""
+        return ResourceCheckpoint(self, resource_key, item_id)
+
+
+class ResourceCheckpoint:
+    """Adapts a CrawlJob to the checkpoint hooks of DriveCrawler for one resource.
+
+    Folders and items completed by an earlier run of the job are skipped.
+    """
+
+    def __init__(self, job, resource_key, item_id):
+        self.job = job
+        self.resource_key = resource_key
+        self.item_id = item_id
+        self.done_folders = {folder for folder, done in job.folder_states(resource_key).items() if done}
+        self.done_items = job.completed_items(resource_key)
+
+    def folders_found(self, folders):
+        """Record newly found folders; returns the ones still to be walked."""
+        folders = [folder for folder in folders if folder not in self.done_folders]
+        self.job.folders_found(self.resource_key, folders)
+        return folders
+
+    def is_file_done(self, task):
+        return self.item_id(task) in self.done_items
+
+    def folder_done(self, folder):
+        self.job.folder_done(self.resource_key, folder)
+
+    def file_done(self, task):
+        self.job.item_done(self.resource_key, self.item_id(task))
+
+
+def get_job_status(store, kind, job_id=None):
+    """Status of a crawl job (the latest of its kind by default) with the size of its remaining work."""
+    if job_id:
+        rows = store.execute("""
+            SELECT job_id, kind, status, full_crawl, runs, started_at, updated_at, finished_at, progress, summary
+            FROM crawl_job WHERE job_id = %s
+        """, (job_id,), fetch=True)
+    else:
+        rows = store.execute("""
+            SELECT job_id, kind, status, full_crawl, runs, started_at, updated_at, finished_at, progress, summary
+            FROM crawl_job WHERE kind = %s ORDER BY started_at DESC LIMIT 1
+        """, (kind,), fetch=True)
+    if not rows:
+        return None
+
+    columns = ["job_id", "kind", "status", "full_crawl", "runs", "started_at", "updated_at", "finished_at", "progress", "summary"]
+    status = dict(zip(columns, rows[0]))
+    for column in ("started_at", "updated_at", "finished_at"):
+        status[column] = status[column].isoformat() if status[column] else None
+
+    counts = store.execute("""
+        SELECT
+            (SELECT count(*) FROM crawl_job_resource WHERE job_id = %(job_id)s AND done),
+            (SELECT count(*) FROM crawl_job_resource WHERE job_id = %(job_id)s AND NOT done),
+            (SELECT count(*) FROM crawl_job_folder WHERE job_id = %(job_id)s AND NOT done),
+            (SELECT count(*) FROM crawl_job_item WHERE job_id = %(job_id)s)
+    """, {"job_id": status["job_id"]}, fetch=True)[0]
+    status.update(zip(["resources_done", "resources_pending", "folders_pending", "items_completed"], counts))
+    return status
@@ -0,0 +1,114 @@
+import uuid
+from psycopg2.extras import Json
+
+SHARD_SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS crawl_shard (
+        run_id TEXT NOT NULL,
+        shard_id TEXT NOT NULL,
+        site_name TEXT NOT NULL,
+        drive_id TEXT NOT NULL,
+        message JSONB NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        result JSONB,
+        error TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT now(),
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (run_id, shard_id)
+    )
+    """,
+]
+
+# Counters of the shard results summed up for a run
+RESULT_COUNTERS = ["folders_listed", "items_seen", "files_done", "files_failed", "bytes_transferred"]
+
+
+def ensure_shard_schema(store):
+    for statement in SHARD_SCHEMA_STATEMENTS:
+        store.execute(statement)
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def make_shard(run_id, site_name, drive_id, mode, folder="", files_only=False, delta_link=None):
+    """Queue message for one shard of a fanned-out crawl.
+
+    mode "delta" applies a drive's changes from its stored delta link; mode
+    "walk" crawls folder and everything below it (only the files directly
+    in it with files_only), and delta_link is stored for the drive once all
+    of its walk shards are done.
+    """
+    return {
+        "run_id": run_id,
+        "shard_id": uuid.uuid4().hex,
+        "site": site_name,
+        "drive_id": drive_id,
+        "mode": mode,
+        "folder": folder,
+        "files_only": files_only,
+        "delta_link": delta_link,
+    }
+
+
+def record_shards(store, shards):
+    """Register shards before they are sent, so a run is only complete once they are done."""
+    if shards:
+        store.execute_batch("""
+            INSERT INTO crawl_shard (run_id, shard_id, site_name, drive_id, message) VALUES %s
+            ON CONFLICT DO NOTHING;
+        """, [(shard["run_id"], shard["shard_id"], shard["site"], shard["drive_id"], Json(shard)) for shard in shards])
+
+
+def start_shard(store, shard):
+    """Mark a shard running; returns False if it was already done, e.g. on a redelivered message."""
+    result = store.execute("""
+        UPDATE crawl_shard SET status = 'running', attempts = attempts + 1, updated_at = now()
+        WHERE run_id = %s AND shard_id = %s AND status <> 'done'
+        RETURNING shard_id;
+    """, (shard["run_id"], shard["shard_id"]), fetch=True)
+    return bool(result)
+
+
+def complete_shard(store, shard, result):
+    """Mark a shard done; returns whether every shard of its drive in the run is done."""
+    store.execute("""
+        UPDATE crawl_shard SET status = 'done', result = %s, error = NULL, updated_at = now()
+        WHERE run_id = %s AND shard_id = %s;
+    """, (Json(result), shard["run_id"], shard["shard_id"]))
+    remaining = store.execute("""
+        SELECT count(*) FROM crawl_shard WHERE run_id = %s AND drive_id = %s AND status <> 'done'
+    """, (shard["run_id"], shard["drive_id"]), fetch=True)
+    return remaining[0][0] == 0
+
+
+def fail_shard(store, shard, error):
+    store.execute("""
+        UPDATE crawl_shard SET status = 'failed', error = %s, updated_at = now()
+        WHERE run_id = %s AND shard_id = %s;
+    """, (str(error), shard["run_id"], shard["shard_id"]))
+
+
+def get_run_status(store, run_id):
+    """Aggregate the shards of a run: counts by status, summed results and failed shards."""
+    rows = store.execute("""
+        SELECT shard_id, site_name, drive_id, status, attempts, result, error FROM crawl_shard WHERE run_id = %s
+    """, (run_id,), fetch=True)
+    if not rows:
+        return None
+
+    status = {"run_id": run_id, "shards": len(rows), "by_status": {}, "totals": dict.fromkeys(RESULT_COUNTERS, 0),
+              "sites": {}, "failed": []}
+    for shard_id, site_name, drive_id, shard_status, attempts, result, error in rows:
+        status["by_status"][shard_status] = status["by_status"].get(shard_status, 0) + 1
+        site = status["sites"].setdefault(site_name, dict.fromkeys(RESULT_COUNTERS, 0))
+        for counter in RESULT_COUNTERS:
+            value = (result or {}).get(counter, 0)
+            status["totals"][counter] += value
+            site[counter] += value
+        if shard_status == "failed":
+            status["failed"].append({"shard_id": shard_id, "drive_id": drive_id, "attempts": attempts, "error": error})
+    status["complete"] = status["by_status"].get("done", 0) == len(rows)
+    return status
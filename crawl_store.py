@@ -0,0 +1,320 @@
+import os
+import logging
+import threading
+import psycopg2
+from psycopg2.extras import execute_values
+
+# PostgreSQL Configuration
+DB_CONFIG = {
+    "host": os.getenv("COSMOPG_HOST"),
+    "dbname": os.getenv("COSMOPG_DBNAME"),
+    "user": os.getenv("COSMOPG_USER"),
+    "password": os.getenv("COSMOPG_PASSWORD"),
+    "port": 5432
+}
+
+# Pending source_url rows are upserted once this many have been collected, and at the end of the run
+FLUSH_SIZE = int(os.getenv('CRAWL_DB_FLUSH_SIZE', '500'))
+
+SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS crawl_cursor (
+        resource_key TEXT PRIMARY KEY,
+        delta_link TEXT NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+    """,
+    "ALTER TABLE source_url ADD COLUMN IF NOT EXISTS item_id TEXT",
+    "CREATE INDEX IF NOT EXISTS source_url_item_id_idx ON source_url (item_id)",
+    "ALTER TABLE source_url ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    "ALTER TABLE source_url ADD COLUMN IF NOT EXISTS sidecar_blobname TEXT",
+]
+
+
+def get_db_connection():
+    try:
+        # Establish the connection to the database
+        connection = psycopg2.connect(**DB_CONFIG)
+        return connection
+    except Exception as e:
+        logging.error(f"Error while connecting to the database: {str(e)}")
+        raise e
+
+
+class CrawlStore:
+    """The PostgreSQL side of a crawl run, over one connection shared by all crawl threads.
+
+    source_url rows are collected as files are stored and upserted in batches;
+    close() flushes what is left and returns the run summary.
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection or get_db_connection()
+        self.lock = threading.RLock()
+        self.pending_rows = {}
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    def execute(self, query, params=None, fetch=False):
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(query, params)
+                result = cursor.fetchall() if fetch else None
+                self.connection.commit()
+                return result
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def execute_batch(self, query, rows):
+        """Run an execute_values statement for rows in one round trip."""
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                execute_values(cursor, query, rows, page_size=max(len(rows), 1))
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def ensure_schema(self):
+        """Create the crawler bookkeeping tables and columns if they are missing."""
+        for statement in SCHEMA_STATEMENTS:
+            self.execute(statement)
+
+    def add_source(self, filename, blob_name, sharepoint_url, item_id=None, content_hash=None, sidecar_blobname=None):
+        """Queue a source_url row (insert or update) for the next batch."""
+        with self.lock:
+            # filename is the conflict key, and a batch may only touch each row once
+            self.pending_rows[filename] = (filename, blob_name, sharepoint_url, item_id, content_hash, sidecar_blobname)
+            if len(self.pending_rows) >= FLUSH_SIZE:
+                self.flush()
+
+    def mark_unchanged(self, count=1):
+        with self.lock:
+            self.unchanged += count
+
+    def flush(self):
+        """Upsert the queued source_url rows in one statement."""
+        with self.lock:
+            if not self.pending_rows:
+                return
+            rows = list(self.pending_rows.values())
+            cursor = self.connection.cursor()
+            try:
+                # Rows that already hold the same values are left alone and not returned
+                results = execute_values(cursor, """
+                    INSERT INTO source_url (filename, blobname, sharepoint_url, item_id, content_hash, sidecar_blobname)
+                    VALUES %s
+                    ON CONFLICT (filename)
+                    DO UPDATE SET blobname = EXCLUDED.blobname, sharepoint_url = EXCLUDED.sharepoint_url,
+                                  item_id = EXCLUDED.item_id, content_hash = EXCLUDED.content_hash,
+                                  sidecar_blobname = EXCLUDED.sidecar_blobname
+                    WHERE (source_url.blobname, source_url.sharepoint_url, source_url.item_id, source_url.content_hash,
+                           source_url.sidecar_blobname)
+                          IS DISTINCT FROM (EXCLUDED.blobname, EXCLUDED.sharepoint_url, EXCLUDED.item_id, EXCLUDED.content_hash,
+                                            EXCLUDED.sidecar_blobname)
+                    RETURNING (xmax = 0);
+                """, rows, page_size=len(rows), fetch=True)
+                self.connection.commit()
+            except Exception as e:
+                self.connection.rollback()
+                logging.error(f"Error storing data in PostgreSQL: {e}")
+                raise
+            finally:
+                cursor.close()
+
+            inserted = sum(1 for (was_inserted,) in results if was_inserted)
+            self.inserted += inserted
+            self.updated += len(results) - inserted
+            self.unchanged += len(rows) - len(results)
+            self.pending_rows = {}
+            logging.info(f"Stored {len(rows)} source_url rows")
+
+    def summary(self):
+        with self.lock:
+            return {"inserted": self.inserted, "updated": self.updated, "unchanged": self.unchanged, "deleted": self.deleted}
+
+    def close(self):
+        """Flush the remaining rows, close the connection and return the run summary."""
+        try:
+            self.flush()
+            return self.summary()
+        finally:
+            self.connection.close()
+
+    def get_delta_link(self, resource_key):
+        """Return the stored delta link for a drive or list, or None if it was never crawled."""
+        result = self.execute("SELECT delta_link FROM crawl_cursor WHERE resource_key = %s", (resource_key,), fetch=True)
+        return result[0][0] if result else None
+
+    def save_delta_link(self, resource_key, delta_link):
+        """Persist the delta link to resume from on the next run."""
+        # The rows of the changes the cursor moves past must be stored first
+        self.flush()
+        self.execute("""
+            INSERT INTO crawl_cursor (resource_key, delta_link, updated_at)
+            VALUES (%s, %s, now())
+            ON CONFLICT (resource_key)
+            DO UPDATE SET delta_link = EXCLUDED.delta_link, updated_at = EXCLUDED.updated_at;
+        """, (resource_key, delta_link))
+
+    def clear_delta_link(self, resource_key):
+        """Forget the delta link so the next run does a full crawl."""
+        self.execute("DELETE FROM crawl_cursor WHERE resource_key = %s", (resource_key,))
+
+    def delete_source_by_item_id(self, item_id, keep_blobname=None):
+        """Delete the source_url rows of a SharePoint item.
+
+        Rows pointing at keep_blobname are left alone, which lets a moved or renamed
+        item drop its old blob without losing the new one. Returns the deleted
+        filenames and the blob names no other row still points at.
+        """
+        with self.lock:
+            # A queued row of this item has to reach the table before it can be deleted
+            if any(row[3] == item_id for row in self.pending_rows.values()):
+                self.flush()
+
+            deleted = self.execute("""
+                DELETE FROM source_url
+                WHERE item_id = %s AND blobname IS DISTINCT FROM %s
+                RETURNING filename, blobname;
+            """, (item_id, keep_blobname), fetch=True)
+            filenames = [row[0] for row in deleted]
+            blob_names = {row[1] for row in deleted}
+            self.deleted += len(deleted)
+
+            # Deduplicated files share a blob, which has to stay while anyone references it
+            return filenames, sorted(self.unreferenced_blobs(blob_names))
+
+    def unreferenced_blobs(self, blob_names, except_filename=None):
+        """The blob names no source_url row points at, stored or queued, not counting the row of except_filename."""
+        with self.lock:
+            # A queued row of a deduplicated file points at its blob before it reaches the table
+            blob_names = set(blob_names) - {row[1] for filename, row in self.pending_rows.items()
+                                            if filename != except_filename}
+            if blob_names:
+                still_referenced = self.execute("""
+                    SELECT DISTINCT blobname FROM source_url WHERE blobname = ANY(%s) AND filename IS DISTINCT FROM %s
+                """, (list(blob_names), except_filename), fetch=True)
+                blob_names -= {row[0] for row in still_referenced}
+            return blob_names
+
+    def set_sidecar(self, filename, sidecar_blobname):
+        """Record the text sidecar of a stored source that is otherwise unchanged."""
+        with self.lock:
+            if filename in self.pending_rows:
+                self.pending_rows[filename] = self.pending_rows[filename][:5] + (sidecar_blobname,)
+                return
+        self.execute("UPDATE source_url SET sidecar_blobname = %s WHERE filename = %s", (sidecar_blobname, filename))
+
+    def load_sharing_links(self):
+        """Sharing links already created for drive items, keyed by item id."""
+        return dict(self.execute("""
+            SELECT item_id, sharepoint_url FROM source_url
+            WHERE item_id IS NOT NULL AND sharepoint_url IS NOT NULL
+        """, fetch=True))
+
+    def load_content_index(self):
+        """Content hashes of the stored sources."""
+        return ContentIndex(self.execute("SELECT filename, blobname, content_hash, sidecar_blobname FROM source_url",
+                                         fetch=True))
+
+
+class ContentIndex:
+    """Content hashes of the stored sources, loaded once per crawl.
+
+    Lets the crawler skip content that has not changed since the last run and
+    store a file that appears in several drives only once, along with its
+    text sidecar. A blob holds one content: recording another hash for it
+    drops the old hash's entry, so nothing is deduplicated onto bytes that
+    were overwritten.
+    """
+
+    def __init__(self, rows=()):
+        self.lock = threading.Lock()
+        self.hash_by_filename = {}
+        self.blobname_by_filename = {}
+        self.blobname_by_hash = {}
+        self.hash_by_blobname = {}
+        self.filenames_by_blobname = {}
+        self.sidecar_by_blobname = {}
+        for filename, blob_name, content_hash, sidecar_blobname in rows:
+            self.record(filename, blob_name, content_hash, sidecar_blobname)
+
+    def is_unchanged(self, filename, content_hash):
+        with self.lock:
+            return content_hash is not None and self.hash_by_filename.get(filename) == content_hash
+
+    def find_duplicate(self, content_hash, blob_name):
+        """Blob already holding this content under another name, if any."""
+        with self.lock:
+            existing = self.blobname_by_hash.get(content_hash)
+            return existing if existing != blob_name else None
+
+    def get_blobname(self, filename):
+        with self.lock:
+            return self.blobname_by_filename.get(filename)
+
+    def is_shared(self, blob_name, filename):
+        """Whether a source other than filename points at blob_name."""
+        with self.lock:
+            return bool(self.filenames_by_blobname.get(blob_name, set()) - {filename})
+
+    def record(self, filename, blob_name, content_hash, sidecar_blobname=None):
+        with self.lock:
+            self.hash_by_filename[filename] = content_hash
+            previous_blob = self.blobname_by_filename.get(filename)
+            if previous_blob is not None and previous_blob != blob_name:
+                self.filenames_by_blobname.get(previous_blob, set()).discard(filename)
+            self.blobname_by_filename[filename] = blob_name
+            self.filenames_by_blobname.setdefault(blob_name, set()).add(filename)
+            if content_hash:
+                previous_hash = self.hash_by_blobname.get(blob_name)
+                if previous_hash != content_hash:
+                    self.forget_blob_hash(blob_name)
+                    self.hash_by_blobname[blob_name] = content_hash
+                self.blobname_by_hash.setdefault(content_hash, blob_name)
+            # An empty sidecar name marks content whose text could not be extracted
+            if sidecar_blobname is not None:
+                self.sidecar_by_blobname[blob_name] = sidecar_blobname
+
+    def get_sidecar(self, blob_name):
+        with self.lock:
+            return self.sidecar_by_blobname.get(blob_name)
+
+    def missing_sidecar(self, filename):
+        """Blob of a stored source that has no text sidecar yet, or None."""
+        with self.lock:
+            blob_name = self.blobname_by_filename.get(filename)
+            return blob_name if blob_name and blob_name not in self.sidecar_by_blobname else None
+
+    def record_sidecar(self, blob_name, sidecar_blobname):
+        with self.lock:
+            self.sidecar_by_blobname[blob_name] = sidecar_blobname
+
+    def forget(self, filenames, blob_names=()):
+        """Drop deleted rows, and hashes pointing at deleted blobs, from the index."""
+        with self.lock:
+            for filename in filenames:
+                self.hash_by_filename.pop(filename, None)
+                blob_name = self.blobname_by_filename.pop(filename, None)
+                self.filenames_by_blobname.get(blob_name, set()).discard(filename)
+            for blob_name in blob_names:
+                self.sidecar_by_blobname.pop(blob_name, None)
+                self.filenames_by_blobname.pop(blob_name, None)
+                self.forget_blob_hash(blob_name)
+                self.hash_by_blobname.pop(blob_name, None)
+
+    def forget_blob_hash(self, blob_name):
+        """Stop deduplicating onto blob_name with the content it held so far; called with the lock held."""
+        content_hash = self.hash_by_blobname.get(blob_name)
+        if content_hash and self.blobname_by_hash.get(content_hash) == blob_name:
+            del self.blobname_by_hash[content_hash]
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import logging
+import threading
+import requests
+
+# Header carrying the milliseconds a called function has left to answer in
+DEADLINE_HEADER = "X-Deadline-Ms"
+# Seconds allowed to open a connection to a downstream function
+CONNECT_TIMEOUT = float(os.getenv('DOWNSTREAM_CONNECT_TIMEOUT', '3'))
+# Consecutive failures that open a breaker, and seconds it stays open before a trial call
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+# Calls are not started with less time than this left
+MIN_CALL_SECONDS = 0.5
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class DownstreamError(Exception):
+    """A downstream function gave no answer, or answered with an error status."""
+
+    def __init__(self, name, message, retry_after=None):
+        super().__init__(f"{name}: {message}")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class DownstreamUnavailable(DownstreamError):
+    """The dependency failed, timed out or was not called; retry_after is a hint for our own caller."""
+
+
+class CircuitOpenError(DownstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(DownstreamUnavailable):
+    pass
+
+
+class Deadline:
+    """Point in time (time.monotonic()) by which a request must be answered."""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    @classmethod
+    def from_request(cls, req, default_seconds):
+        """Deadline of an incoming request: the budget its caller sent, if shorter than default_seconds."""
+        seconds = default_seconds
+        try:
+            seconds = min(seconds, float(req.headers.get(DEADLINE_HEADER)) / 1000)
+        except (TypeError, ValueError):
+            pass
+        return cls(seconds)
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+
+class CircuitBreaker:
+    """Fails calls to a dependency fast once it has failed failure_threshold times in a row.
+
+    After reset_seconds one trial call is let through (half-open); its success
+    closes the breaker again, its failure keeps it open for another period.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.counters = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """CircuitOpenError if the call should not be made."""
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.trial_running = False
+            if self.state == "open" or (self.state == "half_open" and self.trial_running):
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(self.name, "circuit breaker open", self.retry_after())
+            if self.state == "half_open":
+                self.trial_running = True
+            self.counters["calls"] += 1
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logging.info(f"Circuit breaker {self.name} closed")
+            self.state = "closed"
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.counters["failures"] += 1
+            self.trial_running = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.counters["opened"] += 1
+                    logging.warning(f"Circuit breaker {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def retry_after(self):
+        return max(1, round(self.reset_seconds - (time.monotonic() - self.opened_at)))
+
+    def snapshot(self):
+        with self.lock:
+            return {"state": self.state, "consecutive_failures": self.failures, **self.counters}
+
+
+def breaker(name):
+    """The process-wide breaker of a dependency, created on first use."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def breakers_snapshot():
+    with _breakers_lock:
+        return {name: circuit.snapshot() for name, circuit in sorted(_breakers.items())}
+
+
+def post_json(name, url, payload, deadline, max_seconds=None, reserve_seconds=0.0):
+    """POST payload to a downstream function behind the breaker of name, within deadline.
+
+    The call may take at most max_seconds and leaves reserve_seconds of the
+    deadline for the work after it; the time it may take is sent along in
+    the deadline header. Connection errors, timeouts, 429 and 5xx answers
+    count as failures of the dependency and raise DownstreamUnavailable;
+    other error statuses raise DownstreamError.
+    """
+    budget = deadline.remaining() - reserve_seconds
+    if max_seconds is not None:
+        budget = min(budget, max_seconds)
+    if budget < MIN_CALL_SECONDS:
+        raise DeadlineExceeded(name, "no time left for the call")
+    circuit = breaker(name)
+    circuit.before_call()
+
+    headers = {'Content-Type': 'application/json', DEADLINE_HEADER: str(int(budget * 1000))}
+    try:
+        response = requests.post(url, headers=headers, data=json.dumps(payload),
+                                 timeout=(min(CONNECT_TIMEOUT, budget), budget))
+    except requests.RequestException as e:
+        circuit.record_failure()
+        raise DownstreamUnavailable(name, f"{type(e).__name__}: {str(e)}") from e
+    if response.status_code == 429 or response.status_code >= 500:
+        circuit.record_failure()
+        raise DownstreamUnavailable(name, f"HTTP {response.status_code}", response.headers.get("Retry-After"))
+    circuit.record_success()
+    if response.status_code >= 400:
+        raise DownstreamError(name, f"HTTP {response.status_code}: {response.text[:200]}")
+    return response
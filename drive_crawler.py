@@ -0,0 +1,198 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from graph_client import rate_limited
+
+# Concurrency limits, listing and downloading are budgeted separately
+LIST_WORKERS = int(os.getenv('CRAWL_LIST_WORKERS', '4'))
+DOWNLOAD_WORKERS = int(os.getenv('CRAWL_DOWNLOAD_WORKERS', '8'))
+# Listing blocks once this many files are waiting for or in download
+MAX_PENDING_DOWNLOADS = int(os.getenv('CRAWL_MAX_PENDING_DOWNLOADS', '64'))
+PROGRESS_LOG_INTERVAL = 30
+
+
+class CrawlFailed(Exception):
+    pass
+
+
+class CrawlProgress:
+    """Thread-safe counters of a running crawl."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.folders_listed = 0
+        self.items_seen = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_transferred = 0
+        self.folder_queue_depth = 0
+        self.downloads_pending = 0
+        # Files left out by the filter policy, by reason
+        self.skipped = {}
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def add_skip(self, reason):
+        with self.lock:
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            return {
+                "elapsed_seconds": round(elapsed, 1),
+                "folders_listed": self.folders_listed,
+                "items_seen": self.items_seen,
+                "files_done": self.files_done,
+                "files_failed": self.files_failed,
+                "bytes_transferred": self.bytes_transferred,
+                "items_per_second": round(self.items_seen / elapsed, 2),
+                "files_per_second": round(self.files_done / elapsed, 2),
+                "bytes_per_second": round(self.bytes_transferred / elapsed, 1),
+                "folder_queue_depth": self.folder_queue_depth,
+                "downloads_pending": self.downloads_pending,
+                "skipped": dict(self.skipped),
+            }
+
+
+class DriveCrawler:
+    """Breadth-first folder crawler with bounded listing and download pools.
+
+    list_folder(folder) yields ("folder", child) and ("file", task) entries;
+    handle_file(task) downloads one file and returns the number of bytes moved.
+    Graph requests made by either are charged to rate_limiter, if given.
+
+    An optional checkpoint is told about the walk as it goes:
+    folders_found(folders) returns the ones still to walk, folder_done(folder)
+    follows once a folder is listed and all of its files are handled,
+    file_done(task) follows each handled file, and is_file_done(task) lets
+    files completed by an earlier run be skipped.
+
+    Folders that fail to list and files that fail to be handled are kept in
+    failed_folders and failed_files; raise_failures() raises once any did.
+    """
+
+    def __init__(self, list_folder, handle_file, progress=None, list_workers=LIST_WORKERS,
+                 download_workers=DOWNLOAD_WORKERS, max_pending_downloads=MAX_PENDING_DOWNLOADS, rate_limiter=None,
+                 checkpoint=None):
+        self.list_folder = list_folder
+        self.handle_file = handle_file
+        self.progress = progress or CrawlProgress()
+        self.rate_limiter = rate_limiter
+        self.checkpoint = checkpoint
+        # Work still open per folder: its listing plus its files not yet handled
+        self.open_work = {}
+        self.open_work_lock = threading.Lock()
+        self.list_workers = list_workers
+        self.download_workers = download_workers
+        self.download_slots = threading.BoundedSemaphore(max_pending_downloads)
+        self.pending_folders = deque()
+        self.failed_folders = []
+        self.failed_files = []
+        self.download_pool = None
+
+    def crawl(self, roots, deadline=None):
+        """Walk every folder reachable from roots and wait for all downloads to finish.
+
+        No folder is started after deadline (a time.time() value); the folders
+        left over stay in pending_folders.
+        """
+        self.pending_folders.extend(roots)
+        last_log = time.time()
+
+        with ThreadPoolExecutor(self.download_workers, thread_name_prefix="crawl-download") as download_pool, \
+                ThreadPoolExecutor(self.list_workers, thread_name_prefix="crawl-list") as list_pool:
+            self.download_pool = download_pool
+            running = set()
+
+            while running or (self.pending_folders and not self.past(deadline)):
+                while self.pending_folders and len(running) < self.list_workers and not self.past(deadline):
+                    running.add(list_pool.submit(self.list_one, self.pending_folders.popleft()))
+                self.progress.folder_queue_depth = len(self.pending_folders)
+
+                done, running = wait(running, timeout=PROGRESS_LOG_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.pending_folders.extend(future.result())
+
+                if time.time() - last_log >= PROGRESS_LOG_INTERVAL:
+                    logging.info(f"Crawl progress: {self.progress.snapshot()}")
+                    last_log = time.time()
+
+            self.progress.folder_queue_depth = len(self.pending_folders)
+        return self.progress.snapshot()
+
+    def raise_failures(self):
+        """Raise the error of the first failed folder, or CrawlFailed if any file failed."""
+        for _, error in self.failed_folders:
+            raise error
+        if self.failed_files:
+            _, error = self.failed_files[0]
+            raise CrawlFailed(f"{len(self.failed_files)} files failed, the first with: {error}")
+
+    @staticmethod
+    def past(deadline):
+        return deadline is not None and time.time() >= deadline
+
+    def list_one(self, folder):
+        """List one folder, queueing its files for download; returns its subfolders."""
+        subfolders = []
+        with self.open_work_lock:
+            self.open_work[folder] = 1
+        try:
+            with rate_limited(self.rate_limiter):
+                for kind, value in self.list_folder(folder):
+                    self.progress.add(items_seen=1)
+                    if kind == "folder":
+                        subfolders.append(value)
+                    elif not (self.checkpoint and self.checkpoint.is_file_done(value)):
+                        self.submit_file(folder, value)
+            if self.checkpoint:
+                subfolders = self.checkpoint.folders_found(subfolders)
+            self.close_work(folder)
+        except Exception as e:
+            logging.info(f"Failed to list folder {folder}: {e}")
+            self.failed_folders.append((folder, e))
+        self.progress.add(folders_listed=1)
+        return subfolders
+
+    def close_work(self, folder):
+        """Close one unit of a folder's work, checkpointing the folder once none is left."""
+        with self.open_work_lock:
+            self.open_work[folder] -= 1
+            if self.open_work[folder]:
+                return
+            del self.open_work[folder]
+        if self.checkpoint:
+            self.checkpoint.folder_done(folder)
+
+    def submit_file(self, folder, task):
+        # Blocks the listing thread while the download pool is saturated
+        self.download_slots.acquire()
+        self.progress.add(downloads_pending=1)
+        with self.open_work_lock:
+            self.open_work[folder] += 1
+        self.download_pool.submit(self.download_one, folder, task)
+
+    def download_one(self, folder, task):
+        try:
+            with rate_limited(self.rate_limiter):
+                transferred = self.handle_file(task) or 0
+            self.progress.add(files_done=1, bytes_transferred=transferred)
+            if self.checkpoint:
+                self.checkpoint.file_done(task)
+            # A failed file keeps its folder open, so a resumed job lists the folder again
+            self.close_work(folder)
+        except Exception as e:
+            self.progress.add(files_failed=1)
+            self.failed_files.append((task, e))
+            logging.info(f"Failed to process file {task}: {e}")
+        finally:
+            self.progress.add(downloads_pending=-1)
+            self.download_slots.release()
@@ -0,0 +1,73 @@
+import os
+import re
+import time
+import fnmatch
+import calendar
+
+
+def compile_alternation(patterns, flags=re.IGNORECASE):
+    """One regex matching any of patterns, or None if there are none."""
+    return re.compile("|".join(f"(?:{pattern})" for pattern in patterns), flags) if patterns else None
+
+
+def glob_to_regex(glob):
+    return f"^{fnmatch.translate(glob)}"
+
+
+def parse_graph_timestamp(timestamp):
+    """Seconds since the epoch of a Graph timestamp such as 2024-03-01T12:30:00.123Z (always UTC)."""
+    return calendar.timegm(time.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+class FilterPolicy:
+    """Exclusion rules of a site, compiled once and checked against Graph item metadata.
+
+    Rules (all optional): extensions, keywords (matched in file and folder
+    names), paths (globs on folder/name), patterns (regexes on folder/name),
+    mime_types (globs such as video/*), max_size_mb, max_age_days on
+    lastModifiedDateTime, and urls / url_patterns for pages. Everything is
+    decided from the listing, before a file is downloaded.
+    """
+
+    def __init__(self, rules=None):
+        rules = rules or {}
+        self.extensions = frozenset(extension.lower() for extension in rules.get("extensions", []))
+        self.keyword_regex = compile_alternation([re.escape(keyword) for keyword in rules.get("keywords", [])])
+        self.path_regex = compile_alternation([glob_to_regex(glob) for glob in rules.get("paths", [])] +
+                                              list(rules.get("patterns", [])))
+        self.mime_regex = compile_alternation([glob_to_regex(glob) for glob in rules.get("mime_types", [])])
+        self.max_size = int(rules["max_size_mb"] * 1024 * 1024) if rules.get("max_size_mb") else None
+        self.max_age = rules["max_age_days"] * 86400 if rules.get("max_age_days") else None
+        self.urls = frozenset(rules.get("urls", []))
+        self.url_regex = compile_alternation([glob_to_regex(glob) for glob in rules.get("url_patterns", [])], 0)
+
+    def skip_reason(self, item, folder_path=""):
+        """Why a drive item is excluded, or None if it is not. The cheapest checks run first."""
+        name = item.get("name", "")
+        if os.path.splitext(name)[1].lower() in self.extensions:
+            return "extension"
+
+        size = item.get("size")
+        if self.max_size and size and size > self.max_size:
+            return "size"
+
+        mime_type = item.get("file", {}).get("mimeType")
+        if self.mime_regex and mime_type and self.mime_regex.search(mime_type):
+            return "mime_type"
+
+        modified = item.get("lastModifiedDateTime")
+        if self.max_age and modified and time.time() - parse_graph_timestamp(modified) > self.max_age:
+            return "age"
+
+        if self.keyword_regex and (self.keyword_regex.search(name) or self.keyword_regex.search(folder_path)):
+            return "keyword"
+
+        if self.path_regex and self.path_regex.search(f"{folder_path}/{name}".strip("/")):
+            return "path"
+        return None
+
+    def url_skip_reason(self, url):
+        """Why a page URL is excluded, or None if it is not."""
+        if url in self.urls or (self.url_regex and url and self.url_regex.search(url)):
+            return "url"
+        return None
@@ -0,0 +1,307 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from msal import ConfidentialClientApplication
+
+# Azure AD credentials
+CLIENT_ID = os.getenv('AD_CLIENT_id')
+CLIENT_SECRET = os.getenv('AD_CLIENT_SECRET')
+TENANT_ID = os.getenv('TENANT_ID')
+
+AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
+SCOPE = ["https://graph.microsoft.com/.default"]
+# Overridable to point the crawlers at a local stand-in, see benchmarks/mock_graph.py
+GRAPH_BASE_URL = os.getenv('GRAPH_BASE_URL', "https://graph.microsoft.com/v1.0")
+# Token sent instead of acquiring one from Azure AD, for stand-ins only
+GRAPH_STATIC_TOKEN = os.getenv('GRAPH_STATIC_TOKEN')
+
+# Refresh the token this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN = 300
+
+# Graph signals throttling with 429 (and sometimes 503) plus a Retry-After header
+THROTTLE_STATUS_CODES = (429, 503)
+MAX_THROTTLE_RETRIES = 6
+MAX_BACKOFF_SECONDS = 60
+
+# Graph accepts at most 20 sub-requests per $batch
+BATCH_LIMIT = 20
+
+# Default $top for paged collections
+PAGE_SIZE = int(os.getenv('GRAPH_PAGE_SIZE', '200'))
+
+# Connection pool shared by every thread of the crawl
+POOL_SIZE = int(os.getenv('GRAPH_POOL_SIZE', '32'))
+
+_msal_app = None
+_access_token = None
+_token_expiry = 0
+_token_lock = threading.Lock()
+
+# Rate limiter the current thread's Graph requests are charged to, see rate_limited()
+_local = threading.local()
+
+session = requests.Session()
+# Graph API calls wait out throttling in graph_request, where the wait is charged to their rate limiter
+retries = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 504])
+adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retries)
+# Everything else, e.g. file content streamed from a downloadUrl, is retried on throttling here, after its Retry-After
+download_retries = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 504, *THROTTLE_STATUS_CODES],
+                         respect_retry_after_header=True)
+download_adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=download_retries)
+session.mount("https://", download_adapter)
+session.mount("http://", download_adapter)
+session.mount(GRAPH_BASE_URL, adapter)
+
+
+def get_access_token():
+    """Return a cached Graph access token, acquiring a new one shortly before it expires."""
+    global _msal_app, _access_token, _token_expiry
+    if GRAPH_STATIC_TOKEN:
+        return GRAPH_STATIC_TOKEN
+    with _token_lock:
+        if _access_token is None or time.time() > _token_expiry - TOKEN_REFRESH_MARGIN:
+            if _msal_app is None:
+                _msal_app = ConfidentialClientApplication(CLIENT_ID, authority=AUTHORITY, client_credential=CLIENT_SECRET)
+            result = _msal_app.acquire_token_for_client(scopes=SCOPE)
+
+            if "access_token" not in result:
+                raise Exception(f"Failed to acquire access token: {result.get('error_description')}")
+
+            _access_token = result["access_token"]
+            _token_expiry = time.time() + int(result.get("expires_in", 3600))
+            logging.info(f"Acquired Graph access token, expires in {result.get('expires_in')}s")
+        return _access_token
+
+
+def invalidate_access_token():
+    """Drop the cached token so the next call acquires a fresh one."""
+    global _access_token
+    with _token_lock:
+        _access_token = None
+
+
+class RateLimiter:
+    """Token bucket capping the Graph request rate of one crawl scope, such as a site.
+
+    A $batch is charged one token per sub-request, as Graph counts them. After
+    a throttled response the whole scope waits out the Retry-After, not just
+    the thread that got it.
+    """
+
+    def __init__(self, requests_per_second, burst=None):
+        self.rate = float(requests_per_second)
+        self.capacity = float(burst or max(self.rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        """Block until cost requests may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # A cost above the bucket size goes through once the bucket is full, leaving a debt
+                needed = min(cost, self.capacity)
+                if now >= self.paused_until and self.tokens >= needed:
+                    self.tokens -= cost
+                    return
+                delay = max(self.paused_until - now, (needed - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Hold back every request of this scope for the given time."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+@contextmanager
+def rate_limited(limiter):
+    """Charge the Graph requests the current thread sends in this block to limiter."""
+    previous = getattr(_local, "limiter", None)
+    _local.limiter = limiter
+    try:
+        yield limiter
+    finally:
+        _local.limiter = previous
+
+
+def get_retry_after(headers, attempt):
+    """Seconds to wait before retrying a throttled response."""
+    retry_after = next((value for name, value in (headers or {}).items() if name.lower() == "retry-after"), None)
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), MAX_BACKOFF_SECONDS)
+        except ValueError:
+            pass
+    return min(2 ** attempt, MAX_BACKOFF_SECONDS)
+
+
+def graph_request(method, url, headers=None, timeout=30, cost=1, **kwargs):
+    """Send an authenticated Graph request, waiting out throttling and refreshing an expired token.
+
+    cost is the number of requests charged to the rate limiter bound by rate_limited().
+    """
+    if not url.startswith("http"):
+        url = f"{GRAPH_BASE_URL}/{url.lstrip('/')}"
+
+    limiter = getattr(_local, "limiter", None)
+    token_refreshed = False
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        if limiter:
+            limiter.acquire(cost)
+        request_headers = {"Authorization": f"Bearer {get_access_token()}", "Accept": "application/json"}
+        request_headers.update(headers or {})
+        response = session.request(method, url, headers=request_headers, timeout=timeout, **kwargs)
+
+        if response.status_code in THROTTLE_STATUS_CODES and attempt < MAX_THROTTLE_RETRIES:
+            delay = get_retry_after(response.headers, attempt)
+            logging.info(f"Throttled ({response.status_code}) on {url}, retrying in {delay}s")
+            if limiter:
+                limiter.pause(delay)
+            time.sleep(delay)
+            continue
+
+        if response.status_code == 401 and not token_refreshed:
+            invalidate_access_token()
+            token_refreshed = True
+            continue
+
+        return response
+    return response
+
+
+def graph_get(url, **kwargs):
+    """GET a Graph resource."""
+    return graph_request("GET", url, **kwargs)
+
+
+def graph_post(url, **kwargs):
+    """POST to a Graph resource."""
+    return graph_request("POST", url, **kwargs)
+
+
+def graph_batch(sub_requests):
+    """Send requests through JSON $batch, 20 per round trip.
+
+    Each sub-request is a dict with method, url (relative to the Graph root)
+    and optionally body and headers. Throttled sub-requests are retried on
+    their own after their Retry-After. Returns the sub-responses (status,
+    headers, body) in the order of sub_requests.
+    """
+    results = [None] * len(sub_requests)
+    pending = list(range(len(sub_requests)))
+
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        throttled = []
+        delay = 0
+        for start in range(0, len(pending), BATCH_LIMIT):
+            chunk = pending[start:start + BATCH_LIMIT]
+            payload = {"requests": [
+                dict(sub_requests[index], id=str(index), url=f"/{sub_requests[index]['url'].lstrip('/')}")
+                for index in chunk
+            ]}
+            response = graph_post("$batch", json=payload, cost=len(chunk))
+            if response.status_code != 200:
+                raise Exception(f"Batch request failed with {response.status_code}: {response.text}")
+
+            for sub_response in response.json().get("responses", []):
+                index = int(sub_response["id"])
+                if sub_response.get("status") in THROTTLE_STATUS_CODES and attempt < MAX_THROTTLE_RETRIES:
+                    throttled.append(index)
+                    delay = max(delay, get_retry_after(sub_response.get("headers"), attempt))
+                else:
+                    results[index] = sub_response
+
+        if not throttled:
+            break
+        logging.info(f"{len(throttled)} batched requests throttled, retrying in {delay}s")
+        limiter = getattr(_local, "limiter", None)
+        if limiter:
+            limiter.pause(delay)
+        time.sleep(delay)
+        pending = sorted(throttled)
+    return results
+
+
+class DeltaResyncRequired(Exception):
+    """The stored delta link has expired and the resource must be crawled in full."""
+
+
+def collection_params(select=None, top=None, params=None):
+    """Build the query parameters for a projected, paged collection request."""
+    params = dict(params or {})
+    if select:
+        params["$select"] = select if isinstance(select, str) else ",".join(select)
+    if top:
+        params["$top"] = top
+    return params or None
+
+
+def iter_pages(url, params=None):
+    """Yield the pages of a Graph collection one at a time, following @odata.nextLink."""
+    while url:
+        response = graph_get(url, params=params)
+        # Graph answers 410 Gone when a delta token can no longer be resumed
+        if response.status_code == 410:
+            raise DeltaResyncRequired(f"Delta link expired for {url}")
+        if response.status_code != 200:
+            raise Exception(f"Graph request failed with {response.status_code}: {response.text}")
+
+        page = response.json()
+        yield page
+        # The next link already carries the original query parameters
+        url = page.get("@odata.nextLink")
+        params = None
+
+
+def iter_collection(url, select=None, top=PAGE_SIZE, params=None):
+    """Yield the items of a Graph collection as their pages arrive, in constant memory."""
+    for page in iter_pages(url, collection_params(select, top, params)):
+        yield from page.get("value", [])
+
+
+class DeltaQuery:
+    """Iterate the items of a Graph delta query across all of its pages.
+
+    After the iteration completes, delta_link holds the link to resume from
+    on the next run. select only applies to a fresh query, a stored delta
+    link (or next link) keeps the projection it was created with.
+    """
+
+    def __init__(self, url, select=None):
+        self.url = url
+        self.params = None if "token=" in url else collection_params(select)
+        self.next_link = None
+        self.delta_link = None
+
+    def __iter__(self):
+        for items in self.pages():
+            yield from items
+
+    def pages(self):
+        """Yield the items page by page.
+
+        While a page is being handled, next_link points at the page after it,
+        which a query interrupted after the page can be resumed from.
+        """
+        for page in iter_pages(self.url, self.params):
+            self.next_link = page.get("@odata.nextLink")
+            yield page.get("value", [])
+            if "@odata.deltaLink" in page:
+                self.delta_link = page["@odata.deltaLink"]
+
+
+def get_latest_delta_link(url, select=None):
+    """Return a delta link pointing at the current state, without listing any items."""
+    response = graph_get(url, params=collection_params(select, params={"token": "latest"}))
+    if response.status_code != 200:
+        raise Exception(f"Failed to fetch latest delta link for {url}: {response.text}")
+    return response.json().get("@odata.deltaLink")
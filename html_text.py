@@ -0,0 +1,142 @@
+from html.parser import HTMLParser
+
+# Tags that start and end a line of output
+BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "li", "br", "table", "tr", "section", "article", "blockquote"}
+CELL_TAGS = {"td", "th"}
+SKIP_TAGS = {"script", "style"}
+
+
+class HtmlTextConverter(HTMLParser):
+    """Single-pass HTML to text conversion.
+
+    Every text node is emitted exactly once: block elements break lines, links
+    become [text](href) in place, and table rows become cells joined by " | ".
+    Cells and rows whose end tag the markup omits are closed as browsers do,
+    by the next cell or row of the same table.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self.parts = []
+        # (href, parts before the link, cell depth) of every open link
+        self.links = []
+        # (cells, cell depth, table depth) of every open row
+        self.rows = []
+        self.outer_parts = []
+        self.table_depth = 0
+        self.skip_depth = 0
+
+    def flush_line(self):
+        line = " ".join("".join(self.parts).split())
+        if line:
+            self.lines.append(line)
+        self.parts = []
+
+    def in_line(self):
+        # Cells and links are a single line, so blocks inside them only separate words
+        return bool(self.outer_parts or self.links)
+
+    def break_line(self):
+        if self.in_line():
+            self.parts.append(" ")
+        else:
+            self.flush_line()
+
+    def end_link(self):
+        href, outer, depth = self.links.pop()
+        text = " ".join("".join(self.parts).split())
+        self.parts = outer
+        self.parts.append(f" [{text}]({href}) ")
+
+    def end_cell(self):
+        # Links and rows the markup left open inside the cell end with it
+        depth = len(self.outer_parts)
+        while self.links and self.links[-1][2] == depth:
+            self.end_link()
+        while self.rows and self.rows[-1][1] == depth:
+            self.end_row()
+        cell = " ".join("".join(self.parts).split())
+        self.parts = self.outer_parts.pop()
+        if self.rows:
+            self.rows[-1][0].append(cell)
+
+    def end_row(self):
+        cells, depth, table_depth = self.rows[-1]
+        while len(self.outer_parts) > depth:
+            self.end_cell()
+        self.rows.pop()
+        if any(cells):
+            # A table nested in a cell stays inside that cell
+            if self.in_line():
+                self.parts.append(f" {' | '.join(cells)} ")
+            else:
+                self.lines.append(" | ".join(cells))
+
+    def in_open_row(self):
+        """Whether the innermost open row belongs to the innermost open table."""
+        return bool(self.rows) and self.rows[-1][2] == self.table_depth
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == "a":
+            self.links.append((dict(attrs).get("href") or "", self.parts, len(self.outer_parts)))
+            self.parts = []
+        elif tag in CELL_TAGS:
+            if self.in_open_row():
+                while len(self.outer_parts) > self.rows[-1][1]:
+                    self.end_cell()
+            self.outer_parts.append(self.parts)
+            self.parts = []
+        elif tag == "tr":
+            if self.in_open_row():
+                self.end_row()
+            self.break_line()
+            self.rows.append(([], len(self.outer_parts), self.table_depth))
+        elif tag == "table":
+            self.break_line()
+            self.table_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.break_line()
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag == "a" and self.links and self.links[-1][2] == len(self.outer_parts):
+            self.end_link()
+        elif tag in CELL_TAGS and self.outer_parts:
+            self.end_cell()
+        elif tag == "tr" and self.rows:
+            self.end_row()
+        elif tag == "table":
+            while self.in_open_row():
+                self.end_row()
+            self.table_depth = max(self.table_depth - 1, 0)
+            self.break_line()
+        elif tag in BLOCK_TAGS:
+            self.break_line()
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def convert(self, html_content):
+        self.feed(html_content)
+        self.close()
+        # Close whatever the markup left open
+        while self.rows:
+            self.end_row()
+        while self.outer_parts:
+            self.end_cell()
+        while self.links:
+            self.end_link()
+        self.flush_line()
+        return "\n".join(self.lines)
+
+
+def html_to_text(html_content):
+    """Convert web part HTML to readable text in one pass over the markup."""
+    if not html_content:
+        return ""
+    return HtmlTextConverter().convert(html_content)
@@ -0,0 +1,85 @@
+import gzip
+import json
+import hashlib
+import azure.functions as func
+
+try:
+    # brotli is optional; without it responses are gzip-compressed only
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are sent uncompressed, compression would not pay for itself
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# The client must revalidate every time, but may keep the body to revalidate with
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts):
+    """Weak ETag of the values a response depends on.
+
+    Weak, as the same representation is sent with different content encodings.
+    """
+    digest = hashlib.sha1(json.dumps(parts, default=str).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(req, etag):
+    """Whether the If-None-Match header of req names etag (weak comparison)."""
+    header = req.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any((tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip()) == opaque
+               for tag in header.split(","))
+
+
+def not_modified(etag):
+    return func.HttpResponse(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL,
+                                                       "Vary": "Accept-Encoding"})
+
+
+def choose_encoding(accept_encoding):
+    """br or gzip, whichever the client accepts and prefers (br on a tie), or None."""
+    accepted = {}
+    for entry in (accept_encoding or "").split(","):
+        coding, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+    candidates = [coding for coding in ("br", "gzip") if coding != "br" or brotli is not None]
+    ranked = [(accepted.get(coding, accepted.get("*", 0.0)), -index, coding) for index, coding in enumerate(candidates)]
+    quality, _, coding = max(ranked)
+    return coding if quality > 0 else None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def json_response(req, payload, etag=None, headers=None, status_code=200):
+    """JSON response compressed as the client accepts, carrying etag for conditional requests."""
+    body = json.dumps(payload).encode("utf-8")
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if etag:
+        headers["ETag"] = etag
+        headers["Cache-Control"] = CACHE_CONTROL
+    encoding = choose_encoding(req.headers.get("Accept-Encoding")) if len(body) >= MIN_COMPRESS_BYTES else None
+    if encoding:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return func.HttpResponse(body, status_code=status_code, mimetype="application/json", headers=headers)
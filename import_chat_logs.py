@@ -0,0 +1,271 @@
+"""Bulk import of legacy chat logs exported from DynamoDB (see results.csv) into chat_logs.
+
+Cells may hold DynamoDB attribute values ([{"S":"N"}], [{"M":{"name":{"S":...}}}]),
+JSON or CSV-quoted strings; they are decoded and the columns renamed to the
+chat_logs schema of UpdateChatlogsDB.store_object_in_db. Batches are
+normalized and COPYed by parallel worker processes, each with its own
+connection, through a staging table, so re-running an import skips the
+messages already stored (by message_uuid).
+
+    python import_chat_logs.py results.csv --workers 4 --batch-size 20000 [--dry-run]
+"""
+import os
+import io
+import csv
+import sys
+import json
+import time
+import base64
+import logging
+import argparse
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import psycopg2
+from chat_export import EXPORT_COLUMNS as CHAT_LOG_COLUMNS
+from chat_schema import migrate_chat_schema
+
+DB_CONFIG = {
+    "host": os.getenv("COSMOPG_HOST"),
+    "dbname": os.getenv("COSMOPG_DBNAME"),
+    "user": os.getenv("COSMOPG_USER"),
+    "password": os.getenv("COSMOPG_PASSWORD"),
+    "port": 5432
+}
+
+# Legacy export columns that are named differently in chat_logs
+COLUMN_RENAMES = {"Data_source": "data_source", "Input_query": "input_query", "sessionId": "sessionid"}
+# Keys of the legacy source entries that are named differently in the sources the chat stores now
+SOURCE_KEY_RENAMES = {"name": "title", "uri": "url"}
+
+DYNAMODB_TYPES = {"S", "N", "B", "BOOL", "NULL", "M", "L", "SS", "NS", "BS"}
+TRUE_VALUES = {"y", "yes", "true", "t", "1"}
+FALSE_VALUES = {"n", "no", "false", "f", "0"}
+
+# Batches queued per worker beyond the one it is working on, bounding memory on large files
+PENDING_BATCHES_PER_WORKER = 2
+
+STAGING_TABLE = "chat_logs_import"
+
+_connection = None
+
+
+def decode_attribute(attribute):
+    """Python value of a DynamoDB attribute value such as {"S": "text"} or {"M": {...}}."""
+    (attribute_type, value), = attribute.items()
+    if attribute_type == "S":
+        return value
+    if attribute_type == "N":
+        number = Decimal(value)
+        return int(number) if number == number.to_integral_value() else float(number)
+    if attribute_type == "BOOL":
+        return bool(value)
+    if attribute_type == "NULL":
+        return None
+    if attribute_type == "M":
+        return {key: decode_attribute(item) for key, item in value.items()}
+    if attribute_type == "L":
+        return [decode_attribute(item) for item in value]
+    if attribute_type == "NS":
+        return [decode_attribute({"N": item}) for item in value]
+    if attribute_type == "B":
+        return base64.b64decode(value).decode("utf-8", errors="replace")
+    # SS and BS
+    return list(value)
+
+
+def is_attribute(value):
+    return isinstance(value, dict) and len(value) == 1 and next(iter(value)) in DYNAMODB_TYPES
+
+
+def decode_cell(text):
+    """Value of an exported cell: "" is None, DynamoDB attribute values and quoted strings are decoded."""
+    if text == "":
+        return None
+    if text[:2] in ('{"', '[{', '[]'):
+        try:
+            value = json.loads(text)
+        except ValueError:
+            return text
+        if is_attribute(value):
+            return decode_attribute(value)
+        if isinstance(value, list) and all(is_attribute(item) for item in value):
+            return [decode_attribute(item) for item in value]
+        return value
+    # Spreadsheet text marker in front of a value such as '-1
+    if text[0] == "'" and len(text) > 1 and text[1] in "-+=0123456789":
+        return text[1:]
+    # Strings quoted once more, as JSON ("...\n...") or CSV ("SELECT ""Id""")
+    for _ in range(3):
+        if len(text) < 2 or text[0] != '"' or text[-1] != '"':
+            break
+        try:
+            text = json.loads(text)
+        except ValueError:
+            text = text[1:-1].replace('""', '"')
+        if not isinstance(text, str):
+            return text
+    return text
+
+
+def to_scalar(value):
+    """Single-element lists, as the export wraps some scalars, become the element."""
+    return value[0] if isinstance(value, list) and len(value) == 1 else value
+
+
+def to_bool(value):
+    value = to_scalar(value)
+    if value is None or isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    return True if text in TRUE_VALUES else False if text in FALSE_VALUES else None
+
+
+def normalize_sources(value):
+    if value is None:
+        return []
+    sources = value if isinstance(value, list) else [value]
+    return [{SOURCE_KEY_RENAMES.get(key, key): item for key, item in source.items()} if isinstance(source, dict) else source
+            for source in sources]
+
+
+def normalize_record(record):
+    """chat_logs row (in CHAT_LOG_COLUMNS order) of one exported record, or None if it has no message_uuid."""
+    values = {COLUMN_RENAMES.get(column, column): decode_cell(text) for column, text in record.items() if column}
+    if not values.get("message_uuid"):
+        return None
+    for column in CHAT_LOG_COLUMNS:
+        if column not in ("sources", "document_upload"):
+            value = to_scalar(values.get(column))
+            values[column] = value if value is None or isinstance(value, str) else json.dumps(value) \
+                if isinstance(value, (dict, list)) else str(value)
+    values["document_upload"] = to_bool(values.get("document_upload"))
+    values["sources"] = json.dumps(normalize_sources(values.get("sources")))
+    return tuple(values.get(column) for column in CHAT_LOG_COLUMNS)
+
+
+def read_batches(path, batch_size):
+    """Raw records of the export, batch_size at a time."""
+    csv.field_size_limit(2 ** 31 - 1)
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        batch = []
+        for record in csv.DictReader(file):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def ensure_import_schema(connection):
+    """message_uuid must be unique for the import to skip rows that are already stored."""
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS chat_logs_message_uuid_idx ON chat_logs (message_uuid)")
+    connection.commit()
+
+
+def open_worker_connection():
+    global _connection
+    _connection = psycopg2.connect(**DB_CONFIG)
+
+
+def import_batch(records, dry_run=False):
+    """Normalize and store a batch; returns (rows read, rows invalid, rows inserted)."""
+    rows = []
+    invalid = 0
+    for record in records:
+        row = normalize_record(record)
+        if row is None:
+            invalid += 1
+        else:
+            rows.append(row)
+    if dry_run or not rows:
+        return len(records), invalid, 0
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    columns = ", ".join(CHAT_LOG_COLUMNS)
+    try:
+        with _connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (LIKE chat_logs INCLUDING DEFAULTS) "
+                           f"ON COMMIT DELETE ROWS")
+            cursor.copy_expert(f"COPY {STAGING_TABLE} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+            # A message exported twice in one batch is stored once, with its earliest row
+            cursor.execute(f"""
+                INSERT INTO chat_logs ({columns})
+                SELECT DISTINCT ON (message_uuid) {columns} FROM {STAGING_TABLE}
+                ORDER BY message_uuid, timestamp
+                ON CONFLICT (message_uuid) DO NOTHING
+            """)
+            inserted = cursor.rowcount
+        _connection.commit()
+    except Exception:
+        _connection.rollback()
+        raise
+    return len(records), invalid, inserted
+
+
+def import_chat_logs(path, workers=4, batch_size=20000, dry_run=False):
+    """Import an export file with parallel workers; returns the totals and rows per second."""
+    if not dry_run:
+        connection = psycopg2.connect(**DB_CONFIG)
+        try:
+            ensure_import_schema(connection)
+        finally:
+            connection.close()
+
+    totals = {"read": 0, "invalid": 0, "inserted": 0, "batches": 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers, initializer=None if dry_run else open_worker_connection) as pool:
+        pending = set()
+
+        def collect(done):
+            for future in done:
+                read, invalid, inserted = future.result()
+                totals["read"] += read
+                totals["invalid"] += invalid
+                totals["inserted"] += inserted
+                totals["batches"] += 1
+            logging.info(f"Imported {totals['inserted']} of {totals['read']} rows "
+                         f"({totals['read'] / (time.perf_counter() - start):.0f} rows/s)")
+
+        for batch in read_batches(path, batch_size):
+            if len(pending) >= workers * (1 + PENDING_BATCHES_PER_WORKER):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(import_batch, batch, dry_run))
+        collect(pending)
+
+    if not dry_run:
+        # The history endpoint's indexes are built once the rows are in, cheaper than keeping them up during the load
+        connection = psycopg2.connect(**DB_CONFIG)
+        try:
+            migrate_chat_schema(connection)
+        finally:
+            connection.close()
+
+    seconds = time.perf_counter() - start
+    totals["skipped"] = 0 if dry_run else totals["read"] - totals["invalid"] - totals["inserted"]
+    totals["seconds"] = round(seconds, 3)
+    totals["rows_per_second"] = round(totals["read"] / seconds, 1) if seconds else None
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="CSV export, e.g. results.csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--batch-size", type=int, default=20000)
+    parser.add_argument("--dry-run", action="store_true", help="decode and normalize only, without a database")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    totals = import_chat_logs(args.path, args.workers, args.batch_size, args.dry_run)
+    print(json.dumps(totals))
+    if totals["invalid"]:
+        print(f"{totals['invalid']} rows without a message_uuid were not imported", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import os
+import time
+import random
+import logging
+import threading
+import email.utils
+import openai
+from stage_timing import observe
+
+# Concurrent Azure OpenAI calls per process: the limit starts at the initial value and adapts between the bounds
+OPENAI_INITIAL_CONCURRENCY = int(os.getenv('OPENAI_INITIAL_CONCURRENCY', '8'))
+OPENAI_MIN_CONCURRENCY = int(os.getenv('OPENAI_MIN_CONCURRENCY', '1'))
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '32'))
+# Calls that may wait for a slot; beyond that new calls are rejected at once
+OPENAI_MAX_QUEUE = int(os.getenv('OPENAI_MAX_QUEUE', '64'))
+# Completions slower than this count as congestion, like a 429
+OPENAI_LATENCY_TARGET_MS = float(os.getenv('OPENAI_LATENCY_TARGET_MS', '20000'))
+# Time a call may take in total, queueing and retries included, and a single attempt
+OPENAI_DEADLINE_SECONDS = float(os.getenv('OPENAI_DEADLINE_SECONDS', '90'))
+OPENAI_REQUEST_TIMEOUT = float(os.getenv('OPENAI_REQUEST_TIMEOUT', '60'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '4'))
+
+# Multiplicative decrease of the limit on a 429 and on a slow completion
+THROTTLE_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+# Calls in flight when the limit drops report the same congestion; they do not lower it again for this long
+DECREASE_COOLDOWN_SECONDS = 1.0
+# Exponential backoff of retries without a retry-after, with full jitter
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+
+
+class LimiterRejected(Exception):
+    """The call was not started: the queue is full or its deadline passed while it waited."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Azure OpenAI call rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """Process-wide concurrency limit adapted AIMD-style.
+
+    Every successful completion within the latency target, made while all
+    slots were in use, adds 1/limit to the limit (about one more slot per
+    limit's worth of calls); a 429 halves it and a slow completion or
+    timeout lowers it by 10%. A retry-after received on a 429 holds back
+    every new call until it has passed.
+    """
+
+    def __init__(self, initial=OPENAI_INITIAL_CONCURRENCY, minimum=OPENAI_MIN_CONCURRENCY,
+                 maximum=OPENAI_MAX_CONCURRENCY, max_queue=OPENAI_MAX_QUEUE,
+                 latency_target_ms=OPENAI_LATENCY_TARGET_MS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_queue = max_queue
+        self.latency_target_ms = latency_target_ms
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.counters = {"admitted": 0, "rejected_queue_full": 0, "rejected_deadline": 0, "throttled": 0,
+                         "slow": 0, "failed": 0, "retried": 0, "gave_up": 0}
+        self.condition = threading.Condition()
+
+    def acquire(self, deadline):
+        """Wait for a slot until deadline (time.monotonic()); LimiterRejected if there is none."""
+        start = time.monotonic()
+        with self.condition:
+            if self.waiting >= self.max_queue and not self.available(start):
+                self.counters["rejected_queue_full"] += 1
+                raise LimiterRejected("queue full", self.retry_after_hint(start))
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.available(now):
+                        break
+                    if now >= deadline:
+                        self.counters["rejected_deadline"] += 1
+                        raise LimiterRejected("deadline passed while queued", self.retry_after_hint(now))
+                    wake = deadline if self.blocked_until <= now else min(deadline, self.blocked_until)
+                    self.condition.wait(wake - now)
+                self.in_flight += 1
+                self.counters["admitted"] += 1
+            finally:
+                self.waiting -= 1
+        observe("openai.queue_wait", (time.monotonic() - start) * 1000)
+
+    def available(self, now):
+        return self.in_flight < int(self.limit) and now >= self.blocked_until
+
+    def retry_after_hint(self, now):
+        """Seconds a rejected caller should wait before trying again."""
+        return max(1, round(self.blocked_until - now)) if self.blocked_until > now else 1
+
+    def release(self, latency_ms=None, throttled=False, retry_after=None, failed=False, timed_out=False):
+        """Give back a slot, adapting the limit to how the call went.
+
+        latency_ms is None for calls that ended with an error unrelated to load.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.counters["throttled"] += 1
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+                self.decrease(now, THROTTLE_DECREASE)
+            elif failed:
+                self.counters["failed"] += 1
+            elif timed_out or latency_ms is not None:
+                if timed_out or latency_ms > self.latency_target_ms:
+                    self.counters["slow"] += 1
+                    self.decrease(now, LATENCY_DECREASE)
+                elif self.in_flight + 1 >= int(self.limit):
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def decrease(self, now, factor):
+        if now - self.last_decrease >= DECREASE_COOLDOWN_SECONDS:
+            self.limit = max(self.minimum, self.limit * factor)
+            self.last_decrease = now
+            logging.warning(f"Azure OpenAI concurrency limit lowered to {int(self.limit)}")
+
+    def count(self, counter):
+        with self.condition:
+            self.counters[counter] += 1
+
+    def snapshot(self):
+        with self.condition:
+            return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "waiting": self.waiting,
+                    "blocked_for_s": round(max(0.0, self.blocked_until - time.monotonic()), 1), **self.counters}
+
+    def render_prometheus(self, metric="openai_limiter"):
+        snapshot = self.snapshot()
+        lines = []
+        for name in ("limit", "in_flight", "waiting", "blocked_for_s"):
+            lines += [f"# TYPE {metric}_{name} gauge", f"{metric}_{name} {snapshot[name]}"]
+        lines.append(f"# TYPE {metric}_calls_total counter")
+        lines += [f'{metric}_calls_total{{outcome="{name}"}} {snapshot[name]}' for name in self.counters]
+        return "\n".join(lines) + "\n"
+
+
+limiter = AdaptiveLimiter()
+
+
+def retry_after_seconds(response):
+    """Delay a 429 response asks for, from retry-after-ms or retry-after (seconds or an HTTP date)."""
+    headers = response.headers if response is not None else {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_seconds(attempt):
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def complete(create, deadline=None, **kwargs):
+    """Call create(**kwargs) (e.g. client.chat.completions.create) through the limiter.
+
+    Throttled, timed out and 5xx attempts are retried, after the retry-after
+    of a 429 or an exponential backoff, while the next attempt can still
+    start before deadline (time.monotonic(); OPENAI_DEADLINE_SECONDS from now
+    by default). The client should be created with max_retries=0, so that
+    every attempt goes through the limiter.
+    """
+    deadline = deadline or time.monotonic() + OPENAI_DEADLINE_SECONDS
+    attempt = 0
+    while True:
+        limiter.acquire(deadline)
+        start = time.monotonic()
+        timeout = max(1.0, min(OPENAI_REQUEST_TIMEOUT, deadline - start))
+        try:
+            result = create(timeout=timeout, **kwargs)
+        except openai.RateLimitError as e:
+            retry_after = retry_after_seconds(e.response)
+            limiter.release(throttled=True, retry_after=retry_after)
+            error, delay = e, retry_after if retry_after is not None else backoff_seconds(attempt)
+        except openai.APITimeoutError as e:
+            limiter.release(timed_out=True)
+            error, delay = e, backoff_seconds(attempt)
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            limiter.release(failed=True)
+            error, delay = e, backoff_seconds(attempt)
+        except Exception:
+            limiter.release()
+            raise
+        else:
+            limiter.release(latency_ms=(time.monotonic() - start) * 1000)
+            return result
+
+        attempt += 1
+        if attempt > OPENAI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+            limiter.count("gave_up")
+            raise error
+        limiter.count("retried")
+        logging.warning(f"Azure OpenAI call failed ({type(error).__name__}), retry {attempt} in {delay:.1f}s")
+        time.sleep(delay)
@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import functools
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+
+# Statements slower than this are logged with their EXPLAIN plan
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '250'))
+# Each fingerprint is explained at most once per this many seconds and process
+EXPLAIN_INTERVAL = float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL', '300'))
+# Statements a request may run before a warning is logged
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', '10'))
+# Runs of one statement per request beyond which it is reported as a likely N+1 lookup
+REPEATED_QUERY_LIMIT = int(os.getenv('REPEATED_QUERY_LIMIT', '3'))
+
+# Statements that can be explained without running them
+EXPLAINABLE = ("select", "with", "insert", "update", "delete")
+
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\b\d+(?:\.\d+)?\b")
+VALUE_LIST_PATTERN = re.compile(r"\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))+|\(\?(?:, \?)+\)")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+_local = threading.local()
+_explained = {}
+_explained_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query):
+    """Normalized form of a statement: literals and parameters become ?, value lists (...) and whitespace collapse."""
+    text = WHITESPACE_PATTERN.sub(" ", LITERAL_PATTERN.sub("?", query)).strip().rstrip(";")
+    return VALUE_LIST_PATTERN.sub("(...)", text.replace("( ", "(").replace(" )", ")").replace(" ,", ","))
+
+
+def row_bytes(rows):
+    """Approximate size of fetched rows, by the length of their values."""
+    return sum(len(value) if isinstance(value, (str, bytes)) else len(str(value))
+               for row in rows for value in row if value is not None)
+
+
+class QueryLog:
+    """Statements run while handling one request, by fingerprint."""
+
+    def __init__(self, name, budget=QUERY_BUDGET):
+        self.name = name
+        self.budget = budget
+        self.statements = {}
+        self.count = 0
+        self.total_ms = 0.0
+
+    def record(self, fingerprint, duration_ms, rows):
+        stats = self.statements.setdefault(fingerprint, {"calls": 0, "ms": 0.0, "rows": 0, "bytes": 0})
+        stats["calls"] += 1
+        stats["ms"] += duration_ms
+        stats["rows"] += max(rows, 0)
+        self.count += 1
+        self.total_ms += duration_ms
+
+    def record_fetch(self, fingerprint, fetched_bytes):
+        if fingerprint in self.statements:
+            self.statements[fingerprint]["bytes"] += fetched_bytes
+
+    def finish(self):
+        """Log the statements of the request, warning if it ran more than its budget or one statement too often."""
+        repeated = sorted(((stats["calls"], statement) for statement, stats in self.statements.items()
+                           if stats["calls"] > 1), reverse=True)
+        if self.count > self.budget:
+            logging.warning(f"Query budget exceeded in {self.name}: {self.count} statements (budget {self.budget})"
+                            + "".join(f"\n  {calls}x {statement}" for calls, statement in repeated))
+        elif repeated and repeated[0][0] > REPEATED_QUERY_LIMIT:
+            logging.warning(f"Repeated query in {self.name}, likely N+1: {repeated[0][0]}x {repeated[0][1]}")
+        if self.count:
+            record = {"request": self.name, "statements": self.count, "total_ms": round(self.total_ms, 1),
+                      "by_fingerprint": {statement: dict(stats, ms=round(stats["ms"], 1))
+                                         for statement, stats in self.statements.items()}}
+            logging.info(f"Query log: {json.dumps(record)}")
+
+
+def current_query_log():
+    return getattr(_local, "query_log", None)
+
+
+def track_queries(name=None, budget=QUERY_BUDGET):
+    """Decorator logging the statements every call of a function runs against its query budget."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            previous = current_query_log()
+            _local.query_log = QueryLog(name or function.__name__, budget)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _local.query_log.finish()
+                _local.query_log = previous
+        return wrapper
+    return decorator
+
+
+def explain(connection, query, vars):
+    """EXPLAIN plan of a statement, in a savepoint so a failure cannot abort the caller's transaction."""
+    savepoint = not connection.autocommit
+    with connection.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT query_log_explain")
+            cursor.execute(f"EXPLAIN {query}", vars)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT query_log_explain")
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT query_log_explain")
+            return f"(EXPLAIN failed: {e})"
+
+
+def should_explain(statement):
+    if not statement.lower().startswith(EXPLAINABLE):
+        return False
+    now = time.monotonic()
+    with _explained_lock:
+        if now - _explained.get(statement, -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL:
+            return False
+        _explained[statement] = now
+        return True
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor timing every statement into the request's QueryLog and logging slow ones with their plan."""
+
+    fingerprint = None
+
+    def execute(self, query, vars=None):
+        text = query.as_string(self) if isinstance(query, sql.Composable) else query
+        start = time.perf_counter()
+        try:
+            return super().execute(text, vars)
+        finally:
+            self.record_statement(text, vars, (time.perf_counter() - start) * 1000)
+
+    def record_statement(self, text, vars, duration_ms):
+        self.fingerprint = fingerprint(text)
+        query_log = current_query_log()
+        if query_log is not None:
+            query_log.record(self.fingerprint, duration_ms, self.rowcount)
+        if duration_ms > SLOW_QUERY_MS:
+            # A failed statement has aborted the transaction, so there is nothing to explain it in
+            usable = not self.connection.closed and \
+                self.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR
+            plan = explain(self.connection, text, vars) if usable and should_explain(self.fingerprint) else None
+            logging.warning(f"Slow query ({duration_ms:.0f} ms, {self.rowcount} rows): {self.fingerprint}"
+                            + (f"\n{plan}" if plan else ""))
+
+    def record_fetch(self, rows):
+        query_log = current_query_log()
+        if query_log is not None and self.fingerprint:
+            query_log.record_fetch(self.fingerprint, row_bytes(rows))
+        return rows
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.record_fetch([row])
+        return row
+
+    def fetchmany(self, size=None):
+        return self.record_fetch(super().fetchmany(size) if size is not None else super().fetchmany())
+
+    def fetchall(self):
+        return self.record_fetch(super().fetchall())
+
+
+def connect(**config):
+    """psycopg2 connection whose cursors are instrumented."""
+    return psycopg2.connect(cursor_factory=InstrumentedCursor, **config)
@@ -0,0 +1,97 @@
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from graph_client import RateLimiter
+from drive_crawler import LIST_WORKERS, DOWNLOAD_WORKERS, MAX_PENDING_DOWNLOADS
+from filter_policy import FilterPolicy
+
+# Registry of the SharePoint sites to crawl
+SITES_FILE = os.getenv('SHAREPOINT_SITES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sites.json'))
+
+# Sites crawled at the same time
+SITE_WORKERS = int(os.getenv('CRAWL_SITE_WORKERS', '4'))
+
+# Graph requests per second a site may send unless its budget says otherwise
+DEFAULT_REQUESTS_PER_SECOND = float(os.getenv('SITE_REQUESTS_PER_SECOND', '10'))
+
+
+class SiteConfig:
+    """One SharePoint site of the registry and its crawl budget.
+
+    lists are the list titles scraped as pages; drives restricts the document
+    libraries crawled (names or ids), None meaning all of them; exclude holds
+    the FilterPolicy rules of its files and pages. Every site has
+    its own rate limiter and worker pools, so a large site cannot starve the
+    others or push the tenant into throttling.
+    """
+
+    def __init__(self, name, site_id, lists=(), drives=None, exclude=None, budget=None, pages_folder=None):
+        self.name = name
+        self.site_id = site_id
+        self.lists = list(lists)
+        self.drives = None if drives is None else set(drives)
+        self.pages_folder = pages_folder or f"scraped_pages/{name}"
+
+        self.filter_policy = FilterPolicy(exclude)
+
+        budget = budget or {}
+        self.requests_per_second = float(budget.get("requests_per_second", DEFAULT_REQUESTS_PER_SECOND))
+        self.list_workers = int(budget.get("list_workers", LIST_WORKERS))
+        self.download_workers = int(budget.get("download_workers", DOWNLOAD_WORKERS))
+        self.max_pending_downloads = int(budget.get("max_pending_downloads", MAX_PENDING_DOWNLOADS))
+        self.rate_limiter = RateLimiter(self.requests_per_second)
+
+    def includes_drive(self, drive):
+        return self.drives is None or drive["id"] in self.drives or drive.get("name") in self.drives
+
+    def crawler_options(self):
+        """DriveCrawler keyword arguments enforcing this site's budget."""
+        return {
+            "list_workers": self.list_workers,
+            "download_workers": self.download_workers,
+            "max_pending_downloads": self.max_pending_downloads,
+            "rate_limiter": self.rate_limiter,
+        }
+
+
+def load_sites(path=SITES_FILE):
+    """Load the site registry."""
+    with open(path, encoding="utf-8") as file:
+        registry = json.load(file)
+    return [SiteConfig(**entry) for entry in registry["sites"]]
+
+
+def crawl_sites(sites, crawl_site, workers=SITE_WORKERS):
+    """Run crawl_site(site) for every site concurrently.
+
+    A failing site does not stop the others; returns the error of each failed site by name.
+    """
+    failed = {}
+    if not sites:
+        return failed
+
+    def run(site):
+        try:
+            crawl_site(site)
+        except Exception as e:
+            logging.info(f"Error processing site {site.name}: {e}")
+            failed[site.name] = e
+
+    with ThreadPoolExecutor(min(workers, len(sites)), thread_name_prefix="crawl-site") as site_pool:
+        list(site_pool.map(run, sites))
+    return failed
+
+
+_registered_sites = None
+_registered_sites_lock = threading.Lock()
+
+
+def get_site(name):
+    """A site of the registry by name, loaded once per process so its budget is shared."""
+    global _registered_sites
+    with _registered_sites_lock:
+        if _registered_sites is None:
+            _registered_sites = {site.name: site for site in load_sites()}
+    return _registered_sites[name]
@@ -0,0 +1,149 @@
+import json
+import math
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in milliseconds of the latency histogram buckets; one more bucket holds everything slower
+HISTOGRAM_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, cheap enough to update on every request."""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS_MS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile (the maximum for the open bucket)."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total, 3),
+            "max_ms": round(self.max, 3),
+            "p50_ms": self.quantile(0.50),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+def observe(name, duration_ms):
+    """Add a duration to the histogram of name, created on first use."""
+    with _histograms_lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(duration_ms)
+
+
+def metrics_snapshot():
+    """Histograms of this process by name."""
+    with _histograms_lock:
+        return {name: histogram.snapshot() for name, histogram in sorted(_histograms.items())}
+
+
+def render_prometheus(metric="chat_stage_duration_ms"):
+    """The histograms in the Prometheus text format, one series per stage."""
+    lines = [f"# TYPE {metric} histogram"]
+    with _histograms_lock:
+        for name, histogram in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{stage="{name}"}} {histogram.total:.3f}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {histogram.count}')
+    return "\n".join(lines) + "\n"
+
+
+def parse_server_timing(header):
+    """(name, duration in ms) of every metric of a Server-Timing header that has a duration."""
+    metrics = []
+    for entry in (header or "").split(","):
+        name, *params = [part.strip() for part in entry.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "dur" and name:
+                try:
+                    metrics.append((name, float(value.strip('"'))))
+                except ValueError:
+                    pass
+    return metrics
+
+
+class StageTimer:
+    """Times the stages of one request.
+
+    Wrap each stage in stage(name); timings reported by a downstream function
+    in its Server-Timing header are added under a prefix with add_downstream.
+    finish() records every stage in the process histograms as scope.stage,
+    logs one structured record and returns the Server-Timing response header.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, (time.perf_counter() - start) * 1000))
+
+    def add_downstream(self, prefix, response):
+        """Add the stages a downstream function reported on its response."""
+        if response is not None:
+            for name, duration_ms in parse_server_timing(response.headers.get("Server-Timing")):
+                self.stages.append((f"{prefix}.{name}", duration_ms))
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self, total_ms=None):
+        metrics = self.stages + [("total", self.elapsed_ms() if total_ms is None else total_ms)]
+        return ", ".join(f"{name};dur={duration_ms:.1f}" for name, duration_ms in metrics)
+
+    def finish(self, **fields):
+        """Record the stages and total of the request; fields are added to the log record.
+
+        Returns the response headers carrying the timings.
+        """
+        total_ms = self.elapsed_ms()
+        for name, duration_ms in self.stages:
+            observe(f"{self.scope}.{name}", duration_ms)
+        observe(f"{self.scope}.total", total_ms)
+
+        record = {"scope": self.scope, "total_ms": round(total_ms, 1),
+                  "stages": [[name, round(duration_ms, 1)] for name, duration_ms in self.stages]}
+        record.update(fields)
+        logging.info(f"Stage timing: {json.dumps(record, default=str)}")
+        return {"Server-Timing": self.server_timing(total_ms)}
@@ -0,0 +1,123 @@
+import os
+import re
+import json
+from bisect import bisect_right
+from PyPDF2 import PdfReader
+from docx import Document
+
+# Characters per sidecar chunk, and how many of them the next chunk repeats
+CHUNK_SIZE = int(os.getenv('SIDECAR_CHUNK_SIZE', '2000'))
+CHUNK_OVERLAP = int(os.getenv('SIDECAR_CHUNK_OVERLAP', '200'))
+
+# Sidecars are stored next to their blob under the blob name plus this suffix
+SIDECAR_SUFFIX = ".text.json"
+SIDECAR_VERSION = 1
+
+EXTRACTABLE_TYPES = ("pdf", "docx", "txt")
+
+
+def read_txt(file_path):
+    """Read text from a plain text file."""
+    with open(file_path, 'r') as f:
+        return f.read()
+
+
+def read_docx(file_path):
+    """Read text from a DOCX file."""
+    doc = Document(file_path)
+    return '\n'.join([paragraph.text for paragraph in doc.paragraphs])
+
+
+def read_pdf(file_path):
+    """Read text from a PDF file using PyPDF2."""
+    return "".join(read_pdf_pages(file_path))
+
+
+def read_pdf_pages(file):
+    """Text of every page of a PDF (path or binary file object)."""
+    return [page.extract_text() or "" for page in PdfReader(file).pages]
+
+
+def get_file_type(file_name):
+    """Extractable type of a file by its extension, or None."""
+    file_type = os.path.splitext(file_name)[1].lower().lstrip(".")
+    return file_type if file_type in EXTRACTABLE_TYPES else None
+
+
+def extract_pages(file, file_type):
+    """Text of a binary file object by page; DOCX and TXT files have no pages and come back as one."""
+    if file_type == "pdf":
+        return read_pdf_pages(file)
+    if file_type == "docx":
+        return [read_docx(file)]
+    if file_type == "txt":
+        return [file.read().decode("utf-8", errors="replace")]
+    raise ValueError(f"Unsupported file type: {file_type}")
+
+
+def normalize_text(text):
+    """Collapse runs of spaces and blank lines and drop trailing whitespace."""
+    text = re.sub(r"[ \t\r\f\v]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def chunk_spans(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """(start, end) offsets of overlapping chunks of text, ending on whitespace where possible."""
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            # Back off to the last break in the second half of the chunk
+            cut = max(text.rfind("\n", start + chunk_size // 2, end), text.rfind(" ", start + chunk_size // 2, end))
+            if cut > start:
+                end = cut
+        spans.append((start, end))
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        # Start the next chunk on a word
+        while start < end and not text[start - 1].isspace():
+            start += 1
+    return spans
+
+
+def build_sidecar(pages, content_hash=None, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Normalized text sidecar of a document's pages.
+
+    The text is stored once. pages holds [start, end] offsets of each page
+    into it, and chunks holds [start, end, first_page, last_page] with
+    1-based page numbers. content_hash is the source content the text came
+    from, so it is only extracted again when that changes.
+    """
+    texts = []
+    page_spans = []
+    offset = 0
+    for page in pages:
+        page_text = normalize_text(page)
+        if texts:
+            offset += 2
+        page_spans.append([offset, offset + len(page_text)])
+        texts.append(page_text)
+        offset += len(page_text)
+    text = "\n\n".join(texts)
+
+    page_starts = [start for start, _ in page_spans]
+    chunks = [[start, end, bisect_right(page_starts, start), bisect_right(page_starts, max(end - 1, start))]
+              for start, end in chunk_spans(text, chunk_size, overlap)]
+    return {
+        "version": SIDECAR_VERSION,
+        "content_hash": content_hash,
+        "text": text,
+        "pages": page_spans,
+        "chunks": chunks,
+    }
+
+
+def dump_sidecar(sidecar):
+    return json.dumps(sidecar, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def get_sidecar_name(blob_name):
+    return f"{blob_name}{SIDECAR_SUFFIX}"
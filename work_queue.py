@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+# Storage Queue the crawl shards are sent through; the shard worker function is triggered by it
+QUEUE_NAME = os.getenv('CRAWL_QUEUE_NAME', 'crawl-shards')
+# "local" keeps the shards in process and drains them on threads, for tests and local runs
+QUEUE_MODE = os.getenv('CRAWL_QUEUE', 'storage')
+# Worker threads draining a local queue
+LOCAL_WORKERS = int(os.getenv('CRAWL_LOCAL_WORKERS', '4'))
+
+
+class StorageQueue:
+    """Azure Storage Queue of JSON messages."""
+
+    def __init__(self, queue_name=QUEUE_NAME, connection_string=None):
+        # Only needed when shards actually go through Azure
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+
+        # The Functions queue trigger expects base64 encoded messages
+        self.client = QueueClient.from_connection_string(
+            connection_string or os.getenv('AZURE_STORAGE_CONNECTION_STRING'), queue_name,
+            message_encode_policy=TextBase64EncodePolicy())
+        try:
+            self.client.create_queue()
+        except ResourceExistsError:
+            pass
+
+    def send(self, message):
+        self.client.send_message(json.dumps(message))
+
+
+class LocalQueue:
+    """In-process stand-in for StorageQueue."""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+
+    def send(self, message):
+        # Serialized like the real queue, so messages that do not survive JSON fail locally too
+        self.messages.put(json.dumps(message))
+
+    def receive(self):
+        """Next message, or None if the queue is empty."""
+        try:
+            return json.loads(self.messages.get_nowait())
+        except queue.Empty:
+            return None
+
+
+def get_work_queue():
+    return LocalQueue() if QUEUE_MODE == "local" else StorageQueue()
+
+
+def drain(local_queue, handle, workers=LOCAL_WORKERS):
+    """Run handle(message) for every message of a LocalQueue on worker threads.
+
+    Handlers may send more messages; draining stops once the queue is empty
+    and no handler is running. Returns the messages whose handler failed.
+    """
+    lock = threading.Lock()
+    running = [0]
+    failed = []
+
+    def work():
+        while True:
+            with lock:
+                message = local_queue.receive()
+                if message is None and not running[0]:
+                    return
+                if message is not None:
+                    running[0] += 1
+            if message is None:
+                # A running handler may still send more
+                time.sleep(0.1)
+                continue
+            try:
+                handle(message)
+            except Exception as e:
+                logging.info(f"Failed to handle message {message}: {e}")
+                failed.append(message)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+    threads = [threading.Thread(target=work, name=f"queue-worker-{index}") for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed